@@ -1,10 +1,12 @@
 # Copyright (c) 2009-2014 Simon Kennedy <sffjunkie+code@gmail.com>
 
+import os
 import logging
 
 __all__ = ['MediaContainer', 'MediaEntry', 'MediaStream', 'MediaHandlerError',
            'AudioStreamInfo', 'VideoStreamInfo', 'ImageStreamInfo',
-           'SubtitleStreamInfo', 'Image', 'TagTarget', 'Tag', 'TagGroup']
+           'SubtitleStreamInfo', 'Image', 'TagTarget', 'Tag', 'TagGroup',
+           'copy_range']
 
 
 class MediaHandlerError(Exception):
@@ -161,3 +163,49 @@ class SubtitleStreamInfo(object):
     def __init__(self):
         self.metadata = {}
         self.locale = None    
+
+
+def copy_range(src, dest, offset, length, block_size=1048576):
+    """Copy `length` bytes at `offset` in the `src` stream to the current
+    position in `dest`.
+
+    When both streams are files the data is copied by the kernel using
+    `os.copy_file_range` or `os.sendfile` where available.
+    """
+
+    try:
+        src_fd = src.fileno()
+        dest_fd = dest.fileno()
+    except (AttributeError, IOError, ValueError):
+        src_fd = dest_fd = None
+
+    if src_fd is not None:
+        dest.flush()
+        pos = dest.tell()
+        try:
+            while length > 0:
+                if hasattr(os, 'copy_file_range'):
+                    count = os.copy_file_range(src_fd, dest_fd, length,
+                                               offset, pos)
+                elif hasattr(os, 'sendfile'):
+                    os.lseek(dest_fd, pos, os.SEEK_SET)
+                    count = os.sendfile(dest_fd, src_fd, offset, length)
+                else:
+                    break
+
+                if count == 0:
+                    raise EOFError('Unexpected end of stream')
+                offset += count
+                pos += count
+                length -= count
+        except OSError:
+            pass
+        dest.seek(pos, os.SEEK_SET)
+
+    src.seek(offset, os.SEEK_SET)
+    while length > 0:
+        data = src.read(min(block_size, length))
+        if len(data) == 0:
+            raise EOFError('Unexpected end of stream')
+        dest.write(data)
+        length -= len(data)
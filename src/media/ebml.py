@@ -5,6 +5,7 @@ import uuid
 import struct
 import datetime
 from io import BytesIO
+from array import array
 
 from mogul.locale import localize
 _ = localize.get_translator('mogul.media')
@@ -16,7 +17,7 @@ from mogul.media import (MediaHandler, MediaHandlerError,
 from mogul.media.element import Element
 from mogul.media.tag import Tag, TagTarget, TagGroup
     
-__all__ = ['EBMLHandler']
+__all__ = ['EBMLHandler', 'EBMLCues']
 
 DATA_SIZE = [8, 7, 6, 6, 5, 5, 5, 5, 4, 4, 4, 4, 4, 4, 4, 4,
              3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3, 3,
@@ -39,6 +40,226 @@ VSINT_SUBTR = [0x3F, 0x1FFF, 0x0FFFFF, 0x07FFFFFF,
                0x03FFFFFFFF, 0x01FFFFFFFFFF,
                0x00FFFFFFFFFFFF, 0x007FFFFFFFFFFFFF]
 
+SEGMENT_ID = 0x18538067
+SEEK_HEAD_ID = 0x114d9b74
+CLUSTER_ID = 0x1f43b675
+CUES_ID = 0x1c53bb6b
+ATTACHMENTS_ID = 0x1941a469
+TAGS_ID = 0x1254c367
+VOID_ID = 0xec
+CRC32_ID = 0xbf
+
+LEVEL1_IDS = [0x18538067, 0x1f43b675, 0x114d9b74, 0x1549a966, 0x1654ae6b,
+              0x1c53bb6b, 0x1941a469, 0x1043a770, 0x1254c367]
+"""The Segment and the top level elements within it"""
+
+SEEK_IDS = {
+    0x114d9b74: 'seek_head',
+    0x1549a966: 'metadata',
+    0x1654ae6b: 'tracks',
+    0x1043a770: 'chapters',
+    0x1c53bb6b: 'cues',
+    0x1941a469: 'attachments',
+    0x1254c367: 'tags',
+}
+"""Level 1 elements which are read using the Seek Head positions, keyed by
+the name used in `MediaEntry.seek`"""
+
+# The Matroska elements as (ID, title, type, reader, key). The reader is
+# either the name of an EBMLHandler method or 'container' / 'entry' to store
+# the decoded value under `key` in the metadata of the container / media
+# entry. Elements without a reader are skipped.
+EBML_SCHEMA = [
+    (0x1a45dfa3, _('Header'),                             'master', '_read_header'),
+    (0xec,       _('Void'),                               'binary'),
+    (0xbf,       _('CRC-32'),                             'binary'),
+    (0x4282,     _('Doctype'),                            'string', 'container', 'doctype'),
+    (0x4286,     _('Version'),                            'uint',   'container', 'version'),
+    (0x42f7,     _('Read Version'),                       'uint',   'container', 'read_version'),
+    (0x42f2,     _('Max ID Length'),                      'uint',   'container', 'max_id_len'),
+    (0x42f3,     _('Max Size Length'),                    'uint',   'container', 'max_size_len'),
+    (0x4287,     _('Doctype Version'),                    'uint',   'container', 'doctype_version'),
+    (0x4285,     _('Doctype Read Version'),               'uint',   'container', 'doctype_read_version'),
+    (0x18538067, _('Segment'),                            'master', '_read_segment'),
+    (0x2ad7b1,   _('Timecode Scale'),                     'uint',   'entry', 'timecode_scale'),
+    (0x4d80,     _('Muxing Application'),                 'utf8',   'entry', 'app_mux'),
+    (0x5741,     _('Writing Application'),                'utf8',   'entry', 'app_write'),
+    (0x4489,     _('Duration'),                           'float',  'entry', 'duration'),
+    (0x4461,     _('Date UTC'),                           'date',   'entry', 'date_utc'),
+    (0x73a4,     _('Segment UID'),                        'binary', '_read_segment_uid'),
+    (0x114d9b74, _('Seek Head'),                          'master', '_read_seek_head'),
+    (0x4dbb,     _('Seek'),                               'master', '_read_seek'),
+    (0x53ab,     _('Seek ID'),                            'binary', '_read_seek_id'),
+    (0x53ac,     _('Seek Position'),                      'uint',   '_read_seek_pos'),
+    (0x1549a966, _('Info'),                               'master', '_read_info'),
+    (0x1f43b675, _('Cluster'),                            'master', '_read_cluster'),
+    (0xe7,       _('Timecode'),                           'uint'),
+    (0x5854,     _('Silent Tracks'),                      'master'),
+    (0xa7,       _('Position'),                           'uint'),
+    (0xab,       _('Previous Size'),                      'uint'),
+    (0xa3,       _('Simple Block'),                       'binary'),
+    (0xa0,       _('Block Group'),                        'master'),
+    (0xa1,       _('Block'),                              'binary'),
+    (0xa2,       _('Block Virtual'),                      'binary'),
+    (0x75a1,     _('Block Additions'),                    'master'),
+    (0xa6,       _('Block More'),                         'master'),
+    (0xee,       _('Block Add ID'),                       'uint'),
+    (0xa5,       _('Block Additional'),                   'binary'),
+    (0x9b,       _('Block Duration'),                     'uint'),
+    (0xfa,       _('Reference Priority'),                 'uint'),
+    (0xfb,       _('Reference Block'),                    'int'),
+    (0xfd,       _('Reference Virtual'),                  'int'),
+    (0xa4,       _('Codec State'),                        'binary'),
+    (0x8e,       _('Slices'),                             'master'),
+    (0xe8,       _('Time Slice'),                         'master'),
+    (0xcc,       _('Lace Number'),                        'uint'),
+    (0xcd,       _('Frame Number'),                       'uint'),
+    (0xcb,       _('Block Addition ID'),                  'uint'),
+    (0xce,       _('Delay'),                              'uint'),
+    (0xcf,       _('Slice Duration'),                     'uint'),
+    (0xc8,       _('Reference Frame'),                    'master'),
+    (0xc9,       _('Reference Offset'),                   'uint'),
+    (0xca,       _('Reference Timecode'),                 'uint'),
+    (0xaf,       _('Encrypted Block'),                    'binary'),
+    (0x1654ae6b, _('Tracks'),                             'master', '_read_tracks'),
+    (0xae,       _('Track Entry'),                        'master', '_read_track_entry'),
+    (0xd7,       _('Track Number'),                       'uint',   '_read_track_number'),
+    (0x73c5,     _('Track UID'),                          'uint',   '_read_track_uid'),
+    (0x83,       _('Track Type'),                         'uint',   '_read_track_type'),
+    (0xb9,       _('Flag Enabled'),                       'uint'),
+    (0x88,       _('Flag Default'),                       'uint'),
+    (0x55aa,     _('Flag Forced'),                        'uint'),
+    (0x9c,       _('Flag Lacing'),                        'uint'),
+    (0x6de7,     _('Min Cache'),                          'uint'),
+    (0x6df8,     _('Max Cache'),                          'uint'),
+    (0x23e383,   _('Default Duration'),                   'uint',   '_read_track_default_duration'),
+    (0x23314f,   _('Track Timecode Scale'),               'float'),
+    (0x55ee,     _('Max Block Addition ID'),              'uint'),
+    (0x536e,     _('Track Name'),                         'utf8',   '_read_track_name'),
+    (0x22b59c,   _('Track Language'),                     'string', '_read_track_language'),
+    (0x86,       _('Codec ID'),                           'string', '_read_track_codec_id'),
+    (0x63a2,     _('Codec Private'),                      'binary', '_read_track_codec_private'),
+    (0x258688,   _('Codec Name'),                         'utf8'),
+    (0x7446,     _('Attachment Link'),                    'uint'),
+    (0xaa,       _('Codec Decode All'),                   'uint'),
+    (0x6fab,     _('Track Overlay'),                      'uint'),
+    (0x6624,     _('Track Translate'),                    'master'),
+    (0x66fc,     _('Track Translate Edition UID'),        'uint'),
+    (0x66bf,     _('Track Translate Codec'),              'uint'),
+    (0x66a5,     _('Track Translate Track ID'),           'binary'),
+    (0xe0,       _('Video'),                              'master', '_read_video'),
+    (0x9a,       _('Flag Interlace'),                     'uint',   '_read_video_entry'),
+    (0x53b8,     _('Stereo Mode'),                        'uint'),
+    (0xb0,       _('Pixel Width'),                        'uint',   '_read_video_entry'),
+    (0xba,       _('Pixel Height'),                       'uint',   '_read_video_entry'),
+    (0x54aa,     _('Pixel Crop Bottom'),                  'uint'),
+    (0x54bb,     _('Pixel Crop Top'),                     'uint'),
+    (0x54cc,     _('Pixel Crop Left'),                    'uint'),
+    (0x54dd,     _('Pixel Crop Right'),                   'uint'),
+    (0x54b0,     _('Display Width'),                      'uint'),
+    (0x54ba,     _('Display Height'),                     'uint'),
+    (0x54b2,     _('Display Unit'),                       'uint'),
+    (0x54b3,     _('Aspect Ratio'),                       'uint'),
+    (0x2eb525,   _('Colour Space'),                       'binary', '_read_color_space'),
+    (0x2fb523,   _('Gamma'),                              'float'),
+    (0x2383e3,   _('Frame Rate'),                         'float'),
+    (0xe1,       _('Audio'),                              'master'),
+    (0xb5,       _('Sampling Frequency'),                 'float'),
+    (0x78b5,     _('Output Sampling Frequency'),          'float'),
+    (0x9f,       _('Channels'),                           'uint'),
+    (0x7d7b,     _('Channel Positions'),                  'binary'),
+    (0x6264,     _('Bit Depth'),                          'uint'),
+    (0xe2,       _('Track Operation'),                    'master'),
+    (0xe3,       _('Track Combine Planes'),               'master'),
+    (0xe4,       _('Track Plane'),                        'master'),
+    (0xe5,       _('Track Plane UID'),                    'uint'),
+    (0xe6,       _('Track Plane Type'),                   'uint'),
+    (0xe9,       _('Track Join Blocks'),                  'master'),
+    (0xed,       _('Track Join UID'),                     'uint'),
+    (0x6d80,     _('Content Encodings'),                  'master'),
+    (0x6240,     _('Content Encoding'),                   'master'),
+    (0x5031,     _('Content Encoding Order'),             'uint'),
+    (0x5032,     _('Content Encoding Scope'),             'uint'),
+    (0x5033,     _('Content Encoding Type'),              'uint'),
+    (0x5034,     _('Content Compression'),                'master'),
+    (0x4254,     _('Content Compression Algorithm'),      'uint'),
+    (0x4255,     _('Content Compression Settings'),       'binary'),
+    (0x5035,     _('Content Encryption'),                 'master'),
+    (0x47e1,     _('Content Encryption Algorithm'),       'uint'),
+    (0x47e2,     _('Content Encryption Key ID'),          'binary'),
+    (0x47e3,     _('Content Signature'),                  'binary'),
+    (0x47e4,     _('Content Signature Key ID'),           'binary'),
+    (0x47e5,     _('Content Signature Algorithm'),        'uint'),
+    (0x47e6,     _('Content Signature Hash Algorithm'),   'uint'),
+    (0x1c53bb6b, _('Cues'),                               'master', '_read_cues'),
+    (0xbb,       _('Cue Point'),                          'master'),
+    (0xb3,       _('Cue Time'),                           'uint'),
+    (0xb7,       _('Cue Track Positions'),                'master'),
+    (0xf7,       _('Cue Track'),                          'uint'),
+    (0xf1,       _('Cue Cluster Position'),               'uint'),
+    (0x5378,     _('Cue Block Number'),                   'uint'),
+    (0xea,       _('Cue Codec State'),                    'uint'),
+    (0xdb,       _('Cue Reference'),                      'master'),
+    (0x96,       _('Cue Reference Time'),                 'uint'),
+    (0x97,       _('Cue Reference Cluster'),              'uint'),
+    (0x535f,     _('Cue Reference Number'),               'uint'),
+    (0xeb,       _('Cue Reference Codec State'),          'uint'),
+    (0x1941a469, _('Attachments'),                        'master', '_read_attachments'),
+    (0x61a7,     _('Attached File'),                      'master', '_read_attached_file'),
+    (0x467e,     _('File Description'),                   'utf8',   '_read_file_description'),
+    (0x466e,     _('File Name'),                          'utf8',   '_read_file_name'),
+    (0x4660,     _('File Mime Type'),                     'string', '_read_file_mimetype'),
+    (0x465c,     _('File Data'),                          'binary', '_read_file_data'),
+    (0x46ae,     _('File UID'),                           'uint',   '_read_file_uid'),
+    (0x4675,     _('File Referral'),                      'binary'),
+    (0x4661,     _('File Used Start Time'),               'uint'),
+    (0x4662,     _('File Used End Time'),                 'uint'),
+    (0x1043a770, _('Chapters'),                           'master', '_read_chapters'),
+    (0x45b9,     _('Edition Entry'),                      'master'),
+    (0x45bc,     _('Edition UID'),                        'uint'),
+    (0x45bd,     _('Edition Flag Hidden'),                'uint'),
+    (0x45db,     _('Edition Flag Default'),               'uint'),
+    (0x45dd,     _('Edition Flag Ordered'),               'uint'),
+    (0xb6,       _('Chapter'),                            'master'),
+    (0x73c4,     _('Chapter UID'),                        'uint'),
+    (0x91,       _('Chapter Time Start'),                 'uint'),
+    (0x92,       _('Chapter Time End'),                   'uint'),
+    (0x98,       _('Chapter Flag Hidden'),                'uint'),
+    (0x4598,     _('Chapter Flag Enabled'),               'uint'),
+    (0x6e67,     _('Chapter Segment UID'),                'binary'),
+    (0x6ebc,     _('Chapter Segment Edition UID'),        'uint'),
+    (0x63c3,     _('Chapter Physical Equivalent'),        'uint'),
+    (0x8f,       _('Chapter Track'),                      'master'),
+    (0x89,       _('Chapter Track Number'),               'uint'),
+    (0x80,       _('Chapter Display'),                    'master'),
+    (0x85,       _('Chapter String'),                     'utf8'),
+    (0x437c,     _('Chapter Language'),                   'string'),
+    (0x437e,     _('Chapter Country'),                    'string'),
+    (0x6944,     _('Chapter Process'),                    'master'),
+    (0x6955,     _('Chapter Process Codec ID'),           'uint'),
+    (0x450d,     _('Chapter Process Private'),            'binary'),
+    (0x6911,     _('Chapter Process Command'),            'master'),
+    (0x6922,     _('Chapter Process Time'),               'uint'),
+    (0x6933,     _('Chapter Process Data'),               'binary'),
+    (0x1254c367, _('Tags'),                               'master', '_read_tags'),
+    (0x7373,     _('Tag'),                                'master', '_read_tag'),
+    (0x63c0,     _('Targets'),                            'master', '_read_targets'),
+    (0x68ca,     _('Target Type Value'),                  'uint',   '_read_tag_target_type_value'),
+    (0x63ca,     _('Target Type'),                        'string', '_read_tag_target_type'),
+    (0x63c5,     _('Tag Track UID'),                      'uint',   '_read_tag_track_uid'),
+    (0x63c9,     _('Tag Edition UID'),                    'uint',   '_read_tag_edition_uid'),
+    (0x63c4,     _('Tag Chapter UID'),                    'uint',   '_read_tag_chapter_uid'),
+    (0x63c6,     _('Tag Attachment UID'),                 'uint',   '_read_tag_attachment_uid'),
+    (0x67c8,     _('Simple Tag'),                         'master', '_read_simple_tag'),
+    (0x45a3,     _('Tag Name'),                           'utf8',   '_read_tag_name'),
+    (0x447a,     _('Tag Language'),                       'string', '_read_tag_language'),
+    (0x4484,     _('Tag Default'),                        'uint',   '_read_tag_default'),
+    (0x4487,     _('Tag String'),                         'utf8',   '_read_tag_string'),
+    (0x4485,     _('Tag Binary'),                         'binary', '_read_tag_binary'),
+]
+
+UNLOGGED_IDS = set([0xa3])
+
 
 """
 Segment+
@@ -72,6 +293,20 @@ class EBMLContainer(MediaContainer):
     pass
 
 
+class EBMLCues(object):
+    """Cue points decoded into arrays with an entry for each Cue Track
+    Position, in the order they appear in the file."""
+    
+    def __init__(self):
+        self.times = array('Q')
+        """Cue time in segment ticks"""
+        
+        self.tracks = array('I')
+        
+        self.cluster_offsets = array('Q')
+        """File offset of the cluster containing the cued block"""
+
+
 
 class EBMLHandler(MediaHandler):    
     def __init__(self):
@@ -84,195 +319,12 @@ class EBMLHandler(MediaHandler):
         self._media_stream = None
         self._tag_target = None
         self._attachment = None
+        self._seek_id = None
+        self._segment_offset = 0
+        self._segment_read = set()
+        self._segment_elements = []
 
-        self._elements = {
-            b'\x1a\x45\xdf\xa3': Element(_('Header'), self._read_header),
-            b'\xec':             Element(_('Void')),
-            b'\xbf':             Element(_('CRC-32')),
-            b'\x42\x82':         Element(_('Doctype'), self._read_doctype),
-            b'\x42\x86':         Element(_('Version'), self._read_uint, key='version'),
-            b'\x42\xf7':         Element(_('Read Version'), self._read_uint, key='read_version'),
-            b'\x42\xf2':         Element(_('Max ID Length'), self._read_uint, key='max_id_len'),
-            b'\x42\xf3':         Element(_('Max Size Length'), self._read_uint, key='max_size_len'),
-            b'\x42\x87':         Element(_('Doctype Version'), self._read_uint, key='doctype_version'),
-            b'\x42\x85':         Element(_('Doctype Read Version'), self._read_uint, key='doctype_read_version'),
-            b'\x18\x53\x80\x67': Element(_('Segment'), self._read_segment),
-            b'\x2a\xd7\xb1':     Element(_('Timecode Scale'), self._read_uint, key='timecode_scale'),
-            b'\x4d\x80':         Element(_('Muxing Application'), self._read_utf8, key='app_mux'),
-            b'\x57\x41':         Element(_('Writing Application'), self._read_utf8, key='app_write'),
-            b'\x44\x89':         Element(_('Duration'), self._read_rational, key='duration'),
-            b'\x44\x61':         Element(_('Date UTC'), self._read_date, key='date_utc'),
-            b'\x73\xa4':         Element(_('Segment UID'), self._read_segment_uid),
-            b'\x11\x4d\x9b\x74': Element(_('Seek Head'), self._read_seek_head),
-            b'\x4d\xbb':         Element(_('Seek'), self._read_seek),
-            b'\x53\xab':         Element(_('Seek ID'), self._read_seek_id),
-            b'\x53\xac':         Element(_('Seek Position'), self._read_seek_pos),
-            b'\x15\x49\xa9\x66': Element(_('Info'), self._read_info),
-            b'\x1f\x43\xb6\x75': Element(_('Cluster'), self._read_cluster),
-            b'\xe7':             Element(_('Timecode')),
-            b'\x58\x54':         Element(_('Silent Tracks')),
-            b'\xa7':             Element(_('Position')),
-            b'\xab':             Element(_('Previous Size')),
-            b'\xa3':             Element(_('Simple Block'), log=False),
-            b'\xa0':             Element(_('Block Group')),
-            b'\xa1':             Element(_('Block')),
-            b'\xa2':             Element(_('Block Virtual')),
-            b'\x75\xa1':         Element(_('Block Additions')),
-            b'\xa6':             Element(_('Block More')),
-            b'\xee':             Element(_('Block Add ID')),
-            b'\xa5':             Element(_('Block Additional')),
-            b'\x9b':             Element(_('Block Duration')),
-            b'\xfa':             Element(_('Reference Priority')),
-            b'\xfb':             Element(_('Reference Block')),
-            b'\xfd':             Element(_('Reference Virtual')),
-            b'\xa4':             Element(_('Codec State')),
-            b'\x8e':             Element(_('Slices')),
-            b'\xe8':             Element(_('Time Slice')),
-            b'\xcc':             Element(_('Lace Number')),
-            b'\xcd':             Element(_('Frame Number')),
-            b'\xcb':             Element(_('Block Addition ID')),
-            b'\xce':             Element(_('Delay')),
-            b'\xcf':             Element(_('Slice Duration')),
-            b'\xc8':             Element(_('Reference Frame')),
-            b'\xc9':             Element(_('Reference Offset')),
-            b'\xca':             Element(_('Reference Timecode')),
-            b'\xaf':             Element(_('Encrypted Block')),
-            b'\x16\x54\xae\x6b': Element(_('Tracks'), self._read_tracks),
-            b'\xae':             Element(_('Track Entry'), self._read_track_entry),
-            b'\xd7':             Element(_('Track Number'), self._read_track_number),
-            b'\x73\xc5':         Element(_('Track UID'), self._read_track_uid),
-            b'\x83':             Element(_('Track Type'), self._read_track_type),
-            b'\xb9':             Element(_('Flag Enabled')),
-            b'\x88':             Element(_('Flag Default')),
-            b'\x55\xaa':         Element(_('Flag Forced')),
-            b'\x9c':             Element(_('Flag Lacing')),
-            b'\x6d\xe7':         Element(_('Min Cache')),
-            b'\x6d\xf8':         Element(_('Max Cache')),
-            b'\x23\xe3\x83':     Element(_('Default Duration')),
-            b'\x23\x31\x4f':     Element(_('Track Timecode Scale')),
-            b'\x55\xee':         Element(_('Max Block Addition ID')),
-            b'\x53\x6e':         Element(_('Track Name'), self._read_track_name),
-            b'\x22\xb5\x9c':     Element(_('Track Language'), self._read_track_language),
-            b'\x86':             Element(_('Codec ID'), self._read_track_codec_id),
-            b'\x63\xa2':         Element(_('Codec Private')),
-            b'\x25\x86\x88':     Element(_('Codec Name')),
-            b'\x74\x46':         Element(_('Attachment Link')),
-            b'\xaa':             Element(_('Codec Decode All')),
-            b'\x6f\xab':         Element(_('Track Overlay')),
-            b'\x66\x24':         Element(_('Track Translate')),
-            b'\x66\xfc':         Element(_('Track Translate Edition UID')),
-            b'\x66\xbf':         Element(_('Track Translate Codec')),
-            b'\x66\xa5':         Element(_('Track Translate Track ID')),
-            b'\xe0':             Element(_('Video'), self._read_video),
-            b'\x9a':             Element(_('Flag Interlace'), self._read_video_entry),
-            b'\x53\xb8':         Element(_('Stereo Mode')),
-            b'\xb0':             Element(_('Pixel Width'), self._read_video_entry),
-            b'\xba':             Element(_('Pixel Height'), self._read_video_entry),
-            b'\x54\xaa':         Element(_('Pixel Crop Bottom')),
-            b'\x54\xbb':         Element(_('Pixel Crop Top')),
-            b'\x54\xcc':         Element(_('Pixel Crop Left')),
-            b'\x54\xdd':         Element(_('Pixel Crop Right')),
-            b'\x54\xb0':         Element(_('Display Width')),
-            b'\x54\xba':         Element(_('Display Height')),
-            b'\x54\xb2':         Element(_('Display Unit')),
-            b'\x54\xb3':         Element(_('Aspect Ratio')),
-            b'\x2e\xb5\x25':     Element(_('Colour Space'), self._read_color_space),
-            b'\x2f\xb5\x23':     Element(_('Gamma')),
-            b'\x23\x83\xe3':     Element(_('Frame Rate')),
-            b'\xe1':             Element(_('Audio')),
-            b'\xb5':             Element(_('Sampling Frequency')),
-            b'\x78\xb5':         Element(_('Output Sampling Frequency')),
-            b'\x9f':             Element(_('Channels')),
-            b'\x7d\x7b':         Element(_('Channel Positions')),
-            b'\x62\x64':         Element(_('Bit Depth')),
-            b'\xe2':             Element(_('Track Operation')),
-            b'\xe3':             Element(_('Track Combine Planes')),
-            b'\xe4':             Element(_('Track Plane')),
-            b'\xe5':             Element(_('Track Plane UID')),
-            b'\xe6':             Element(_('Track Plane Type')),
-            b'\xe9':             Element(_('Track Join Blocks')),
-            b'\xed':             Element(_('Track Join UID')),
-            b'\x6d\x80':         Element(_('Content Encodings')),
-            b'\x62\x40':         Element(_('Content Encoding')),
-            b'\x50\x31':         Element(_('Content Encoding Order')),
-            b'\x50\x32':         Element(_('Content Encoding Scope')),
-            b'\x50\x33':         Element(_('Content Encoding Type')),
-            b'\x50\x34':         Element(_('Content Compression')),
-            b'\x42\x54':         Element(_('Content Compression Algorithm')),
-            b'\x42\x55':         Element(_('Content Compression Settings')),
-            b'\x50\x35':         Element(_('Content Encryption')),
-            b'\x47\xe1':         Element(_('Content Encryption Algorithm')),
-            b'\x47\xe2':         Element(_('Content Encryption Key ID')),
-            b'\x47\xe3':         Element(_('Content Signature')),
-            b'\x47\xe4':         Element(_('Content Signature Key ID')),
-            b'\x47\xe5':         Element(_('Content Signature Algorithm')),
-            b'\x47\xe6':         Element(_('Content Signature Hash Algorithm')),
-            b'\x1c\x53\xbb\x6b': Element(_('Cues'), self._read_cues),
-            b'\xbb':             Element(_('Cue Point')),
-            b'\xb3':             Element(_('Cue Time')),
-            b'\xb7':             Element(_('Cue Track Positions')),
-            b'\xf7':             Element(_('Cue Track')),
-            b'\xf1':             Element(_('Cue Cluster Position')),
-            b'\x53\x78':         Element(_('Cue Block Number')),
-            b'\xea':             Element(_('Cue Codec State')),
-            b'\xdb':             Element(_('Cue Reference')),
-            b'\x96':             Element(_('Cue Reference Time')),
-            b'\x97':             Element(_('Cue Reference Cluster')),
-            b'\x53\x5f':         Element(_('Cue Reference Number')),
-            b'\xeb':             Element(_('Cue Reference Codec State')),
-            b'\x19\x41\xa4\x69': Element(_('Attachments'), self._read_attachments),
-            b'\x61\xa7':         Element(_('Attached File'), self._read_attached_file),
-            b'\x46\x7e':         Element(_('File Description'), self._read_file_description),
-            b'\x46\x6e':         Element(_('File Name'), self._read_file_name),
-            b'\x46\x60':         Element(_('File Mime Type'), self._read_file_mimetype),
-            b'\x46\x5c':         Element(_('File Data'), self._read_file_data),
-            b'\x46\xae':         Element(_('File UID'), self._read_file_uid),
-            b'\x46\x75':         Element(_('File Referral')),
-            b'\x46\x61':         Element(_('File Used Start Time')),
-            b'\x46\x62':         Element(_('File Used End Time')),
-            b'\x10\x43\xa7\x70': Element(_('Chapters'), self._read_chapters),
-            b'\x45\xb9':         Element(_('Edition Entry')),
-            b'\x45\xbc':         Element(_('Edition UID')),
-            b'\x45\xbd':         Element(_('Edition Flag Hidden')),
-            b'\x45\xdb':         Element(_('Edition Flag Default')),
-            b'\x45\xdd':         Element(_('Edition Flag Ordered')),
-            b'\xb6':             Element(_('Chapter')),
-            b'\x73\xc4':         Element(_('Chapter UID')),
-            b'\x91':             Element(_('Chapter Time Start')),
-            b'\x92':             Element(_('Chapter Time End')),
-            b'\x98':             Element(_('Chapter Flag Hidden')),
-            b'\x45\x98':         Element(_('Chapter Flag Enabled')),
-            b'\x6e\x67':         Element(_('Chapter Segment UID')),
-            b'\x6e\xbc':         Element(_('Chapter Segment Edition UID')),
-            b'\x63\xc3':         Element(_('Chapter Physical Equivalent')),
-            b'\x8f':             Element(_('Chapter Track')),
-            b'\x89':             Element(_('Chapter Track Number')),
-            b'\x80':             Element(_('Chapter Display')),
-            b'\x85':             Element(_('Chapter String')),
-            b'\x43\x7c':         Element(_('Chapter Language')),
-            b'\x43\x7e':         Element(_('Chapter Country')),
-            b'\x69\x44':         Element(_('Chapter Process')),
-            b'\x69\x55':         Element(_('Chapter Process Codec ID')),
-            b'\x45\x0d':         Element(_('Chapter Process Private')),
-            b'\x69\x11':         Element(_('Chapter Process Command')),
-            b'\x69\x22':         Element(_('Chapter Process Time')),
-            b'\x69\x33':         Element(_('Chapter Process Data')),
-            b'\x12\x54\xc3\x67': Element(_('Tags'), self._read_tags),
-            b'\x73\x73':         Element(_('Tag'), self._read_tag),
-            b'\x63\xc0':         Element(_('Targets'), self._read_targets),
-            b'\x68\xca':         Element(_('Target Type Value'), self._read_tag_target_type_value),
-            b'\x63\xca':         Element(_('Target Type'), self._read_tag_target_type),
-            b'\x63\xc5':         Element(_('Tag Track UID'), self._read_tag_track_uid),
-            b'\x63\xc9':         Element(_('Tag Edition UID'), self._read_tag_edition_uid),
-            b'\x63\xc4':         Element(_('Tag Chapter UID'), self._read_tag_chapter_uid),
-            b'\x63\xc6':         Element(_('Tag Attachment UID'), self._read_tag_attachment_uid),
-            b'\x67\xc8':         Element(_('Simple Tag'), self._read_simple_tag),
-            b'\x45\xa3':         Element(_('Tag Name'), self._read_tag_name),
-            b'\x44\x7a':         Element(_('Tag Language'), self._read_tag_language),
-            b'\x44\x84':         Element(_('Tag Default'), self._read_tag_default),
-            b'\x44\x87':         Element(_('Tag String'), self._read_tag_string),
-            b'\x44\x85':         Element(_('Tag Binary'), self._read_tag_binary),
-        }
+        self._elements = ebml_compile_schema(EBML_SCHEMA, type(self))
         
         self.__attribute_accessors = {
             'doctype': ('header', '\x42\x82'),
@@ -335,7 +387,7 @@ class EBMLHandler(MediaHandler):
     
             if doctype is not None:
                 try:
-                    self.read_stream(ds)
+                    self.read_stream(ds, doctype)
                 except EOFError:
                     pass
             else:
@@ -354,44 +406,42 @@ class EBMLHandler(MediaHandler):
             raise MediaHandlerError("EBMLHandler: Unable to handle stream")
 
     def _read_element(self, parent, end=None):
-        element_id, element_id_len = ebml_read_id(self._ds)
+        start = self._ds.tell()
+        header = self._ds.read(12)
+        element_id, pos = ebml_decode_id(header)
             
         if end is not None and element_id in end:
-            self._ds.seek(-element_id_len, os.SEEK_CUR)
+            self._ds.seek(start, os.SEEK_SET)
             return -1
         
-        element_size, element_size_len = ebml_read_size(self._ds)
+        element_size, pos = ebml_decode_size(header, pos)
+        self._ds.seek(start + pos, os.SEEK_SET)
         
         if element_size != 0:
-            try:
-                info = self._elements[element_id]
-                
+            info = self._elements.get(element_id, None)
+            if info is not None:
                 reader = info.reader
                 key = info.key
                 log = info.log
                 if key is None:
                     key = element_id
-            except:
+            else:
                 reader = None
                 key = None
                 log = False
         
             if log:
-                id_str = ''.join([ "%02X " % x for x in element_id ]).strip()
-                try:
-                    self.logger.debug('EBML: ID = %s, Name = %s' % (id_str, self._elements[element_id].title))
-                except:
-                    self.logger.debug('EBML: Unknown ID = %s' % id_str)
+                self.logger.debug('EBML: ID = %X, Name = %s' % (element_id, info.title))
                 
             if reader is not None:
-                size_read = reader(parent, element_size, key)
+                size_read = reader(self, parent, element_size, key)
             else:
                 size_read = element_size
                 self._ds.seek(element_size, os.SEEK_CUR)
         else:
             size_read = 0
                 
-        return element_id_len + element_size_len + size_read
+        return pos + size_read
 
     def _read_header(self, parent, size, element_id):
         total_read = 0
@@ -401,28 +451,65 @@ class EBMLHandler(MediaHandler):
             
         return total_read
 
-    def _read_doctype(self, parent, size, element_id):
-        self.container.metadata['doctype'] = ebml_read_doctype(self._ds)
-        return size
-
     def _read_segment(self, parent, size, element_id):
         self._media_entry = MediaEntry()
         self._media_entry.container = self.container
         self._media_entry.tick_period = 1000000
         self.container.entries.append(self._media_entry)
+        
+        self._segment_offset = self._ds.tell()
+        self._segment_read = set()
+        self._segment_elements = []
+        self._media_entry.segment_offset = self._segment_offset
 
         total_read = 0
         if size == -1:                    
-            end = [b'\x18\x53\xB0\x67', b'\x1F\x43\xB6\x75', 
-                   b'\x11\x4d\x9b\x74', b'\x15\x49\xA9\x66',
-                   b'\x16\x54\xAE\x6B', b'\x1C\x53\xBB\x6B',
-                   b'\x19\x41\xA4\x69', b'\x10\x43\xA7\x70',
-                   b'\x12\x54\xC3\x67']
-
-            total_read = self._skip_junk(end)
+            total_read = self._skip_junk(LEVEL1_IDS)
+        
+        use_seek_head = True
+        try:
+            while size == -1 or total_read < size:
+                child_id = self._peek_id()
                 
-        while (total_read < size):
-            total_read += self._read_element('segment')
+                # Once the clusters start use the Seek Head to find the rest
+                # of the level 1 elements, reading the clusters only when
+                # there is no Seek Head or it is damaged.
+                if child_id == CLUSTER_ID and use_seek_head:
+                    start = self._ds.tell()
+                    if self._read_seek_targets():
+                        if size == -1:
+                            self._ds.seek(0, os.SEEK_END)
+                            total_read = self._ds.tell() - self._segment_offset
+                        else:
+                            self._ds.seek(self._segment_offset + size,
+                                          os.SEEK_SET)
+                            total_read = size
+                        break
+                    
+                    use_seek_head = False
+                    self._ds.seek(start, os.SEEK_SET)
+                
+                if child_id not in self._elements:
+                    total_read += self._skip_junk(LEVEL1_IDS)
+                    continue
+                
+                start = self._ds.tell()
+                
+                # Elements already read from the Seek Head's entries
+                read = [element for element in self._segment_elements
+                        if element[1] == start]
+                if len(read) > 0:
+                    self._ds.seek(start + read[0][2], os.SEEK_SET)
+                    total_read += read[0][2]
+                    continue
+                
+                size_read = self._read_element('segment')
+                self._segment_read.add(child_id)
+                self._segment_elements.append((child_id, start, size_read))
+                total_read += size_read
+        except EOFError:
+            if size != -1:
+                raise
 
         try:
             t = self._media_entry.metadata.pop('duration')
@@ -435,8 +522,80 @@ class EBMLHandler(MediaHandler):
             self._media_entry.tick_period = ts
         except KeyError:
             pass
+        
+        if self._media_entry.ticks == -1:
+            self._estimate_duration(size)
             
         return total_read
+    
+    def _estimate_duration(self, size):
+        """Find the duration of a segment which has no Duration element
+        from the end of its last Cluster"""
+        
+        pos = self._ds.tell()
+        self._ds.seek(0, os.SEEK_END)
+        end = self._ds.tell()
+        if size != -1:
+            end = min(end, self._segment_offset + size)
+        
+        ticks = ebml_tail_duration(self._ds, self._segment_offset, end)
+        if ticks is not None:
+            self.logger.debug('EBML: Duration estimated from the last Cluster')
+            self._media_entry.ticks = ticks
+        self._ds.seek(pos, os.SEEK_SET)
+    
+    def _read_seek_targets(self):
+        """Read the level 1 elements listed in the Seek Head which have not
+        already been read.
+        
+        Returns False if there are no Seek Head entries or an entry does
+        not point at the element expected.
+        """
+        
+        seek = self._media_entry.seek
+        if len(seek) == 0:
+            return False
+        
+        seek_names = dict([(name, seek_id)
+                           for seek_id, name in SEEK_IDS.items()])
+        visited = set()
+        found = True
+        while found:
+            found = False
+            for name, position in list(seek.items()):
+                seek_id = seek_names.get(name, None)
+                if seek_id is None or position in visited:
+                    continue
+                
+                # There may be more than one Seek Head
+                if seek_id == SEEK_HEAD_ID:
+                    offset = self._segment_offset + position
+                    if offset in [element[1] for element in self._segment_elements]:
+                        continue
+                elif seek_id in self._segment_read:
+                    continue
+                
+                visited.add(position)
+                self._ds.seek(self._segment_offset + position, os.SEEK_SET)
+                try:
+                    if self._peek_id() != seek_id:
+                        return False
+                except EOFError:
+                    return False
+                
+                start = self._ds.tell()
+                size_read = self._read_element('segment')
+                self._segment_read.add(seek_id)
+                self._segment_elements.append((seek_id, start, size_read))
+                found = True
+        
+        return True
+    
+    def _peek_id(self):
+        start = self._ds.tell()
+        element_id = ebml_decode_id(self._ds.read(9))[0]
+        self._ds.seek(start, os.SEEK_SET)
+        return element_id
         
     def _read_seek_head(self, parent, size, element_id):
         total_read = 0
@@ -447,6 +606,8 @@ class EBMLHandler(MediaHandler):
         return total_read
             
     def _read_seek(self, parent, size, element_id):
+        self._seek_id = None
+        
         total_read = 0
         while total_read < size:
             total_read += self._read_element('seek')
@@ -454,24 +615,15 @@ class EBMLHandler(MediaHandler):
         return total_read
 
     def _read_seek_id(self, parent, size, element_id):
-        seek_id = self._ds.read(size)
-        if seek_id == b'\x15\x49\xa9\x66':
-            self._seek_id = 'metadata'
-        elif seek_id == b'\x16\x54\xae\x6b':
-            self._seek_id = 'tracks'
-        elif seek_id == b'\x10\x43\xa7\x70':
-            self._seek_id = 'chapters'
-        elif seek_id == b'\x1c\x53\xbb\x6b':
-            self._seek_id = 'cues'
-        elif seek_id == b'\x19\x41\xa4\x69':
-            self._seek_id = 'attachments'
-        elif seek_id == b'\x12\x54\xc3\x67':
-            self._seek_id = 'metadata'
+        seek_id = int.from_bytes(ebml_read(self._ds, size), 'big')
+        self._seek_id = SEEK_IDS.get(seek_id, None)
             
         return size
 
     def _read_seek_pos(self, parent, size, element_id):
-        self._media_entry.seek[self._seek_id] = ebml_read_uint(self._ds, size)
+        position = ebml_read_uint(self._ds, size)
+        if self._seek_id is not None:
+            self._media_entry.seek.setdefault(self._seek_id, position)
         return size
 
     def _read_info(self, parent, size, element_id):
@@ -484,22 +636,24 @@ class EBMLHandler(MediaHandler):
 
     def _read_cluster(self, parent, size, element_id):
         total_read = 0
-        if size == -1:                    
-            end = [b'\x18\x53\xB0\x67', b'\x1F\x43\xB6\x75', 
-                   b'\x11\x4d\x9b\x74', b'\x15\x49\xA9\x66',
-                   b'\x16\x54\xAE\x6B', b'\x1C\x53\xBB\x6B',
-                   b'\x19\x41\xA4\x69', b'\x10\x43\xA7\x70',
-                   b'\x12\x54\xC3\x67']
-    
-            size_read = 0
-            while size_read != -1:
-                size_read = self._read_element('cluster', end)
-                if size_read != -1:
-                    total_read += size_read
-
-        else:                    
-            while total_read < size:
-                total_read += self._read_element('cluster')
+        if size == -1:
+            while True:
+                try:
+                    child_id = self._peek_id()
+                except EOFError:
+                    break
+                
+                if child_id in LEVEL1_IDS:
+                    break
+                elif child_id not in self._elements:
+                    total_read += self._skip_junk(LEVEL1_IDS)
+                else:
+                    total_read += self._read_element('cluster')
+
+        else:
+            # None of the children of a cluster are stored
+            self._ds.seek(size, os.SEEK_CUR)
+            total_read = size
             
         return total_read
 
@@ -558,9 +712,9 @@ class EBMLHandler(MediaHandler):
         return total_read
 
     def _read_video_entry(self, parent, size, element_id):
-        if element_id == b'\xb0':
+        if element_id == 0xb0:
             self._media_stream.stream_type_info.width = ebml_read_uint(self._ds, size)
-        elif element_id == b'\xba':
+        elif element_id == 0xba:
             self._media_stream.stream_type_info.height = ebml_read_uint(self._ds, size)
         else:
             _u = ebml_read_uint(self._ds, size)
@@ -579,12 +733,50 @@ class EBMLHandler(MediaHandler):
         self._media_stream.codec = self._ds.read(size)
         return size
 
+    def _read_track_codec_private(self, parent, size, element_id):
+        self._media_stream.codec_private = self._ds.read(size)
+        return size
+
+    def _read_track_default_duration(self, parent, size, element_id):
+        self._media_stream.default_duration = ebml_read_uint(self._ds, size)
+        return size
+
     def _read_track_name(self, parent, size, element_id):
         self._media_stream.name = self._ds.read(size).decode('UTF-8')
         return size
 
     def _read_cues(self, parent, size, element_id):
-        self._ds.seek(size, os.SEEK_CUR)
+        cues = EBMLCues()
+        self._media_entry.cues = cues
+        
+        data = ebml_read(self._ds, size)
+        for point_id, start, end in ebml_iter_elements(data):
+            if point_id != 0xbb:
+                continue
+            
+            time = 0
+            positions = []
+            for child_id, child_start, child_end in \
+                    ebml_iter_elements(data, start, end):
+                if child_id == 0xb3:
+                    time = int.from_bytes(data[child_start:child_end], 'big')
+                elif child_id == 0xb7:
+                    track = position = None
+                    for pos_id, pos_start, pos_end in \
+                            ebml_iter_elements(data, child_start, child_end):
+                        if pos_id == 0xf7:
+                            track = int.from_bytes(data[pos_start:pos_end], 'big')
+                        elif pos_id == 0xf1:
+                            position = int.from_bytes(data[pos_start:pos_end], 'big')
+                    
+                    if track is not None and position is not None:
+                        positions.append((track, position))
+            
+            for track, position in positions:
+                cues.times.append(time)
+                cues.tracks.append(track)
+                cues.cluster_offsets.append(self._segment_offset + position)
+            
         return size
 
     def _read_attachments(self, parent, size, element_id):
@@ -660,7 +852,7 @@ class EBMLHandler(MediaHandler):
         return size
 
     def _read_tag_target_type(self, parent, size, element_id):
-        self._tag_target.target_type = str(self._ds.read(size))
+        self._tag_target.target_type = ebml_decode_string(self._ds.read(size))
         return size
 
     def _read_tag_target_type_value(self, parent, size, element_id):
@@ -699,7 +891,7 @@ class EBMLHandler(MediaHandler):
         return size
     
     def _read_tag_name(self, parent, size, element_id):
-        self._tag.name = str(self._ds.read(size))
+        self._tag.name = ebml_read_utf8(self._ds, size)
         return size
 
     def _read_tag_string(self, parent, size, element_id):
@@ -707,7 +899,7 @@ class EBMLHandler(MediaHandler):
         return size
 
     def _read_tag_binary(self, parent, size, element_id):
-        self._tag.value = (ord(self._ds.read(1)) == 1)
+        self._tag.value = ebml_read(self._ds, size)
         return size
 
     def _read_tag_language(self, parent, size, element_id):
@@ -723,60 +915,312 @@ class EBMLHandler(MediaHandler):
         self._tag.default = (ord(self._ds.read(1)) == 1)
         return size
         
-    def _read_bytes(self, parent, size, element_id):
+    def _read_segment_uid(self, parent, size, element_id):
         data = self._ds.read(size)
-        if parent == 'header':
-            self.container.metadata[element_id] = data
-        elif parent == 'metadata':
-            self._media_entry.metadata[element_id] = data
-        return size
-
-    def _read_string(self, parent, size, element_id):
-        data = self._ds.read(size).decode('latin-1')
-        if parent == 'header':
-            self.container.metadata[element_id] = data
-        elif parent == 'metadata':
-            self._media_entry.metadata[element_id] = data
-        return size
-
-    def _read_uint(self, parent, size, element_id):
-        data = ebml_read_uint(self._ds, size)
-        if parent == 'header':
-            self.container.metadata[element_id] = data
-        elif parent == 'metadata':
-            self._media_entry.metadata[element_id] = data
-        return size
-
-    def _read_utf8(self, parent, size, element_id):
-        data = ebml_read_utf8(self._ds, size)
-        if parent == 'header':
-            self.container.metadata[element_id] = data
-        elif parent == 'metadata':
-            self._media_entry.metadata[element_id] = data
-        return size
-
-    def _read_rational(self, parent, size, element_id):
-        data = ebml_read_float(self._ds, size)
-        if parent == 'header':
-            self.container.metadata[element_id] = data
-        elif parent == 'metadata':
-            self._media_entry.metadata[element_id] = data
+        self._media_entry.uid = uuid.UUID(bytes=data)
         return size
     
-    def _read_date(self, parent, size, element_id):
-        data = ebml_read_int(self._ds, size)
-        delta = datetime.timedelta(microseconds=data/1000)
-        base = datetime.datetime(2001, 1, 1, 0, 0, 0)
+    def write_tags(self, filename, tag_groups=None):
+        """Write the Tags of the segment into an existing file.
+        
+        `tag_groups` is a list of TagGroup, by default the groups currently
+        held by the handler or, when it has not read a file, those read from
+        `filename`. See `write_segment_element` for how the Tags are placed.
+        """
+        
+        if tag_groups is None and self.container is not None:
+            tag_groups = self.container.entries[0].tag_groups
+        
+        with open(filename, 'r+b') as ds:
+            self.read_stream(ds)
+            if tag_groups is None:
+                tag_groups = self.container.entries[0].tag_groups
+            payload = b''.join([self._encode_tag_group(group)
+                                for group in tag_groups])
+            self.write_segment_element(ds, TAGS_ID, payload)
+
+    def write_attachments(self, filename, attachments=None):
+        """Write the Attachments of the segment into an existing file.
+        
+        `attachments` is a list of dictionaries with the same keys as those
+        created when reading, where 'data' is either the file's data or an
+        (offset, size) tuple in the existing file. By default the
+        attachments currently held by the handler are written or, when it
+        has not read a file, those read from `filename`.
+        """
+        
+        if attachments is None and self.container is not None:
+            attachments = self.container.entries[0].attachments
+        
+        with open(filename, 'r+b') as ds:
+            self.read_stream(ds)
+            if attachments is None:
+                attachments = self.container.entries[0].attachments
+            payload = b''.join([self._encode_attachment(ds, attachment)
+                                for attachment in attachments])
+            self.write_segment_element(ds, ATTACHMENTS_ID, payload)
+
+    def write_segment_element(self, ds, element_id, payload):
+        """Replace a level 1 element of the segment read from `ds`, which
+        must be open for reading and writing.
+        
+        The element is written over the existing one when it fits into the
+        space occupied by it plus any Void elements which follow it, with
+        a Void element filling any space left. A new element is written into
+        the first Void element large enough to hold it. Otherwise the
+        existing element is turned into a Void element, the new one appended
+        to the segment and the Seek Head updated to point at it.
+        """
+        
+        existing = None
+        for child_id, offset, size in self._segment_elements:
+            if child_id == element_id:
+                existing = (offset, size)
+                break
+        
+        if existing is not None:
+            offset, size = existing
+            space = size + self._void_space(ds, offset + size)
+            if self._write_in_place(ds, offset, space, element_id, payload):
+                return
+        else:
+            for idx, (child_id, offset, size) in \
+                    enumerate(self._segment_elements):
+                if child_id != VOID_ID:
+                    continue
+                
+                space = self._void_space(ds, offset)
+                if self._write_in_place(ds, offset, space, element_id,
+                                        payload):
+                    self._segment_elements[idx] = (element_id, offset, space)
+                    self._update_seek_head(ds, element_id,
+                                           offset - self._segment_offset)
+                    return
+        
+        data = ebml_element(element_id, payload)
+        self._check_append(ds, len(data))
+        if existing is not None:
+            ds.seek(existing[0], os.SEEK_SET)
+            ds.write(ebml_void(existing[1]))
+        
+        position = self._append(ds, data)
+        self._update_seek_head(ds, element_id, position)
+    
+    def _update_seek_head(self, ds, element_id, position):
+        seek_head = None
+        for child_id, offset, size in self._segment_elements:
+            if child_id == SEEK_HEAD_ID:
+                seek_head = (offset, size)
+                break
+        
+        if seek_head is None:
+            return
+        
+        offset, size = seek_head
+        ds.seek(offset, os.SEEK_SET)
+        data = ebml_read(ds, size)
+        _seek_head_id, data_start = ebml_decode_id(data)
+        _size, data_start = ebml_decode_size(data, data_start)
         
-        if parent == 'metadata':
-            self._media_entry.metadata[element_id] = base + delta
+        entries = []
+        for seek_id, start, end in ebml_iter_elements(data, data_start):
+            if seek_id != 0x4dbb:
+                continue
             
-        return size
+            entry = [None, None]
+            for child_id, child_start, child_end in \
+                    ebml_iter_elements(data, start, end):
+                if child_id == 0x53ab:
+                    entry[0] = ebml_decode_uint(data[child_start:child_end])
+                elif child_id == 0x53ac:
+                    entry[1] = ebml_decode_uint(data[child_start:child_end])
+            entries.append(entry)
+        
+        for entry in entries:
+            if entry[0] == element_id:
+                entry[1] = position
+                break
+        else:
+            entries.append([element_id, position])
+        
+        payload = self._encode_seek_head(entries)
+        space = size + self._void_space(ds, offset + size)
+        if self._write_in_place(ds, offset, space, SEEK_HEAD_ID, payload):
+            return
+        
+        # Move the Seek Head to the end of the segment and leave one which
+        # points to it in its place.
+        data = ebml_element(SEEK_HEAD_ID, payload)
+        self._check_append(ds, len(data))
+        position = self._append(ds, data)
+        payload = self._encode_seek_head([[SEEK_HEAD_ID, position]])
+        if not self._write_in_place(ds, offset, space, SEEK_HEAD_ID, payload):
+            raise MediaHandlerError('EBMLHandler: Unable to update the Seek Head')
     
-    def _read_segment_uid(self, parent, size, element_id):
-        data = self._ds.read(size)
-        self._media_entry.uid = uuid.UUID(bytes=data)
-        return size
+    def _encode_seek_head(self, entries):
+        return b''.join([ebml_element(0x4dbb,
+                                      ebml_element(0x53ab, ebml_encode_id(seek_id)) +
+                                      ebml_element(0x53ac, ebml_encode_uint(position)))
+                         for seek_id, position in entries
+                         if seek_id is not None and position is not None])
+    
+    def _write_in_place(self, ds, offset, space, element_id, payload):
+        data = ebml_element(element_id, payload)
+        remaining = space - len(data)
+        if remaining == 1:
+            # A Void element needs at least 2 bytes so use a longer size
+            size_length = len(data) - len(ebml_encode_id(element_id)) - len(payload)
+            if size_length < 8:
+                data = ebml_element(element_id, payload, size_length + 1)
+                remaining = 0
+        
+        if remaining < 0 or remaining == 1:
+            return False
+        
+        ds.seek(offset, os.SEEK_SET)
+        ds.write(data)
+        if remaining > 0:
+            ds.write(ebml_void(remaining))
+        return True
+    
+    def _void_space(self, ds, offset):
+        """The size of the Void elements starting at `offset`"""
+        
+        ds.seek(0, os.SEEK_END)
+        end = min(ds.tell(), self._segment_end(ds))
+        
+        space = 0
+        while offset + space < end:
+            ds.seek(offset + space, os.SEEK_SET)
+            header = ds.read(9)
+            try:
+                element_id, pos = ebml_decode_id(header)
+                size, pos = ebml_decode_size(header, pos)
+            except EOFError:
+                break
+            
+            if element_id != VOID_ID or size == -1 or \
+                    offset + space + pos + size > end:
+                break
+            space += pos + size
+        
+        return space
+    
+    def _segment_header(self, ds):
+        """(size offset, size length, size) of the Segment being edited"""
+        
+        offset = 0
+        ds.seek(0, os.SEEK_END)
+        stream_end = ds.tell()
+        while offset < stream_end:
+            ds.seek(offset, os.SEEK_SET)
+            header = ds.read(12)
+            element_id, pos = ebml_decode_id(header)
+            size, size_end = ebml_decode_size(header, pos)
+            if offset + size_end == self._segment_offset:
+                return (offset + pos, size_end - pos, size)
+            if size == -1:
+                break
+            offset += size_end + size
+        
+        raise MediaHandlerError('EBMLHandler: Segment not found')
+    
+    def _segment_end(self, ds):
+        _offset, _length, size = self._segment_header(ds)
+        if size == -1:
+            ds.seek(0, os.SEEK_END)
+            return ds.tell()
+        return self._segment_offset + size
+    
+    def _check_append(self, ds, length):
+        """Check `length` bytes can be appended to the segment"""
+        
+        ds.seek(0, os.SEEK_END)
+        stream_end = ds.tell()
+        if self._segment_end(ds) != stream_end:
+            raise MediaHandlerError('EBMLHandler: Unable to append to a '
+                                    'segment which does not end the file')
+        
+        _offset, length_size, size = self._segment_header(ds)
+        if size != -1 and size + length >= (1 << (7 * length_size)) - 1:
+            raise MediaHandlerError('EBMLHandler: Segment size too large')
+    
+    def _append(self, ds, data):
+        """Append `data` to the segment, returning its position relative
+        to the segment's data"""
+        
+        size_offset, length_size, size = self._segment_header(ds)
+        ds.seek(0, os.SEEK_END)
+        position = ds.tell() - self._segment_offset
+        ds.write(data)
+        
+        if size != -1:
+            ds.seek(size_offset, os.SEEK_SET)
+            ds.write(ebml_encode_size(size + len(data), length_size))
+        return position
+    
+    def _encode_tag_group(self, group):
+        payload = b''
+        for target in group.targets:
+            targets = b''
+            target_type_value = getattr(target, 'target_type_value', None)
+            if target_type_value is not None:
+                targets += ebml_element(0x68ca, ebml_encode_uint(target_type_value))
+            target_type = getattr(target, 'target_type', None)
+            if target_type:
+                targets += ebml_element(0x63ca, target_type.encode('latin-1'))
+            for uid_id, name in [(0x63c5, 'track_uid'),
+                                 (0x63c9, 'edition_uid'),
+                                 (0x63c4, 'chapter_uid'),
+                                 (0x63c6, 'attachment_uid')]:
+                uid = getattr(target, name, None)
+                if uid:
+                    targets += ebml_element(uid_id, ebml_encode_uint(uid))
+            payload += ebml_element(0x63c0, targets)
+        
+        if len(group.targets) == 0:
+            payload += ebml_element(0x63c0, b'')
+        
+        for tag in group.tags:
+            payload += self._encode_simple_tag(tag)
+        return ebml_element(0x7373, payload)
+    
+    def _encode_simple_tag(self, tag):
+        payload = ebml_element(0x45a3, tag.name.encode('UTF-8'))
+        
+        if tag.locale is not None:
+            language = getattr(tag.locale, 'language', 'und')
+            country = getattr(tag.locale, 'country', None)
+            if country and country.upper() != 'UND':
+                language = '%s-%s' % (language, country)
+            payload += ebml_element(0x447a, language.encode('latin-1'))
+        
+        payload += ebml_element(0x4484, ebml_encode_uint(1 if tag.default else 0))
+        
+        if isinstance(tag.value, bytes):
+            payload += ebml_element(0x4485, tag.value)
+        elif tag.value is not None:
+            payload += ebml_element(0x4487, str(tag.value).encode('UTF-8'))
+        
+        for subtag in tag.metadata:
+            payload += self._encode_simple_tag(subtag)
+        return ebml_element(0x67c8, payload)
+    
+    def _encode_attachment(self, ds, attachment):
+        data = attachment['data']
+        if isinstance(data, tuple):
+            offset, size = data
+            ds.seek(offset, os.SEEK_SET)
+            data = ebml_read(ds, size)
+        
+        payload = b''
+        if 'description' in attachment:
+            payload += ebml_element(0x467e, attachment['description'].encode('UTF-8'))
+        payload += ebml_element(0x466e, attachment['name'].encode('UTF-8'))
+        payload += ebml_element(0x4660, attachment['mimetype'].encode('ASCII'))
+        payload += ebml_element(0x465c, data)
+        payload += ebml_element(0x46ae, ebml_encode_uint(attachment['uid']))
+        return ebml_element(0x61a7, payload)
     
     def element_title(self, element_id):
         return self._elements[element_id][0]
@@ -803,19 +1247,15 @@ class EBMLHandler(MediaHandler):
                         yield group
                         
     def _skip_junk(self, end):
-        # Skip any junk at the start of the Cluster
-        total_read = 0
-        buf = b'\x00\x00\x00\x00'
-        while 1:
-            buf += self._ds.read(1)
-            buf = buf[1:]
-            total_read += 1
-            if buf in end:
-                total_read -= 4
-                self._ds.seek(-4, os.SEEK_CUR)
-                break
+        """Skip to the next element with an ID in `end`, returning the
+        number of bytes skipped"""
+        
+        start = self._ds.tell()
+        offset = ebml_resync(self._ds, end)
+        if offset is None:
+            raise EOFError()
             
-        return total_read
+        return offset - start
 
 def ebml_read(ds, size):
     data = ds.read(size)
@@ -849,11 +1289,368 @@ def ebml_read_size(ds):
         for x in range(length):
             val = val << 8
             val = val | rest[x]
+        
+        # All value bits set means the size is unknown
+        if val == (1 << (7 * (length + 1))) - 1:
+            val = -1
     else:
         val = start ^ 0x80
 
     return (val, length+1)
 
+def ebml_decode_id(data, pos=0):
+    """Decode the element ID at `pos` in `data` as an integer.
+    
+    Returns the ID and the position following it."""
+    
+    if pos >= len(data):
+        raise EOFError()
+    
+    length = DATA_SIZE[data[pos]] + 1
+    if pos + length > len(data):
+        raise EOFError()
+    return (int.from_bytes(data[pos:pos + length], 'big'), pos + length)
+
+def ebml_decode_size(data, pos=0):
+    """Decode the element size at `pos` in `data`, -1 for an unknown size.
+    
+    Returns the size and the position following it."""
+    
+    if pos >= len(data):
+        raise EOFError()
+    
+    length = DATA_SIZE[data[pos]] + 1
+    if length > 8 or pos + length > len(data):
+        raise EOFError()
+    
+    value = int.from_bytes(data[pos:pos + length], 'big') & \
+        ((1 << (7 * length)) - 1)
+    if value == (1 << (7 * length)) - 1:
+        value = -1
+    return (value, pos + length)
+
+def ebml_encode_id(element_id):
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+
+def ebml_encode_size(size, length=None):
+    """Encode an element size as a vint of `length` bytes, by default the
+    shortest length which can hold it"""
+    
+    if length is None:
+        length = 1
+        while size >= (1 << (7 * length)) - 1:
+            length += 1
+    
+    return ((1 << (7 * length)) | size).to_bytes(length, 'big')
+
+def ebml_encode_uint(value):
+    return value.to_bytes(max((value.bit_length() + 7) // 8, 1), 'big')
+
+def ebml_element(element_id, payload, size_length=None):
+    return ebml_encode_id(element_id) + \
+        ebml_encode_size(len(payload), size_length) + payload
+
+def ebml_void(size):
+    """A Void element occupying `size` bytes, which must be at least 2"""
+    
+    if size - 2 < 127:
+        return ebml_element(VOID_ID, b'\x00' * (size - 2), 1)
+    else:
+        return ebml_element(VOID_ID, b'\x00' * (size - 9), 8)
+
+def ebml_iter_elements(data, start=0, end=None):
+    """Generate (ID, data start, data end) for each element of known size
+    between `start` and `end` in `data`"""
+    
+    if end is None:
+        end = len(data)
+    
+    pos = start
+    while pos < end:
+        element_id, pos = ebml_decode_id(data, pos)
+        size, pos = ebml_decode_size(data, pos)
+        if size == -1 or pos + size > end:
+            break
+        yield (element_id, pos, pos + size)
+        pos += size
+
+def ebml_resync(ds, ids=LEVEL1_IDS, window=1048576):
+    """Find the next element from the current position in `ds` which has
+    one of the `ids` followed by a valid size.
+    
+    The stream is searched `window` bytes at a time. Returns the offset of
+    the element, with `ds` positioned at it, or None if no element is found.
+    """
+    
+    pos = ds.tell()
+    ds.seek(0, os.SEEK_END)
+    stream_end = ds.tell()
+    
+    ids = [ebml_encode_id(element_id) for element_id in ids]
+    
+    while pos < stream_end:
+        ds.seek(pos, os.SEEK_SET)
+        # Read enough past the window to decode the ID and size of an
+        # element starting within it
+        data = ds.read(window + 12)
+        limit = min(window, len(data))
+        
+        found = None
+        for element_id in ids:
+            idx = data.find(element_id, 0, limit + len(element_id) - 1)
+            while idx != -1 and (found is None or idx < found):
+                if _resync_valid(data, idx, len(element_id), pos,
+                                 stream_end):
+                    found = idx
+                    break
+                idx = data.find(element_id, idx + 1,
+                                limit + len(element_id) - 1)
+        
+        if found is not None:
+            ds.seek(pos + found, os.SEEK_SET)
+            return pos + found
+        
+        pos += limit
+    
+    ds.seek(stream_end, os.SEEK_SET)
+    return None
+
+def _resync_valid(data, idx, id_len, offset, stream_end):
+    """Whether the element ID found at `idx` in `data`, which was read from
+    `offset`, is followed by a size which fits in the stream"""
+    
+    try:
+        size, data_pos = ebml_decode_size(data, idx + id_len)
+    except (EOFError, IndexError):
+        return False
+    
+    return size == -1 or offset + data_pos + size <= stream_end
+
+def ebml_read_element_header(ds, pos):
+    """(ID, data offset, size) of the element at `pos` in `ds` or None at the
+    end of the stream"""
+    
+    ds.seek(pos, os.SEEK_SET)
+    data = ds.read(12)
+    try:
+        element_id, idx = ebml_decode_id(data)
+        size, idx = ebml_decode_size(data, idx)
+    except (EOFError, IndexError):
+        return None
+    
+    return (element_id, pos + idx, size)
+
+def ebml_cluster_timecode(ds, start, end):
+    """The Timecode of the Cluster with data between `start` and `end` and
+    the offset following it.
+    
+    CRC-32 and Void elements before the Timecode are skipped. Returns None
+    if the Cluster does not start with a Timecode.
+    """
+    
+    pos = start
+    while pos < end:
+        element = ebml_read_element_header(ds, pos)
+        if element is None:
+            return None
+        
+        element_id, data_start, size = element
+        if size == -1:
+            return None
+        if element_id in (CRC32_ID, VOID_ID):
+            pos = data_start + size
+            continue
+        
+        if element_id != 0xe7 or not 0 < size <= 8:
+            return None
+        ds.seek(data_start, os.SEEK_SET)
+        data = ds.read(size)
+        if len(data) != size:
+            return None
+        return (ebml_decode_uint(data), data_start + size)
+    
+    return None
+
+def ebml_tail_duration(ds, start, end, tail_size=4194304):
+    """Find the duration in ticks of the segment with data between `start`
+    and `end` in `ds` from the Timecode of its last Cluster and the
+    timecodes of the blocks within it.
+    
+    The segment is searched backwards from its end `tail_size` bytes at a
+    time. Returns None if the segment has no Clusters.
+    """
+    
+    cluster_id = ebml_encode_id(CLUSTER_ID)
+    window_end = end
+    while window_end > start:
+        pos = max(start, window_end - tail_size)
+        ds.seek(pos, os.SEEK_SET)
+        data = ds.read(window_end - pos)
+        
+        idx = data.rfind(cluster_id)
+        while idx != -1:
+            ticks = _cluster_end_ticks(ds, pos + idx + len(cluster_id), end)
+            if ticks is not None:
+                return ticks
+            idx = data.rfind(cluster_id, 0, idx)
+        
+        if pos == start:
+            break
+        # Overlap the windows so an ID across their boundary is found
+        window_end = pos + len(cluster_id) - 1
+    
+    return None
+
+def _cluster_end_ticks(ds, pos, stream_end):
+    """The end time of the Cluster whose size is at `pos` in `ds`, or None
+    if there is no valid Cluster with a Timecode at `pos`"""
+    
+    ds.seek(pos, os.SEEK_SET)
+    try:
+        size, data_pos = ebml_decode_size(ds.read(8))
+    except (EOFError, IndexError):
+        return None
+    
+    start = pos + data_pos
+    if size != -1 and start + size > stream_end:
+        return None
+    end = stream_end if size == -1 else start + size
+    
+    timecode = ebml_cluster_timecode(ds, start, end)
+    if timecode is None:
+        return None
+    timecode, pos = timecode
+    
+    last = 0
+    while pos < end:
+        element = ebml_read_element_header(ds, pos)
+        if element is None:
+            break
+        element_id, data_pos, size = element
+        if element_id in LEVEL1_IDS or size == -1:
+            break
+        
+        try:
+            if element_id == 0xa3:
+                ds.seek(data_pos, os.SEEK_SET)
+                last = max(last, _block_timecode(ds.read(min(size, 12)), 0))
+            elif element_id == 0xa0:
+                last = max(last, _block_group_end(ds, data_pos,
+                                                  min(data_pos + size, end)))
+        except EOFError:
+            # The last block is incomplete
+            break
+        pos = data_pos + size
+    
+    return timecode + last
+
+def _block_group_end(ds, start, end):
+    """The relative timecode of the end of the Block Group with data between
+    `start` and `end`, only the headers of its children are read"""
+    
+    block_time = None
+    duration = 0
+    pos = start
+    while pos < end:
+        element = ebml_read_element_header(ds, pos)
+        if element is None or element[2] == -1:
+            break
+        
+        element_id, data_pos, size = element
+        ds.seek(data_pos, os.SEEK_SET)
+        if element_id == 0xa1:
+            block_time = _block_timecode(ds.read(min(size, 12)), 0)
+        elif element_id == 0x9b:
+            duration = ebml_decode_uint(ds.read(size))
+        pos = data_pos + size
+    
+    if block_time is None:
+        return 0
+    return block_time + duration
+
+def _block_timecode(data, pos):
+    """The relative timecode of the block at `pos` in `data`"""
+    
+    _track, pos = ebml_decode_size(data, pos)
+    if pos + 2 > len(data):
+        raise EOFError()
+    return struct.unpack_from('>h', data, pos)[0]
+
+def ebml_decode_uint(data):
+    return int.from_bytes(data, 'big')
+
+def ebml_decode_int(data):
+    return int.from_bytes(data, 'big', signed=True)
+
+def ebml_decode_float(data):
+    if len(data) == 4:
+        return struct.unpack('>f', data)[0]
+    elif len(data) == 8:
+        return struct.unpack('>d', data)[0]
+    else:
+        return 0.0
+
+def ebml_decode_date(data):
+    delta = datetime.timedelta(microseconds=ebml_decode_int(data) / 1000)
+    return datetime.datetime(2001, 1, 1, 0, 0, 0) + delta
+
+def ebml_decode_string(data):
+    return data.rstrip(b'\x00').decode('latin-1')
+
+def ebml_decode_utf8(data):
+    return data.rstrip(b'\x00').decode('UTF-8')
+
+EBML_DECODERS = {
+    'uint': ebml_decode_uint,
+    'int': ebml_decode_int,
+    'float': ebml_decode_float,
+    'date': ebml_decode_date,
+    'string': ebml_decode_string,
+    'utf8': ebml_decode_utf8,
+    'binary': bytes,
+}
+
+_compiled_schemas = {}
+
+def ebml_compile_schema(schema, handler_class):
+    """Compile a schema into a dictionary of Element keyed by integer ID.
+    
+    Element readers are called as reader(handler, parent, size, key). The
+    result is cached for each handler class.
+    """
+    
+    elements = _compiled_schemas.get((id(schema), handler_class), None)
+    if elements is not None:
+        return elements
+    
+    elements = {}
+    for row in schema:
+        element_id, title, element_type = row[:3]
+        reader = row[3] if len(row) > 3 else None
+        key = row[4] if len(row) > 4 else None
+        
+        if reader in ('container', 'entry'):
+            reader = _value_reader(reader, EBML_DECODERS[element_type])
+        elif reader is not None:
+            reader = getattr(handler_class, reader)
+        
+        elements[element_id] = Element(title, reader, key=key,
+                                       log=element_id not in UNLOGGED_IDS)
+    
+    _compiled_schemas[(id(schema), handler_class)] = elements
+    return elements
+
+def _value_reader(target, decode):
+    if target == 'container':
+        def reader(handler, parent, size, key):
+            handler.container.metadata[key] = decode(ebml_read(handler._ds, size))
+            return size
+    else:
+        def reader(handler, parent, size, key):
+            handler._media_entry.metadata[key] = decode(ebml_read(handler._ds, size))
+            return size
+    return reader
+
 def ebml_read_utf8(fp, size):
     data = fp.read(size)
     return data.decode('UTF-8')
@@ -0,0 +1,132 @@
+# Copyright (c) 2015 Simon Kennedy <sffjunkie+code@gmail.com>
+
+"""Export the attachments of Matroska files.
+
+The data of each attachment is copied straight from the source file using
+the offset and size recorded by the EBMLHandler. Many files can be exported
+at once using a pool of processes.
+"""
+
+import os
+import logging
+from fnmatch import fnmatch
+from concurrent.futures import ProcessPoolExecutor
+
+from mogul.media import MediaHandlerError, copy_range
+from mogul.media.ebml import EBMLHandler
+
+__all__ = ['FONT_MIMETYPES', 'ebml_attachments', 'ebml_export_attachments',
+           'ebml_export_attachments_parallel']
+
+FONT_MIMETYPES = ['application/x-truetype-font', 'application/x-font-ttf',
+                  'application/x-font-otf', 'application/vnd.ms-opentype',
+                  'application/font-sfnt', 'application/font-woff',
+                  'font/*']
+
+
+def ebml_attachments(handler, mimetypes=None, names=None):
+    """The attachments of the file read by an EBMLHandler whose mimetype
+    matches one of the `mimetypes` and whose name matches one of the
+    `names`. Both are lists of shell style patterns and None matches
+    everything."""
+
+    attachments = []
+    for entry in handler.container.entries:
+        for attachment in entry.attachments:
+            if 'data' not in attachment:
+                continue
+            if mimetypes is not None and \
+                    not _matches(attachment.get('mimetype', ''), mimetypes):
+                continue
+            if names is not None and \
+                    not _matches(attachment.get('name', ''), names):
+                continue
+            attachments.append(attachment)
+    return attachments
+
+
+def ebml_export_attachments(filename, directory, mimetypes=None, names=None):
+    """Write the attachments of `filename` selected as for
+    `ebml_attachments` to files in `directory`.
+
+    Returns the names of the files written.
+    """
+
+    handler = EBMLHandler()
+    with open(filename, 'rb') as ds:
+        doctype = handler.can_handle(ds)
+        if doctype is None:
+            raise MediaHandlerError("EBML: Unable to handle file '%s'" %
+                                    filename)
+        try:
+            handler.read_stream(ds, doctype)
+        except EOFError:
+            pass
+
+        attachments = ebml_attachments(handler, mimetypes, names)
+        if len(attachments) > 0:
+            os.makedirs(directory, exist_ok=True)
+
+        written = []
+        for attachment in attachments:
+            output = os.path.join(directory, _filename(attachment, written))
+            offset, size = attachment['data']
+            with open(output, 'wb') as fp:
+                copy_range(ds, fp, offset, size)
+            written.append(output)
+
+    return written
+
+
+def ebml_export_attachments_parallel(filenames, directory, mimetypes=None,
+                                     names=None, workers=None):
+    """Export the attachments of each of `filenames` using a pool of
+    `workers` processes.
+
+    The attachments of each file are written to a sub directory of
+    `directory` named after the file's position in `filenames` and its
+    name. Returns a dictionary of the files written for each source file,
+    or of the exception raised for files which could not be exported.
+    """
+
+    filenames = list(filenames)
+    directories = [os.path.join(directory, '%d_%s' %
+                                (idx, os.path.splitext(
+                                    os.path.basename(filename))[0]))
+                   for idx, filename in enumerate(filenames)]
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(ebml_export_attachments, filename,
+                                   file_directory, mimetypes, names)
+                   for filename, file_directory in zip(filenames, directories)]
+
+        for filename, future in zip(filenames, futures):
+            try:
+                results[filename] = future.result()
+            except Exception as exc:
+                logging.getLogger('mogul.media').warning(
+                    'EBML: Unable to export attachments from %s: %s' %
+                    (filename, exc))
+                results[filename] = exc
+    return results
+
+
+def _matches(value, patterns):
+    value = value.lower()
+    for pattern in patterns:
+        if fnmatch(value, pattern.lower()):
+            return True
+    return False
+
+
+def _filename(attachment, written):
+    """A file name for the attachment which does not leave the output
+    directory or overwrite another attachment of the same file"""
+
+    name = os.path.basename(attachment.get('name', '').replace('\\', '/'))
+    if name in ('', '.', '..'):
+        name = 'attachment'
+    if name in [os.path.basename(path) for path in written]:
+        name = '%s_%s' % (attachment.get('uid', len(written)), name)
+    return name
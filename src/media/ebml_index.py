@@ -0,0 +1,534 @@
+# Copyright (c) 2015 Simon Kennedy <sffjunkie+code@gmail.com>
+
+"""Seek indexes and Cues for Matroska and WebM files.
+
+The index is built from the Cues read by an EBMLHandler or, for files
+without Cues, by scanning the clusters and recording the header of each
+block. Only the ID, size and first few bytes of each element are read, the
+frame data is skipped.
+
+Large files can be scanned in parallel, each process scanning the clusters
+of one byte range. Indexes can be saved to a sidecar file which is only used
+while the size and modification time of the source file are unchanged.
+Files without Cues can have them generated from a scan.
+"""
+
+import os
+import sys
+import struct
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from mogul.media import MediaHandlerError, VideoStreamInfo
+from mogul.media.ebml import (CLUSTER_ID, CUES_ID, LEVEL1_IDS,
+                              ebml_cluster_timecode, ebml_decode_size,
+                              ebml_element, ebml_encode_uint,
+                              ebml_read_element_header, ebml_resync)
+
+__all__ = ['EBMLBlocks', 'EBMLIndex', 'ebml_scan_blocks',
+           'ebml_scan_blocks_parallel', 'ebml_index', 'ebml_write_cues']
+
+INDEX_MAGIC = b'MGEI'
+INDEX_HEADER = struct.Struct('<4sHQqQQQ')
+INDEX_VERSION = 1
+
+
+class EBMLBlocks(object):
+    """The headers of the blocks in a file, one array entry per block"""
+
+    def __init__(self):
+        self.offsets = array('Q')
+        """File offset of the SimpleBlock or Block element"""
+
+        self.sizes = array('Q')
+        """Size of the block's data"""
+
+        self.cluster_offsets = array('Q')
+        self.tracks = array('I')
+
+        self.timecodes = array('q')
+        """Cluster timecode plus the block's relative timecode, in ticks"""
+
+        self.keyframes = array('B')
+        self.lacing = array('B')
+        """0 none, 1 Xiph, 2 fixed size, 3 EBML"""
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def extend(self, blocks):
+        for name in self._arrays():
+            getattr(self, name).extend(getattr(blocks, name))
+
+    def to_numpy(self):
+        """The arrays as a dictionary of NumPy arrays"""
+
+        if numpy is None:
+            raise MediaHandlerError('EBML: NumPy is not available')
+
+        return dict([(name, numpy.frombuffer(getattr(self, name),
+                                             dtype=getattr(self, name).typecode))
+                     for name in self._arrays()])
+
+    @staticmethod
+    def _arrays():
+        return ['offsets', 'sizes', 'cluster_offsets', 'tracks', 'timecodes',
+                'keyframes', 'lacing']
+
+
+class EBMLIndex(object):
+    """Cue points sorted by time with the offset of the cluster to seek to"""
+
+    def __init__(self, tick_period=1000000):
+        self.tick_period = tick_period
+        """Period of one tick in nanoseconds"""
+
+        self.times = array('Q')
+        self.tracks = array('I')
+        self.cluster_offsets = array('Q')
+
+        self.blocks = None
+        """EBMLBlocks when the index was built by scanning the clusters"""
+
+        self._track_times = {}
+
+    def __len__(self):
+        return len(self.times)
+
+    def add_cues(self, cues):
+        points = sorted(zip(cues.times, cues.tracks, cues.cluster_offsets))
+        self._set_points(points)
+
+    def add_blocks(self, blocks):
+        """Create cue points from the first keyframe of each track in each
+        cluster"""
+
+        self.blocks = blocks
+
+        points = []
+        seen = set()
+        for idx in range(len(blocks)):
+            if not blocks.keyframes[idx]:
+                continue
+
+            key = (blocks.cluster_offsets[idx], blocks.tracks[idx])
+            if key not in seen:
+                seen.add(key)
+                points.append((max(blocks.timecodes[idx], 0),
+                               blocks.tracks[idx], key[0]))
+        self._set_points(sorted(points))
+
+    def seek(self, seconds, track=None):
+        """The offset of the cluster to start reading from to find the
+        keyframe at or before `seconds`, for a single track or any track"""
+
+        if track not in self._track_times:
+            points = [(time, offset) for time, point_track, offset in
+                      zip(self.times, self.tracks, self.cluster_offsets)
+                      if track is None or point_track == track]
+            self._track_times[track] = ([point[0] for point in points],
+                                        [point[1] for point in points])
+
+        times, offsets = self._track_times[track]
+        if len(times) == 0:
+            raise MediaHandlerError('EBML: No cue points found')
+
+        ticks = int(seconds * 1000000000 / self.tick_period)
+        idx = max(bisect_right(times, ticks) - 1, 0)
+        return offsets[idx]
+
+    def save(self, filename, source_stat):
+        """Write the index to the sidecar `filename`.
+
+        `source_stat` is the `os.stat` result for the indexed file.
+        """
+
+        blocks = self.blocks
+        if blocks is None:
+            blocks = EBMLBlocks()
+
+        with open(filename, 'wb') as fp:
+            fp.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION,
+                                       source_stat.st_size,
+                                       _mtime(source_stat), self.tick_period,
+                                       len(self.times), len(blocks)))
+            for values in self._arrays(blocks):
+                _write_array(fp, values)
+
+    @staticmethod
+    def load(filename, source_stat):
+        """Read an index from a sidecar file, returns None if the file does
+        not exist or does not match `source_stat`"""
+
+        try:
+            fp = open(filename, 'rb')
+        except (IOError, OSError):
+            return None
+
+        with fp:
+            header = fp.read(INDEX_HEADER.size)
+            if len(header) != INDEX_HEADER.size:
+                return None
+
+            magic, version, size, mtime, tick_period, count, block_count = \
+                INDEX_HEADER.unpack(header)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION or \
+                    size != source_stat.st_size or \
+                    mtime != _mtime(source_stat):
+                return None
+
+            index = EBMLIndex(tick_period)
+            blocks = EBMLBlocks()
+            arrays = index._arrays(blocks)
+            try:
+                for values in arrays[:3]:
+                    _read_array(fp, values, count)
+                for values in arrays[3:]:
+                    _read_array(fp, values, block_count)
+            except EOFError:
+                return None
+
+            if block_count > 0:
+                index.blocks = blocks
+            return index
+
+    def _set_points(self, points):
+        self.times = array('Q', [point[0] for point in points])
+        self.tracks = array('I', [point[1] for point in points])
+        self.cluster_offsets = array('Q', [point[2] for point in points])
+        self._track_times = {}
+
+    def _arrays(self, blocks):
+        return [self.times, self.tracks, self.cluster_offsets] + \
+            [getattr(blocks, name) for name in blocks._arrays()]
+
+
+def ebml_scan_blocks(ds, start, end=None, blocks=None):
+    """Record the header of each block in the clusters of the level 1
+    elements from `start` up to `end`.
+
+    Returns an EBMLBlocks instance.
+    """
+
+    if blocks is None:
+        blocks = EBMLBlocks()
+
+    _scan_range(ds, start, end, blocks)
+    return blocks
+
+
+def ebml_scan_blocks_parallel(filename, start, end=None, workers=None,
+                              min_range_size=67108864):
+    """Scan the blocks of the file `filename` as `ebml_scan_blocks` does
+    using a pool of `workers` processes.
+
+    The file is split into byte ranges of at least `min_range_size` bytes
+    and each process scans from the first Cluster in its range. A range
+    whose Cluster is not where the scan of the ranges before it ended is
+    scanned again from that point, so the result is always the same as a
+    sequential scan.
+    """
+
+    if end is None:
+        end = os.path.getsize(filename)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    count = max(1, min(workers * 4, (end - start) // max(min_range_size, 1)))
+    bounds = [start + (end - start) * idx // count for idx in range(count)]
+    bounds.append(end)
+    ranges = [(filename, bounds[idx], bounds[idx + 1], idx == 0)
+              for idx in range(count)]
+
+    if workers == 1 or count == 1:
+        results = [_scan_range_worker(*args) for args in ranges]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_scan_range_worker,
+                                        *zip(*ranges)))
+
+    blocks = EBMLBlocks()
+    pos = start
+    with open(filename, 'rb') as ds:
+        for (_filename, range_start, range_end, _first), result in \
+                zip(ranges, results):
+            if pos >= range_end:
+                continue
+
+            cluster_offset, range_blocks, range_pos = result
+            if cluster_offset == pos:
+                blocks.extend(range_blocks)
+                pos = range_pos
+            else:
+                pos = _scan_range(ds, pos, range_end, blocks)
+
+            # The scan stopped before the end of the range at the end of
+            # the stream or an element which cannot be skipped
+            if pos < range_end:
+                break
+
+    return blocks
+
+
+def ebml_index(handler, ds, cache=None, workers=None):
+    """Build a seek index for the file read by an EBMLHandler.
+
+    The Cues are used when the file has them, otherwise the clusters are
+    scanned, in parallel when a number of `workers` is given. If `cache` is
+    the name of a sidecar file, a valid index in it is returned rather than
+    building the index and a newly built index is saved to it.
+    """
+
+    source_stat = None
+    if cache is not None:
+        source_stat = os.fstat(ds.fileno())
+        index = EBMLIndex.load(cache, source_stat)
+        if index is not None:
+            return index
+
+    entry = handler.container.entries[0]
+    tick_period = entry.tick_period if entry.tick_period > 0 else 1000000
+    index = EBMLIndex(tick_period)
+
+    cues = getattr(entry, 'cues', None)
+    if cues is not None and len(cues.times) > 0:
+        index.add_cues(cues)
+    else:
+        if workers is not None:
+            blocks = ebml_scan_blocks_parallel(ds.name, entry.segment_offset,
+                                               workers=workers)
+        else:
+            blocks = ebml_scan_blocks(ds, entry.segment_offset)
+        index.add_blocks(blocks)
+
+    if cache is not None:
+        index.save(cache, source_stat)
+    return index
+
+
+def ebml_write_cues(handler, filename, track=None):
+    """Scan the clusters of a file and write Cues for it.
+    
+    A cue point is created for each keyframe of the track numbered `track`
+    or, by default, of the video tracks. When there are no video tracks the
+    first block of each track in each cluster is used. The Cues and Seek
+    Head are written as described by `EBMLHandler.write_segment_element`.
+    
+    Returns the number of cue points written.
+    """
+    
+    with open(filename, 'r+b') as ds:
+        handler.read_stream(ds)
+        entry = handler.container.entries[0]
+        
+        if track is not None:
+            tracks = set([track])
+        else:
+            tracks = set([stream.number for stream in entry.streams
+                          if isinstance(getattr(stream, 'stream_type_info', None),
+                                        VideoStreamInfo)])
+        
+        blocks = ebml_scan_blocks(ds, entry.segment_offset)
+        points = []
+        seen = set()
+        for idx in range(len(blocks)):
+            block_track = blocks.tracks[idx]
+            if len(tracks) > 0:
+                if block_track not in tracks or not blocks.keyframes[idx]:
+                    continue
+            else:
+                key = (blocks.cluster_offsets[idx], block_track)
+                if key in seen:
+                    continue
+                seen.add(key)
+            
+            points.append((max(blocks.timecodes[idx], 0), block_track,
+                           blocks.cluster_offsets[idx] - entry.segment_offset))
+        
+        if len(points) == 0:
+            raise MediaHandlerError('EBML: No blocks found to create Cues from')
+        
+        payload = b''.join([_encode_cue_point(*point) for point in sorted(points)])
+        handler.write_segment_element(ds, CUES_ID, payload)
+        return len(points)
+
+
+def _encode_cue_point(time, track, position):
+    positions = ebml_element(0xf7, ebml_encode_uint(track)) + \
+        ebml_element(0xf1, ebml_encode_uint(position))
+    return ebml_element(0xbb, ebml_element(0xb3, ebml_encode_uint(time)) +
+                        ebml_element(0xb7, positions))
+
+
+def _scan_range(ds, start, end, blocks):
+    """Scan the level 1 elements from `start` until one starts at or after
+    `end`, returns the offset the scan stopped at"""
+
+    pos = start
+    while end is None or pos < end:
+        element = ebml_read_element_header(ds, pos)
+        if element is None:
+            break
+
+        element_id, data_start, size = element
+        if element_id == CLUSTER_ID:
+            pos = _scan_cluster(ds, pos, data_start, size, blocks)
+        elif size == -1:
+            break
+        else:
+            pos = data_start + size
+
+    return pos
+
+
+def _scan_range_worker(filename, start, end, first):
+    """Scan from the first Cluster at or after `start` in a process of the
+    pool.
+
+    Returns the offset of the Cluster, the blocks and the offset the scan
+    stopped at. The offset is None when no Cluster starts in the range.
+    """
+
+    blocks = EBMLBlocks()
+    with open(filename, 'rb') as ds:
+        if first:
+            cluster_offset = start
+        else:
+            cluster_offset = _find_cluster(ds, start, end)
+            if cluster_offset is None:
+                return (None, blocks, None)
+
+        pos = _scan_range(ds, cluster_offset, end, blocks)
+    return (cluster_offset, blocks, pos)
+
+
+def _find_cluster(ds, start, end):
+    """The offset of the first Cluster starting with a Timecode between
+    `start` and `end`, after any CRC-32 and Void elements"""
+
+    pos = start
+    while pos < end:
+        ds.seek(pos, os.SEEK_SET)
+        pos = ebml_resync(ds, [CLUSTER_ID])
+        if pos is None or pos >= end:
+            return None
+
+        element = ebml_read_element_header(ds, pos)
+        if element is not None:
+            _element_id, data_start, size = element
+            cluster_end = sys.maxsize if size == -1 else data_start + size
+            if ebml_cluster_timecode(ds, data_start, cluster_end) is not None:
+                return pos
+        pos += 1
+
+    return None
+
+
+def _scan_cluster(ds, cluster_offset, start, size, blocks):
+    """Record the blocks in a cluster, returns the offset following it"""
+
+    timecode = 0
+    end = None if size == -1 else start + size
+
+    pos = start
+    while end is None or pos < end:
+        element = ebml_read_element_header(ds, pos)
+        if element is None:
+            return ds.tell()
+
+        element_id, data_start, element_size = element
+        if end is None and element_id in LEVEL1_IDS:
+            return pos
+        if element_size == -1:
+            return data_start
+
+        if element_id == 0xe7:
+            ds.seek(data_start, os.SEEK_SET)
+            timecode = int.from_bytes(ds.read(element_size), 'big')
+        elif element_id == 0xa3:
+            ds.seek(data_start, os.SEEK_SET)
+            header = ds.read(min(element_size, 11))
+            _add_block(blocks, header, pos, element_size, cluster_offset,
+                       timecode, None)
+        elif element_id == 0xa0:
+            _scan_block_group(ds, data_start, data_start + element_size, pos,
+                              cluster_offset, timecode, blocks)
+
+        pos = data_start + element_size
+
+    return pos
+
+
+def _scan_block_group(ds, start, end, offset, cluster_offset, timecode,
+                      blocks):
+    """Record the block in the Block Group with data between `start` and
+    `end`, reading only the headers of its children and of the block"""
+
+    block = None
+    keyframe = True
+    pos = start
+    while pos < end:
+        element = ebml_read_element_header(ds, pos)
+        if element is None or element[2] == -1:
+            break
+
+        element_id, data_start, element_size = element
+        if element_id == 0xa1:
+            ds.seek(data_start, os.SEEK_SET)
+            block = (ds.read(min(element_size, 11)), element_size)
+        elif element_id == 0xfb:
+            keyframe = False
+        pos = data_start + element_size
+
+    if block is not None:
+        _add_block(blocks, block[0], offset, block[1], cluster_offset,
+                   timecode, keyframe)
+
+
+def _add_block(blocks, header, offset, size, cluster_offset, timecode,
+               keyframe):
+    try:
+        track, idx = ebml_decode_size(header)
+    except (EOFError, IndexError):
+        return
+    if idx + 3 > len(header):
+        return
+
+    relative, flags = struct.unpack_from('>hB', header, idx)
+    if keyframe is None:
+        keyframe = (flags & 0x80) != 0
+
+    blocks.offsets.append(offset)
+    blocks.sizes.append(size)
+    blocks.cluster_offsets.append(cluster_offset)
+    blocks.tracks.append(track)
+    blocks.timecodes.append(timecode + relative)
+    blocks.keyframes.append(1 if keyframe else 0)
+    blocks.lacing.append((flags >> 1) & 0x03)
+
+
+def _mtime(source_stat):
+    return int(source_stat.st_mtime * 1000000)
+
+
+def _write_array(fp, values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    fp.write(values.tobytes())
+
+
+def _read_array(fp, values, count):
+    data = fp.read(count * values.itemsize)
+    if len(data) != count * values.itemsize:
+        raise EOFError()
+
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
@@ -0,0 +1,244 @@
+# Copyright (c) 2015 Simon Kennedy <sffjunkie+code@gmail.com>
+
+"""Incremental parsing of EBML streams which are still being written.
+
+Data is pushed into an EBMLStreamParser as it arrives and an event is
+generated as each element starts, ends or has its value available. Only the
+bytes of the element currently being decoded are held, block payloads and
+large binary values are discarded as they arrive.
+"""
+
+import struct
+from collections import namedtuple
+
+from mogul.media import MediaHandlerError
+from mogul.media.ebml import (EBML_SCHEMA, EBML_DECODERS, LEVEL1_IDS,
+                              SEGMENT_ID, CLUSTER_ID, ebml_decode_id,
+                              ebml_decode_size)
+
+__all__ = ['EBMLEvent', 'EBMLStreamParser']
+
+EBMLEvent = namedtuple('EBMLEvent', "kind element_id offset size value")
+"""`kind` is 'start' or 'end' for master elements, 'value' for others. For
+blocks the value is a (track, relative timecode, flags) tuple."""
+
+HEADER_ID = 0x1a45dfa3
+TRACK_ENTRY_ID = 0xae
+BLOCK_IDS = set([0xa3, 0xa1])
+
+_ELEMENT_TYPES = dict([(row[0], row[2]) for row in EBML_SCHEMA])
+
+_TRACK_KEYS = {
+    0xd7: 'number',
+    0x73c5: 'uid',
+    0x83: 'type',
+    0x86: 'codec_id',
+    0x63a2: 'codec_private',
+    0x536e: 'name',
+    0x22b59c: 'language',
+    0x23e383: 'default_duration',
+    0xb0: 'pixel_width',
+    0xba: 'pixel_height',
+    0xb5: 'sampling_frequency',
+    0x9f: 'channels',
+}
+
+_INFO_KEYS = {
+    0x2ad7b1: 'timecode_scale',
+    0x4489: 'duration',
+    0x4d80: 'app_mux',
+    0x5741: 'app_write',
+    0x4461: 'date_utc',
+}
+
+
+class _Master(object):
+    def __init__(self, element_id, offset, end):
+        self.element_id = element_id
+        self.offset = offset
+        self.end = end
+        """Offset following the element or None for an unknown size"""
+
+
+class EBMLStreamParser(object):
+    """Parse EBML data pushed in with `feed`.
+
+    Values larger than `max_value_size` are not buffered, their event has
+    a value of None.
+    """
+
+    def __init__(self, max_value_size=16777216):
+        self.max_value_size = max_value_size
+
+        self.info = {}
+        self.tracks = []
+        """A dictionary of the values read for each Track Entry"""
+
+        self.segment_offset = None
+        self.cluster_timecode = 0
+
+        self.last_timecode = 0
+        """Largest block timecode seen, in segment ticks"""
+
+        self._buffer = bytearray()
+        self._offset = 0
+        self._skip = 0
+        self._stack = []
+        self._track = None
+
+    @property
+    def duration(self):
+        """The duration in seconds, from the Info element when present or
+        the blocks read so far"""
+
+        scale = self.info.get('timecode_scale', 1000000)
+        if 'duration' in self.info:
+            return self.info['duration'] * scale / 1000000000.0
+        return self.last_timecode * scale / 1000000000.0
+
+    @property
+    def offset(self):
+        """Stream offset of the next byte to be parsed"""
+
+        return self._offset + self._skip
+
+    def feed(self, data):
+        """Parse `data` and return the list of events generated"""
+
+        self._buffer += data
+        events = []
+        pos = 0
+        buffer = self._buffer
+
+        while True:
+            if self._skip > 0:
+                count = min(self._skip, len(buffer) - pos)
+                pos += count
+                self._skip -= count
+                if self._skip > 0:
+                    break
+
+            offset = self._offset + pos
+            self._end_masters(events, offset)
+
+            try:
+                element_id, data_pos = ebml_decode_id(buffer, pos)
+                size, data_pos = ebml_decode_size(buffer, data_pos)
+            except EOFError:
+                break
+
+            self._end_unknown_masters(events, element_id, offset)
+
+            header_size = data_pos - pos
+            element_type = _ELEMENT_TYPES.get(element_id, 'binary')
+            if element_type == 'master':
+                end = None if size == -1 else offset + header_size + size
+                self._start_master(events, element_id, offset, end)
+                pos = data_pos
+                continue
+
+            if size == -1:
+                raise MediaHandlerError('EBML: Unknown size for element %X' %
+                                        element_id)
+
+            if element_id in BLOCK_IDS:
+                header = bytes(buffer[data_pos:data_pos + min(size, 11)])
+                value = _block_header(header)
+                if value is None:
+                    if len(header) < min(size, 11):
+                        break
+                else:
+                    self._block(value)
+                self._skip = size
+            elif size > self.max_value_size:
+                value = None
+                self._skip = size
+            else:
+                if len(buffer) - data_pos < size:
+                    break
+                value = EBML_DECODERS[element_type](bytes(buffer[data_pos:data_pos + size]))
+                self._value(element_id, value)
+                self._skip = size
+
+            events.append(EBMLEvent('value', element_id, offset,
+                                    header_size + size, value))
+            pos = data_pos
+
+        del buffer[:pos]
+        self._offset += pos
+        return events
+
+    def close(self):
+        """End any elements of unknown size at the end of the stream"""
+
+        events = []
+        while len(self._stack) > 0:
+            self._end_master(events, self.offset)
+        return events
+
+    def _start_master(self, events, element_id, offset, end):
+        self._stack.append(_Master(element_id, offset, end))
+        if element_id == SEGMENT_ID:
+            self.segment_offset = offset
+        elif element_id == TRACK_ENTRY_ID:
+            self._track = {}
+            self.tracks.append(self._track)
+
+        size = None if end is None else end - offset
+        events.append(EBMLEvent('start', element_id, offset, size, None))
+
+    def _end_masters(self, events, offset):
+        while len(self._stack) > 0 and self._stack[-1].end is not None and \
+                offset >= self._stack[-1].end:
+            self._end_master(events, offset)
+
+    def _end_unknown_masters(self, events, element_id, offset):
+        """End Clusters and Segments of unknown size when an element which
+        cannot be their child starts"""
+
+        while len(self._stack) > 0:
+            master = self._stack[-1]
+            if master.end is not None:
+                break
+            if master.element_id == CLUSTER_ID and element_id in LEVEL1_IDS:
+                self._end_master(events, offset)
+            elif master.element_id == SEGMENT_ID and \
+                    element_id in (HEADER_ID, SEGMENT_ID):
+                self._end_master(events, offset)
+            else:
+                break
+
+    def _end_master(self, events, offset):
+        master = self._stack.pop()
+        if master.element_id == TRACK_ENTRY_ID:
+            self._track = None
+        events.append(EBMLEvent('end', master.element_id, master.offset,
+                                offset - master.offset, None))
+
+    def _value(self, element_id, value):
+        if element_id == 0xe7:
+            self.cluster_timecode = value
+            self.last_timecode = max(self.last_timecode, value)
+        elif self._track is not None and element_id in _TRACK_KEYS:
+            self._track[_TRACK_KEYS[element_id]] = value
+        elif element_id in _INFO_KEYS:
+            self.info[_INFO_KEYS[element_id]] = value
+
+    def _block(self, value):
+        timecode = self.cluster_timecode + value[1]
+        self.last_timecode = max(self.last_timecode, timecode)
+
+
+def _block_header(header):
+    """(track, relative timecode, flags) from the start of a block or None
+    if more data is needed"""
+
+    try:
+        track, pos = ebml_decode_size(header)
+    except EOFError:
+        return None
+    if pos + 3 > len(header):
+        return None
+
+    relative, flags = struct.unpack_from('>hB', header, pos)
+    return (track, relative, flags)
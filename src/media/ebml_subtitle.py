@@ -0,0 +1,284 @@
+# Copyright (c) 2015 Simon Kennedy <sffjunkie+code@gmail.com>
+
+"""Extract text subtitle tracks from Matroska and WebM files.
+
+The clusters holding the track's blocks are found from the Cues when they
+have entries for the track, otherwise every cluster is visited. The block
+headers of each cluster are scanned as for the block index and only the
+data of the track's blocks is read.
+"""
+
+import os
+import re
+import struct
+
+from mogul.media import MediaHandlerError
+from mogul.media.ebml import (CLUSTER_ID, ebml_decode_size,
+                              ebml_read_element_header)
+from mogul.media.ebml_index import EBMLBlocks, _scan_cluster
+
+__all__ = ['ebml_extract_subtitles']
+
+TEXT_CODECS = ['S_TEXT/UTF8', 'S_TEXT/ASCII', 'S_TEXT/WEBVTT', 'D_WEBVTT/SUBTITLES']
+ASS_CODECS = ['S_TEXT/ASS', 'S_TEXT/SSA', 'S_ASS', 'S_SSA']
+
+ASS_EVENTS = '[Events]\nFormat: Layer, Start, End, Style, Name, MarginL, ' \
+    'MarginR, MarginV, Effect, Text\n'
+
+_ASS_OVERRIDE = re.compile(r'\{[^}]*\}')
+
+
+def ebml_extract_subtitles(handler, ds, output, track=None,
+                           subtitle_format=None):
+    """Write a text subtitle track of the file read by an EBMLHandler from
+    `ds` to the text stream `output`.
+
+    `track` is the track number, by default the first text subtitle track.
+    ASS and SSA tracks are written as ASS and other tracks as SRT unless
+    `subtitle_format` is 'srt' or 'ass'.
+
+    Returns the number of subtitles written.
+    """
+
+    entry = handler.container.entries[0]
+    stream = _subtitle_stream(entry, track)
+    codec = _codec(stream)
+
+    if subtitle_format is None:
+        subtitle_format = 'ass' if codec in ASS_CODECS else 'srt'
+    if subtitle_format == 'ass':
+        writer = _ASSWriter(output, stream, codec in ASS_CODECS)
+    elif subtitle_format == 'srt':
+        writer = _SRTWriter(output, codec in ASS_CODECS)
+    else:
+        raise MediaHandlerError('EBML: Unknown subtitle format %s' %
+                                subtitle_format)
+
+    tick_period = entry.tick_period if entry.tick_period > 0 else 1000000
+    default_duration = getattr(stream, 'default_duration', None)
+    if default_duration is not None:
+        default_duration = default_duration // tick_period
+
+    pending = None
+    for timecode, duration, data in \
+            _track_blocks(ds, entry, stream.number):
+        if pending is not None:
+            writer.write(pending[0], timecode, pending[1], tick_period)
+            pending = None
+
+        if duration is None:
+            duration = default_duration
+        if duration is None:
+            # Ends when the next subtitle starts
+            pending = (timecode, data)
+        else:
+            writer.write(timecode, timecode + duration, data, tick_period)
+
+    if pending is not None:
+        writer.write(pending[0], pending[0], pending[1], tick_period)
+
+    return writer.count
+
+
+class _SRTWriter(object):
+    def __init__(self, output, from_ass):
+        self.output = output
+        self.from_ass = from_ass
+        self.count = 0
+
+    def write(self, start, end, data, tick_period):
+        text = data.decode('utf-8', 'replace')
+        if self.from_ass:
+            text = text.split(',', 8)[-1]
+            text = _ASS_OVERRIDE.sub('', text)
+            text = text.replace('\\N', '\n').replace('\\n', '\n')
+
+        self.count += 1
+        self.output.write('%d\n%s --> %s\n%s\n\n' %
+                          (self.count, _srt_time(start, tick_period),
+                           _srt_time(end, tick_period),
+                           text.replace('\r\n', '\n').strip('\n')))
+
+
+class _ASSWriter(object):
+    def __init__(self, output, stream, from_ass):
+        self.output = output
+        self.from_ass = from_ass
+        self.count = 0
+
+        header = getattr(stream, 'codec_private', None)
+        if from_ass and header:
+            header = header.decode('utf-8', 'replace').replace('\r\n', '\n')
+        else:
+            header = '[Script Info]\nScriptType: v4.00+\n\n'
+        output.write(header)
+        if '[Events]' not in header:
+            if not header.endswith('\n\n'):
+                output.write('\n')
+            output.write(ASS_EVENTS)
+
+    def write(self, start, end, data, tick_period):
+        text = data.decode('utf-8', 'replace')
+        if self.from_ass:
+            # ReadOrder, Layer, Style, Name, MarginL, MarginR, MarginV,
+            # Effect, Text
+            fields = text.split(',', 8)
+            layer = fields[1] if len(fields) > 1 else '0'
+            rest = ','.join(fields[2:])
+        else:
+            layer = '0'
+            rest = 'Default,,0,0,0,,' + \
+                text.replace('\r\n', '\n').strip('\n').replace('\n', '\\N')
+
+        self.count += 1
+        self.output.write('Dialogue: %s,%s,%s,%s\n' %
+                          (layer, _ass_time(start, tick_period),
+                           _ass_time(end, tick_period), rest))
+
+
+def _subtitle_stream(entry, track):
+    for stream in entry.streams:
+        number = getattr(stream, 'number', None)
+        if track is not None:
+            if number == track:
+                codec = _codec(stream)
+                if codec not in TEXT_CODECS and codec not in ASS_CODECS:
+                    raise MediaHandlerError('EBML: Track %d is not a text '
+                                            'subtitle track' % track)
+                return stream
+        elif _codec(stream) in TEXT_CODECS + ASS_CODECS:
+            return stream
+
+    if track is not None:
+        raise MediaHandlerError('EBML: Track %d not found' % track)
+    raise MediaHandlerError('EBML: No text subtitle track found')
+
+
+def _codec(stream):
+    codec = getattr(stream, 'codec', None)
+    if isinstance(codec, bytes):
+        codec = codec.decode('ascii', 'replace')
+    return codec
+
+
+def _track_blocks(ds, entry, number):
+    """Generate (timecode, duration, data) for each block of the track
+    numbered `number`, the duration is None when the block has none"""
+
+    cues = getattr(entry, 'cues', None)
+    offsets = []
+    if cues is not None:
+        offsets = sorted(set([offset for offset, cue_track in
+                              zip(cues.cluster_offsets, cues.tracks)
+                              if cue_track == number]))
+
+    if len(offsets) > 0:
+        for offset in offsets:
+            element = ebml_read_element_header(ds, offset)
+            if element is not None and element[0] == CLUSTER_ID:
+                yield from _cluster_blocks(ds, offset, element[1], element[2],
+                                           number)
+        return
+
+    pos = entry.segment_offset
+    while True:
+        element = ebml_read_element_header(ds, pos)
+        if element is None:
+            break
+
+        element_id, data_start, size = element
+        if element_id == CLUSTER_ID:
+            pos = yield from _cluster_blocks(ds, pos, data_start, size,
+                                             number)
+        elif size == -1:
+            break
+        else:
+            pos = data_start + size
+
+
+def _cluster_blocks(ds, cluster_offset, start, size, number):
+    """Generate the blocks of track `number` in the cluster at
+    `cluster_offset` with data at `start`, returns the offset following the
+    cluster"""
+
+    blocks = EBMLBlocks()
+    end = _scan_cluster(ds, cluster_offset, start, size, blocks)
+
+    for offset, track, timecode in zip(blocks.offsets, blocks.tracks,
+                                       blocks.timecodes):
+        if track != number:
+            continue
+
+        element = ebml_read_element_header(ds, offset)
+        if element is None:
+            continue
+
+        element_id, data_start, element_size = element
+        if element_id == 0xa3:
+            block = _block(ds, data_start, element_size, number)
+            if block is not None:
+                yield (timecode, None, block[1])
+        elif element_id == 0xa0:
+            block = _block_group(ds, data_start, element_size, number)
+            if block is not None:
+                yield (timecode, block[1], block[2])
+
+    return end
+
+
+def _block_group(ds, start, size, number):
+    """(relative timecode, duration, data) of a Block Group for track
+    `number`"""
+
+    block = None
+    duration = None
+
+    pos = start
+    while pos < start + size:
+        element = ebml_read_element_header(ds, pos)
+        if element is None or element[2] == -1:
+            break
+
+        element_id, data_start, element_size = element
+        if element_id == 0xa1:
+            block = _block(ds, data_start, element_size, number)
+            if block is None:
+                return None
+        elif element_id == 0x9b:
+            ds.seek(data_start, os.SEEK_SET)
+            duration = int.from_bytes(ds.read(element_size), 'big')
+        pos = data_start + element_size
+
+    if block is None:
+        return None
+    return (block[0], duration, block[1])
+
+
+def _block(ds, start, size, number):
+    """(relative timecode, data) of a block for track `number`, only the
+    track number is read for the blocks of other tracks"""
+
+    ds.seek(start, os.SEEK_SET)
+    header = ds.read(min(size, 11))
+    try:
+        track, idx = ebml_decode_size(header)
+    except (EOFError, IndexError):
+        return None
+    if track != number or idx + 3 > len(header):
+        return None
+
+    relative = struct.unpack_from('>h', header, idx)[0]
+    data = header[idx + 3:] + ds.read(size - len(header))
+    return (relative, data)
+
+
+def _srt_time(ticks, tick_period):
+    ms = ticks * tick_period // 1000000
+    return '%02d:%02d:%02d,%03d' % (ms // 3600000, ms // 60000 % 60,
+                                    ms // 1000 % 60, ms % 1000)
+
+
+def _ass_time(ticks, tick_period):
+    cs = ticks * tick_period // 10000000
+    return '%d:%02d:%02d.%02d' % (cs // 360000, cs // 6000 % 60,
+                                  cs // 100 % 60, cs % 100)
@@ -1,5 +1,9 @@
 # Copyright (c) 2009-2014 Simon Kennedy <sffjunkie+code@gmail.com>
 
+import os
+import struct
+from collections import namedtuple
+
 from mogul.media import localize
 _ = localize()
 
@@ -10,6 +14,16 @@ class ExifError(Exception):
     pass
 
 
+ExifThumbnail = namedtuple('ExifThumbnail', "offset size")
+"""Offset in the stream and size of the JPEG thumbnail in EXIF data"""
+
+EXIF_HEADER = b'Exif\x00\x00'
+
+# JPEGInterchangeFormat and JPEGInterchangeFormatLength
+THUMBNAIL_OFFSET_TAG = 513
+THUMBNAIL_LENGTH_TAG = 514
+
+
 class ExifHandler(MediaHandler):
     def __init__(self, log_indent_level=0):
         super(ExifHandler, self).__init__(log_indent_level)
@@ -37,4 +51,119 @@ class ExifHandler(MediaHandler):
         flash = entry.metadata.get(37385, None)
         if flash is not None:
             self.metadata['exif']['Flash']['Fired'] = False
-            
\ No newline at end of file
+            
+
+
+def exif_thumbnail(ds, lazy=False):
+    """The JPEG thumbnail stored in the EXIF data of the JPEG stream `ds`.
+    
+    Only the headers of the JPEG segments before the EXIF data, the size
+    and next IFD pointer of IFD0 and the entries of IFD1 are read. Returns
+    the thumbnail's data, an ExifThumbnail if `lazy` is True or None when
+    there is no thumbnail.
+    """
+    
+    if ds.read(2) != b'\xFF\xD8':
+        raise ExifError('EXIF: Not a JPEG stream')
+    
+    segment = _exif_segment(ds)
+    if segment is None:
+        return None
+    base, end = segment
+    
+    ds.seek(base, os.SEEK_SET)
+    header = ds.read(8)
+    if len(header) < 8:
+        raise ExifError('EXIF: TIFF header is truncated')
+    if header[:2] == b'\x49\x49':
+        endian = '<'
+    elif header[:2] == b'\x4d\x4d':
+        endian = '>'
+    else:
+        raise ExifError('EXIF: Unknown BOM %s' % header[:2])
+    
+    magic, ifd_offset = struct.unpack('%sHL' % endian, header[2:8])
+    if magic != 42:
+        raise ExifError('EXIF: Unknown TIFF version number %d' % magic)
+    
+    # Step over the entries of IFD0 to the offset of IFD1
+    count = _read_uint(ds, base + ifd_offset, end, '%sH' % endian)
+    if count is None:
+        return None
+    ifd_offset = _read_uint(ds, base + ifd_offset + 2 + count * 12, end,
+                            '%sL' % endian)
+    if not ifd_offset:
+        return None
+    
+    count = _read_uint(ds, base + ifd_offset, end, '%sH' % endian)
+    if count is None:
+        return None
+    table = ds.read(min(count * 12, end - ds.tell()))
+    
+    values = {}
+    for idx in range(0, len(table) - 11, 12):
+        tag, field_type, value_count, value = \
+            struct.unpack_from('%sHHL4s' % endian, table, idx)
+        if tag in (THUMBNAIL_OFFSET_TAG, THUMBNAIL_LENGTH_TAG) and \
+                value_count == 1 and field_type in (3, 4):
+            values[tag] = struct.unpack_from('%s%s' % (endian,
+                'H' if field_type == 3 else 'L'), value)[0]
+    
+    if THUMBNAIL_OFFSET_TAG not in values or \
+            THUMBNAIL_LENGTH_TAG not in values:
+        return None
+    
+    thumbnail = ExifThumbnail(base + values[THUMBNAIL_OFFSET_TAG],
+                              values[THUMBNAIL_LENGTH_TAG])
+    if thumbnail.size == 0 or thumbnail.offset + thumbnail.size > end:
+        return None
+    
+    if lazy:
+        return thumbnail
+    
+    ds.seek(thumbnail.offset, os.SEEK_SET)
+    data = ds.read(thumbnail.size)
+    if len(data) != thumbnail.size:
+        return None
+    return data
+
+
+def _read_uint(ds, pos, end, fmt):
+    """The unsigned integer at `pos`, or None if it does not end before
+    `end` or the stream is truncated"""
+    
+    size = struct.calcsize(fmt)
+    if pos + size > end:
+        return None
+    
+    ds.seek(pos, os.SEEK_SET)
+    data = ds.read(size)
+    if len(data) != size:
+        return None
+    return struct.unpack(fmt, data)[0]
+
+
+def _exif_segment(ds):
+    """The offset of the TIFF header in the EXIF APP1 segment and the
+    offset of the end of the segment, or None if there is no EXIF data"""
+    
+    while True:
+        marker = ds.read(4)
+        while marker[1:2] == b'\xFF':
+            marker = marker[1:] + ds.read(1)
+        if len(marker) < 4 or marker[:1] != b'\xFF':
+            return None
+        
+        box_id = ord(marker[1:2])
+        if box_id == 0xD9 or box_id == 0xDA:
+            return None
+        
+        size = struct.unpack('>H', marker[2:4])[0]
+        if size < 2:
+            raise ExifError('EXIF: JPEG segment size must be at least 2')
+        
+        start = ds.tell()
+        if box_id == 0xE1 and size >= 2 + len(EXIF_HEADER) + 8 and \
+                ds.read(len(EXIF_HEADER)) == EXIF_HEADER:
+            return (start + len(EXIF_HEADER), start + size - 2)
+        ds.seek(start + size - 2, os.SEEK_SET)
@@ -1,18 +1,23 @@
 # Copyright (c) 2009-2014 Simon Kennedy <sffjunkie+code@gmail.com>
 
-__all__ = ['MP4Handler']
+__all__ = ['MP4Handler', 'MP4SampleTable']
 
 import os
+import sys
 import uuid
 import struct
 import datetime
 import logging
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
 
 from mogul.media import localize
 _ = localize()
 
 from mogul.media.id3_info import ID3_GENRE
 from mogul.media.image import Image
+from mogul.media.attachment import Attachment
 from mogul.media import MediaContainer, MediaEntry, MediaStream, \
         AudioStreamInfo, VideoStreamInfo, Tag, TagTarget, TagGroup, \
         MediaHandlerError
@@ -26,6 +31,32 @@ class MP4Warning(UserWarning):
 class MP4Exception(Exception):
     pass
 
+
+MP4Box = namedtuple('MP4Box', "path offset size header_size")
+"""Location of a box within a stream. `path` is a tuple of the box types
+from the root down to and including this box."""
+
+FREE_BOX_TYPES = (b'free', b'skip')
+
+ITUNES_HDLR = struct.pack('>L4sLL4s4s8xx', 33, b'hdlr', 0, 0, b'mdir', b'appl')
+
+# Integer atoms which iTunes expects to have a fixed width
+ITUNES_INT_FORMATS = {
+    b'tmpo': '>H',
+    b'cpil': '>B',
+    b'pgap': '>B',
+    b'pcst': '>B',
+    b'hdvd': '>B',
+    b'rtng': '>B',
+    b'stik': '>B',
+    b'akID': '>B',
+    b'cnID': '>L',
+    b'atID': '>L',
+    b'geID': '>L',
+    b'sfID': '>L',
+    b'plID': '>Q',
+}
+
 """
 moov
     mvhd - Global Header
@@ -68,6 +99,105 @@ mdat
 """
 
 
+class MP4SampleTable(object):
+    """The decoded sample table ('stbl') of a track.
+    
+    Sample and chunk indexes are 0 based, other than `sync_samples` which
+    holds the 1 based sample numbers from the 'stss' box."""
+    
+    def __init__(self):
+        self.time_to_sample = []
+        self.composition_offsets = []
+        self.sample_to_chunk = []
+        self.sync_samples = None
+        self.sample_size = 0
+        self.sample_sizes = None
+        self.sample_count = 0
+        self.chunk_offsets = array('Q')
+
+    def sizes(self):
+        """The size of each sample"""
+        
+        if self.sample_sizes is not None:
+            return self.sample_sizes
+        else:
+            return array('I', [self.sample_size]) * self.sample_count
+    
+    def times(self):
+        """The decode time of each sample plus the end time of the last"""
+        
+        times = array('Q')
+        t = 0
+        for count, delta in self.time_to_sample:
+            times.extend(range(t, t + count * delta, delta) if delta else [t] * count)
+            t += count * delta
+        times.append(t)
+        return times
+    
+    def duration(self):
+        return sum([count * delta for count, delta in self.time_to_sample])
+    
+    def chunks(self):
+        """Generate (chunk index, offset, first sample, sample count) for
+        each chunk from the sample to chunk runs"""
+        
+        runs = self.sample_to_chunk
+        chunk_count = len(self.chunk_offsets)
+        sample = 0
+        for idx, (first_chunk, samples_per_chunk, _desc) in enumerate(runs):
+            if idx + 1 < len(runs):
+                last_chunk = runs[idx + 1][0] - 1
+            else:
+                last_chunk = chunk_count
+
+            for chunk in range(first_chunk - 1, min(last_chunk, chunk_count)):
+                count = min(samples_per_chunk, self.sample_count - sample)
+                if count <= 0:
+                    return
+                yield (chunk, self.chunk_offsets[chunk], sample, count)
+                sample += count
+
+    def offsets(self):
+        """The file offset of each sample"""
+        
+        sizes = self.sizes()
+        offsets = array('Q', [0]) * self.sample_count
+        for _chunk, offset, first, count in self.chunks():
+            for idx in range(first, first + count):
+                offsets[idx] = offset
+                offset += sizes[idx]
+        return offsets
+    
+    def composition_offsets_per_sample(self):
+        """The composition time offset of each sample or None if the track
+        has no composition offsets"""
+        
+        if len(self.composition_offsets) == 0:
+            return None
+        
+        offsets = array('q')
+        for count, offset in self.composition_offsets:
+            offsets.extend([offset] * count)
+        return offsets
+
+    def is_sync(self, sample):
+        """Whether the 0 based `sample` is a sync sample"""
+        
+        if self.sync_samples is None:
+            return True
+        
+        idx = bisect_left(self.sync_samples, sample + 1)
+        return idx < len(self.sync_samples) and self.sync_samples[idx] == sample + 1
+
+    def sync_sample_indexes(self):
+        """The 0 based index of each sync sample"""
+        
+        if self.sync_samples is None:
+            return range(self.sample_count)
+        else:
+            return [sample - 1 for sample in self.sync_samples]
+
+
 class MP4Handler(object):
     def __init__(self):
         self.container = MediaContainer()
@@ -79,13 +209,17 @@ class MP4Handler(object):
         self._tag_target = None
         self._languages = None
         self._countries = None
+        self._box_path = []
+        self.boxes = []
         self.logger = logging.getLogger('mogul.media')
 
         self._elements = {
             b'clip': Element(_('Clipping')),
             b'cmov': Element(_('Compressed Movie')),
+            b'co64': Element(_('64 Bit Chunk Offset'), self._read_co64),
             b'crgn': Element(_('Clipping Region')),
             b'cslg': Element(_('Composition Shift Least Greatest')),
+            b'ctts': Element(_('Composition Offset'), self._read_ctts),
             b'ctab': Element(_('Colour Table'), self._read_ctab),
             b'ctry': Element(_('Country'), self._read_ctry),
             b'dinf': Element(_('Data Information'), self._read_dinf),
@@ -116,13 +250,13 @@ class MP4Handler(object):
             b'skip': Element(_('Skip')),
             b'smhd': Element(_('Sound Media Information Header'), self._read_smhd),
             b'stbl': Element(_('Sample Table'), self._read_stbl),
-            b'stco': Element(_('Chunk Offset')),
+            b'stco': Element(_('Chunk Offset'), self._read_stco),
             b'stps': Element(_('Partial Sync Sample')),
-            b'stsc': Element(_('Sample-to-Chunk')),
+            b'stsc': Element(_('Sample-to-Chunk'), self._read_stsc),
             b'stsd': Element(_('Sample Description'), self._read_stsd),
-            b'stss': Element(_('Sync Sample')),
-            b'stsz': Element(_('Sample Size')),
-            b'stts': Element(_('Time To Sample')),
+            b'stss': Element(_('Sync Sample'), self._read_stss),
+            b'stsz': Element(_('Sample Size'), self._read_stsz),
+            b'stts': Element(_('Time To Sample'), self._read_stts),
             b'stsh': Element(_('Shadow Sync')),
             b'tkhd': Element(_('Track Header'), self._read_tkhd),
             b'trak': Element(_('Track'), self._read_trak),
@@ -140,12 +274,12 @@ class MP4Handler(object):
             'doctype': lambda: b'mp4',
             'title': b'\xA9nam',
             'artist': b'\xA9ART',
-            'album_artist': b'\aART',
+            'album_artist': b'aART',
             'album': b'\xA9alb',
             'track': b'trkn',
             'release_date': b'\xA9day',
             'writer': b'\xA9wrt',
-            'comment': b'',
+            'comment': b'\xA9cmt',
             'genre': self._get_id3_genre,
             'compilation': b'cpil',
             'gapless': b'pgap',
@@ -166,7 +300,7 @@ class MP4Handler(object):
                               b'mp4v', b'dvc ', b'dvcp', b'gif ', b'h263',
                               b'tiff', b'raw ', b'2vuY', b'yuv2', b'v308',
                               b'v408', b'v216', b'v410', b'v210',
-                              b'avc1']
+                              b'avc1', b'avc3', b'hvc1', b'hev1']
 
         self.__metadata_formats = [b'mp4s']
         
@@ -217,6 +351,8 @@ class MP4Handler(object):
 
         if doctype is not None:
             self._ds = ds
+            self._box_path = []
+            self.boxes = []
 
             size_read = 0
             try:
@@ -229,31 +365,245 @@ class MP4Handler(object):
         else:
             raise MediaHandlerError("MP4Handler: Unable to handle stream")
 
+    def write_tags(self, filename, tags, padding=2048):
+        """Write iTunes metadata into an existing file.
+
+        `tags` maps either an attribute name (e.g. 'title', 'artist') or an
+        item atom name (e.g. b'\xA9nam') to a value. Items which are not
+        mentioned are kept and a value of None removes an item.
+
+        The new Item List is written over the old one when it fits into the
+        space occupied by the old list plus any `free` or `skip` boxes which
+        directly follow it, so only the boxes which change are written.
+        Otherwise the Movie box is grown by the size difference plus
+        `padding` bytes of free space for later edits, any data following
+        it is moved and the chunk offset tables are updated.
+        """
+        
+        with open(filename, 'r+b') as ds:
+            self.filename = filename
+            self.container = MediaContainer()
+            self.read_stream(ds)
+            
+            ds.seek(0, os.SEEK_END)
+            file_size = ds.tell()
+
+            moov = self.find_box((b'moov',))
+            if moov is None:
+                raise MP4Exception("MP4Handler: No 'moov' box found in '%s'" % filename)
+
+            chain = [moov]
+            for path in [(b'moov', b'udta'), (b'moov', b'udta', b'meta')]:
+                box = self.find_box(path)
+                if box is None:
+                    break
+                chain.append(box)
+            
+            ilst = None
+            if len(chain) == 3:
+                ilst = self.find_box((b'moov', b'udta', b'meta', b'ilst'))
+
+            items = self._read_ilst_items(ds, ilst)
+            self._merge_ilst_items(items, tags)
+            data = mp4_box(b'ilst', b''.join([item for _name, item in items]))
+
+            if ilst is not None:
+                start = ilst.offset
+                old_end = ilst.offset + ilst.size
+            else:
+                start = old_end = chain[-1].offset + chain[-1].size
+                if len(chain) < 3:
+                    data = mp4_box(b'meta', b'\x00' * 4 + ITUNES_HDLR + data)
+                if len(chain) < 2:
+                    data = mp4_box(b'udta', data)
+
+            end = self._free_space_end(old_end)
+            remainder = (end - start) - len(data)
+            if remainder == 0 or remainder >= 8:
+                self.logger.debug('MP4:  Writing ilst in place at offset %d' % start)
+                ds.seek(start, os.SEEK_SET)
+                ds.write(data)
+                if remainder > 0:
+                    ds.write(struct.pack('>L4s', remainder, b'free'))
+                
+                for box in chain:
+                    box_end = box.offset + box.size
+                    if box_end >= old_end and box_end <= end:
+                        self._write_box_size(ds, box,
+                                             start + len(data) - box.offset)
+            else:
+                padding = max(padding, 8)
+                data += struct.pack('>L4s', padding, b'free') + \
+                    b'\x00' * (padding - 8)
+                self._grow_moov(ds, file_size, chain, start, old_end, data)
+
+    def _read_ilst_items(self, ds, ilst):
+        """Read the raw item atoms from an Item List as a list of
+        (name, data) tuples"""
+        
+        items = []
+        if ilst is not None:
+            ds.seek(ilst.offset + ilst.header_size, os.SEEK_SET)
+            data = ds.read(ilst.size - ilst.header_size)
+            
+            pos = 0
+            while pos + 8 <= len(data):
+                size, name = struct.unpack('>L4s', data[pos:pos + 8])
+                if size < 8:
+                    break
+                items.append((name, data[pos:pos + size]))
+                pos += size
+            
+        return items
+
+    def _merge_ilst_items(self, items, tags):
+        for name, value in tags.items():
+            atom = self._tag_atom(name)
+            
+            if value is None:
+                item = None
+            else:
+                if not isinstance(value, (list, tuple)) or atom in [b'trkn', b'disk']:
+                    value = [value]
+
+                item = b''
+                for v in value:
+                    dtype, data = self._encode_meta_data(atom, v)
+                    item += mp4_box(b'data', struct.pack('>LL', dtype, 0) + data)
+                item = mp4_box(atom, item)
+                
+            for idx, (item_name, _data) in enumerate(items):
+                if item_name == atom:
+                    if item is None:
+                        del items[idx]
+                    else:
+                        items[idx] = (atom, item)
+                    break
+            else:
+                if item is not None:
+                    items.append((atom, item))
+
+    def _tag_atom(self, name):
+        """Map an attribute name onto an item atom name"""
+        
+        if isinstance(name, bytes):
+            return name
+
+        if name == 'genre':
+            return b'\xA9gen'
+
+        accessor = self.__attribute_accessors.get(name, None)
+        if accessor is None or callable(accessor):
+            raise MP4Exception("MP4Handler: Unable to write attribute '%s'" % name)
+        
+        return accessor
+    
+    def _free_space_end(self, offset):
+        """Find the end of any run of free space boxes starting at `offset`"""
+        
+        while True:
+            candidates = [box for box in self.boxes if box.offset == offset]
+            if len(candidates) == 0:
+                break
+            
+            box = min(candidates, key=lambda b: len(b.path))
+            if box.path[-1] not in FREE_BOX_TYPES:
+                break
+            
+            offset += box.size
+            
+        return offset
+
+    def _write_box_size(self, ds, box, size, buf=None, base=0):
+        """Update the size field of a box either in the stream or, when `buf`
+        is provided, in a buffer holding the stream from offset `base`"""
+        
+        if box.header_size - (16 if isinstance(box.path[-1], uuid.UUID) else 0) == 16:
+            pos, data = box.offset + 8, struct.pack('>Q', size)
+        elif size <= 0xFFFFFFFF:
+            pos, data = box.offset, struct.pack('>L', size)
+        else:
+            raise MP4Exception("MP4Handler: Box '%s' too large for a 32 bit size" % box.path[-1])
+
+        if buf is None:
+            ds.seek(pos, os.SEEK_SET)
+            ds.write(data)
+        else:
+            buf[pos - base:pos - base + len(data)] = data
+    
+    def _grow_moov(self, ds, file_size, chain, start, old_end, data):
+        """Replace the region between `start` and `old_end` within the Movie
+        box with `data`, moving anything which follows the Movie box."""
+        
+        moov = chain[0]
+        moov_end = moov.offset + moov.size
+        delta = len(data) - (old_end - start)
+        self.logger.debug('MP4:  Growing moov by %d bytes' % delta)
+        
+        ds.seek(moov.offset, os.SEEK_SET)
+        buf = bytearray(ds.read(moov.size))
+        buf[start - moov.offset:old_end - moov.offset] = data
+        
+        for box in chain:
+            self._write_box_size(ds, box, box.size + delta, buf, moov.offset)
+
+        for box in self.boxes:
+            if box.path[0] != b'moov' or box.path[-1] not in (b'stco', b'co64'):
+                continue
+            
+            pos = box.offset - moov.offset + box.header_size
+            if box.offset >= old_end:
+                pos += delta
+
+            if box.path[-1] == b'stco':
+                fmt = 'L'
+            else:
+                fmt = 'Q'
+                
+            count = struct.unpack('>L', bytes(buf[pos + 4:pos + 8]))[0]
+            fmt = '>%d%s' % (count, fmt)
+            pos += 8
+            size = struct.calcsize(fmt)
+
+            offsets = list(struct.unpack(fmt, bytes(buf[pos:pos + size])))
+            for idx, offset in enumerate(offsets):
+                if offset >= moov_end:
+                    offsets[idx] = offset + delta
+            
+            try:
+                buf[pos:pos + size] = struct.pack(fmt, *offsets)
+            except struct.error:
+                raise MP4Exception("MP4Handler: Chunk offsets no longer fit in 'stco' box")
+
+        if moov_end < file_size:
+            mp4_move(ds, moov_end, file_size - moov_end, moov_end + delta)
+
+        ds.seek(moov.offset, os.SEEK_SET)
+        ds.write(buf)
+
     def _read_box(self, parent):
-        size_left = element_size = self._read_long()
+        offset = self._ds.tell()
+        element_size = self._read_long()
         if element_size == 0:
             return 4
         
-        if element_size == 1:
-            element_size = self._read_quad()
-        
         element_type = self._ds.read(4)
         size_read = 8
-        size_left -= 8
 
-        if size_left == 1:
+        if element_size == 1:
             element_size = self._read_quad()
             size_read += 8
-            element_size -= 8
 
         if element_type == b'uuid':
             data = self._ds.read(16)
             element_type = uuid.UUID(bytes=data)
             size_read += 16
-            size_left -= 16
 
-        offset = self._ds.tell() - size_read
+        size_left = element_size - size_read
+
         self.logger.debug('MP4:  Reading box %s at offset %d, size %d' % (element_type, offset, element_size))
+        self.boxes.append(MP4Box(tuple(self._box_path) + (element_type,),
+                                 offset, element_size, size_read))
 
         if element_size > 0:
             try:
@@ -264,14 +614,29 @@ class MP4Handler(object):
                 handler = None
     
             if handler is not None:
-                handler(parent, size_left)
+                self._box_path.append(element_type)
+                try:
+                    handler(parent, size_left)
+                finally:
+                    self._box_path.pop()
             else:
                 self._ds.seek(size_left, os.SEEK_CUR)
 
             size_read += size_left
 
         return size_read
+
+    def find_box(self, path):
+        """Return the first box found at `path`, a tuple of box types, or
+        None if there isn't one"""
         
+        path = tuple(path)
+        for box in self.boxes:
+            if box.path == path:
+                return box
+            
+        return None
+
     def _read_ftyp(self, parent, element_size):
         """File Type"""
         
@@ -463,6 +828,7 @@ class MP4Handler(object):
                 _unknown = self._ds.read(element_size-size_read)
                 
             if parent == 'mdia' or (parent == 'minf' and self._stream is None):
+                self._stream.handler_type = component_subtype
                 if component_subtype == b'vide':
                     self._stream.media_type_info = VideoStreamInfo()
                 elif component_subtype == b'soun':
@@ -547,6 +913,8 @@ class MP4Handler(object):
     def _read_stbl(self, parent, element_size):
         """Sample Table"""
         
+        self._stream.sample_table = MP4SampleTable()
+        
         size_read = 0
         while size_read < element_size:
             size_read += self._read_box('stbl')
@@ -632,6 +1000,8 @@ class MP4Handler(object):
                         self._read_esds(data_length - 8)
                     elif data_format == b'avcC':
                         self._read_avcC(data_length - 8)
+                    elif data_format == b'hvcC':
+                        self._read_hvcC(data_length - 8)
                     else:
                         self._ds.seek(data_length-8, os.SEEK_CUR)
                         
@@ -687,26 +1057,77 @@ class MP4Handler(object):
     def _read_stsz(self, parent, element_size):
         """Sample Size"""
         
-        _version = ord(self._ds.read(1))
-        _flags = mp4_read_uint(self._ds, 3)
+        data = self._ds.read(element_size)
+        table = self._stream.sample_table
 
-        sample_size, count = struct.unpack('>LL', self._ds.read(8))
-        if sample_size == 0 and count > 0:
-            _data = self._ds.read(count*4)
-        else:
-            pass
+        table.sample_size, table.sample_count = struct.unpack('>4xLL', data[:12])
+        if table.sample_size == 0:
+            table.sample_sizes = mp4_unpack_array('I', data[12:12 + 4 * table.sample_count])
 
         return element_size
 
     def _read_stts(self, parent, element_size):
         """Time to Sample"""
         
-        _version = ord(self._ds.read(1))
-        _flags = mp4_read_uint(self._ds, 3)
+        data = self._ds.read(element_size)
+        count = struct.unpack('>4xL', data[:8])[0]
+        self._stream.sample_table.time_to_sample = \
+            list(struct.iter_unpack('>LL', data[8:8 + 8 * count]))
+        
+        return element_size
 
-        count = struct.unpack('>L', self._ds.read(4))[0]
-        for _x in range(count):
-            _sample_count, _sample_duration = struct.unpack('>LL', self._ds.read(8))
+    def _read_ctts(self, parent, element_size):
+        """Composition Offset"""
+        
+        data = self._ds.read(element_size)
+        version, count = struct.unpack('>B3xL', data[:8])
+        if version == 0:
+            fmt = '>LL'
+        else:
+            fmt = '>Ll'
+
+        self._stream.sample_table.composition_offsets = \
+            list(struct.iter_unpack(fmt, data[8:8 + 8 * count]))
+        
+        return element_size
+
+    def _read_stss(self, parent, element_size):
+        """Sync Sample"""
+        
+        data = self._ds.read(element_size)
+        count = struct.unpack('>4xL', data[:8])[0]
+        self._stream.sample_table.sync_samples = \
+            mp4_unpack_array('I', data[8:8 + 4 * count])
+        
+        return element_size
+
+    def _read_stsc(self, parent, element_size):
+        """Sample to Chunk"""
+        
+        data = self._ds.read(element_size)
+        count = struct.unpack('>4xL', data[:8])[0]
+        self._stream.sample_table.sample_to_chunk = \
+            list(struct.iter_unpack('>LLL', data[8:8 + 12 * count]))
+        
+        return element_size
+
+    def _read_stco(self, parent, element_size):
+        """Chunk Offset"""
+        
+        data = self._ds.read(element_size)
+        count = struct.unpack('>4xL', data[:8])[0]
+        self._stream.sample_table.chunk_offsets = \
+            array('Q', mp4_unpack_array('I', data[8:8 + 4 * count]))
+        
+        return element_size
+
+    def _read_co64(self, parent, element_size):
+        """64 Bit Chunk Offset"""
+        
+        data = self._ds.read(element_size)
+        count = struct.unpack('>4xL', data[:8])[0]
+        self._stream.sample_table.chunk_offsets = \
+            mp4_unpack_array('Q', data[8:8 + 8 * count])
         
         return element_size
 
@@ -735,17 +1156,18 @@ class MP4Handler(object):
                         length, byte_count = self._read_descriptor_length()
                         size_read += (1 + byte_count)
     
-                        _object_type, _stream_type, _buffer_size, \
+                        object_type, _stream_type, _buffer_size, \
                         _bitrate_max, _bitrate_avg = struct.unpack('>BB3sLL', self._ds.read(13))
                         size_read += 13
     
                         #self._stream.codec['buffer_size'] = buffer_size
                         #self._stream.codec['bitrate_max'] = bitrate_max
                         #self._stream.codec['bitrate_avg'] = bitrate_avg
+                        self._stream.object_type = object_type
 
                         if ord(self._ds.read(1)) == 0x05:
                             length, byte_count = self._read_descriptor_length()
-                            self._ds.seek(length, os.SEEK_CUR)
+                            self._stream.decoder_config = self._ds.read(length)
                             size_read += (1 + byte_count + length)
                             
                     
@@ -769,7 +1191,44 @@ class MP4Handler(object):
         return element_size
 
     def _read_avcC(self, element_size):
-        self._ds.seek(element_size, os.SEEK_CUR)
+        """AVC Decoder Configuration"""
+        
+        data = self._ds.read(element_size)
+        self._stream.decoder_config = data
+        self._stream.nal_length_size = (ord(data[4:5]) & 0x03) + 1
+        
+        parameter_sets = []
+        pos = 5
+        for count_mask in [0x1F, 0xFF]:
+            count = ord(data[pos:pos + 1]) & count_mask
+            pos += 1
+            for _x in range(count):
+                length = struct.unpack('>H', data[pos:pos + 2])[0]
+                parameter_sets.append(data[pos + 2:pos + 2 + length])
+                pos += 2 + length
+                
+        self._stream.parameter_sets = parameter_sets
+        return element_size
+    
+    def _read_hvcC(self, element_size):
+        """HEVC Decoder Configuration"""
+        
+        data = self._ds.read(element_size)
+        self._stream.decoder_config = data
+        self._stream.nal_length_size = (ord(data[21:22]) & 0x03) + 1
+        
+        parameter_sets = []
+        array_count = ord(data[22:23])
+        pos = 23
+        for _x in range(array_count):
+            count = struct.unpack('>H', data[pos + 1:pos + 3])[0]
+            pos += 3
+            for _y in range(count):
+                length = struct.unpack('>H', data[pos:pos + 2])[0]
+                parameter_sets.append(data[pos + 2:pos + 2 + length])
+                pos += 2 + length
+        
+        self._stream.parameter_sets = parameter_sets
         return element_size
     
     def _read_ctab(self, parent, element_size):
@@ -990,6 +1449,32 @@ class MP4Handler(object):
 
         return value
 
+    def _encode_meta_data(self, name, value):
+        """Encode a value as an MP4 data type and data"""
+        
+        if name == b'trkn':
+            return 0x00, struct.pack('>2xHH2x', *value)
+        elif name == b'disk':
+            return 0x00, struct.pack('>2xHH', *value)
+        elif isinstance(value, Attachment):
+            return self._mime_to_dtype(value.mime_type), value.data
+        elif isinstance(value, bool):
+            return 0x15, struct.pack('>B', int(value))
+        elif isinstance(value, int):
+            if value < 0:
+                raise ValueError('Value %d negative for MP4 integer' % value)
+            
+            fmt = ITUNES_INT_FORMATS.get(name, None)
+            formats = [fmt] if fmt is not None else ['>B', '>H', '>L', '>Q']
+            for fmt in formats:
+                if value < (1 << (8 * struct.calcsize(fmt))):
+                    return 0x15, struct.pack(fmt, value)
+            raise ValueError('Value %d too large for MP4 integer' % value)
+        elif isinstance(value, bytes):
+            return 0x00, value
+        else:
+            return 0x01, value.encode('UTF-8')
+
     def _dtype_to_mime(self, dtype):
         """MP4 Data Type to Mime Type"""
         
@@ -1004,6 +1489,20 @@ class MP4Handler(object):
         else:
             raise ValueError('Unknown MP4 data type %d' % dtype)
     
+    def _mime_to_dtype(self, mime_type):
+        """Mime Type to MP4 Data Type"""
+        
+        if mime_type == 'image/gif':
+            return 0x0C
+        elif mime_type == 'image/jpeg':
+            return 0x0D
+        elif mime_type == 'image/png':
+            return 0x0E
+        elif mime_type == 'image/bmp':
+            return 0x11
+        else:
+            raise ValueError('Unable to store mime type %s in MP4' % mime_type)
+    
     def _read_byte_string(self):
         """Read a null terminated byte string"""
          
@@ -1102,6 +1601,73 @@ class MP4Handler(object):
             
         return struct.unpack('>Q', data)[0]
 
+def mp4_unpack_array(typecode, data):
+    """Unpack big endian data into an array"""
+    
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+def mp4_box(box_type, payload):
+    """Build a box from its type and payload"""
+    
+    size = len(payload) + 8
+    if size <= 0xFFFFFFFF:
+        return struct.pack('>L4s', size, box_type) + payload
+    else:
+        return struct.pack('>L4sQ', 1, box_type, size + 8) + payload
+
+
+def mp4_iter_boxes(data, start=0, end=None):
+    """Generate (box type, offset, payload offset, end offset) for each box
+    in a buffer"""
+    
+    if end is None:
+        end = len(data)
+        
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack('>L4s', data[pos:pos + 8])
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', data[pos + 8:pos + 16])[0]
+            header_size = 16
+        elif size == 0:
+            size = end - pos
+        
+        if size < header_size:
+            break
+
+        yield (box_type, pos, pos + header_size, pos + size)
+        pos += size
+
+
+def mp4_move(ds, offset, length, dest, block_size=1048576):
+    """Move `length` bytes at `offset` in a stream to `dest`"""
+    
+    if dest > offset:
+        pos = length
+        while pos > 0:
+            count = min(block_size, pos)
+            pos -= count
+            ds.seek(offset + pos, os.SEEK_SET)
+            data = ds.read(count)
+            ds.seek(dest + pos, os.SEEK_SET)
+            ds.write(data)
+    elif dest < offset:
+        pos = 0
+        while pos < length:
+            count = min(block_size, length - pos)
+            ds.seek(offset + pos, os.SEEK_SET)
+            data = ds.read(count)
+            ds.seek(dest + pos, os.SEEK_SET)
+            ds.write(data)
+            pos += count
+
+
 def mp4_read_uint(ds, size):
     if size == 1:
         return ord(ds.read(1))
@@ -0,0 +1,172 @@
+# Copyright (c) 2015 Simon Kennedy <sffjunkie+code@gmail.com>
+
+"""Extract elementary streams from MP4 files.
+
+AAC tracks are written as ADTS and H.264/HEVC tracks as Annex B byte
+streams. Sample data is read a chunk at a time, with chunks which follow
+each other in the file merged into a single read, rather than a seek and
+read per sample.
+"""
+
+import struct
+
+from mogul.media.mp4 import MP4Exception
+from mogul.media.mp4_segment import mp4_tracks
+
+__all__ = ['MP4Demuxer']
+
+START_CODE = b'\x00\x00\x00\x01'
+
+AAC_OBJECT_TYPES = [0x40, 0x66, 0x67, 0x68]
+
+
+class MP4Demuxer(object):
+    """Demultiplex the tracks of the file read by an MP4Handler.
+
+    `ds` is the stream the handler read from and `max_read` the largest
+    number of bytes to read at once.
+    """
+
+    def __init__(self, handler, ds, max_read=4194304):
+        self._handler = handler
+        self._ds = ds
+        self._max_read = max_read
+
+    def track(self, track_id):
+        for stream in mp4_tracks(self._handler):
+            if stream.id == track_id:
+                return stream
+
+        raise MP4Exception('MP4: Track %d not found' % track_id)
+
+    def write_track(self, track_id, ds):
+        """Write the elementary stream of a track to `ds`"""
+
+        stream = self.track(track_id)
+        codec = stream.codec
+        if codec == b'mp4a' and getattr(stream, 'object_type', None) in AAC_OBJECT_TYPES:
+            writer = ADTSWriter(stream.decoder_config)
+        elif codec in [b'avc1', b'avc3', b'hvc1', b'hev1']:
+            writer = AnnexBWriter(stream.nal_length_size,
+                                  stream.parameter_sets)
+        else:
+            raise MP4Exception('MP4: Unable to demultiplex %s tracks' % codec)
+
+        table = stream.sample_table
+        sizes = table.sizes()
+        sync = table.sync_samples
+        if sync is not None:
+            sync = set(table.sync_sample_indexes())
+
+        for offset, length, first, end in self._reads(table, sizes):
+            self._ds.seek(offset)
+            data = memoryview(self._ds.read(length))
+            if len(data) != length:
+                raise MP4Exception('MP4: Unexpected end of stream')
+
+            pos = 0
+            for sample in range(first, end):
+                size = sizes[sample]
+                writer.write(ds, data[pos:pos + size],
+                             sync is None or sample in sync)
+                pos += size
+
+    def _reads(self, table, sizes):
+        """Generate (offset, length, first sample, end sample) for each
+        read, where a read covers one or more consecutive chunks"""
+
+        run = None
+        for _chunk, offset, first, count in table.chunks():
+            length = sum(sizes[first:first + count])
+            if run is not None and run[0] + run[1] == offset and \
+                    run[1] + length <= self._max_read:
+                run[1] += length
+                run[3] = first + count
+            else:
+                if run is not None:
+                    yield run
+                run = [offset, length, first, first + count]
+
+        if run is not None:
+            yield run
+
+
+class ADTSWriter(object):
+    """Write raw AAC frames with ADTS headers"""
+
+    def __init__(self, decoder_config):
+        if decoder_config is None or len(decoder_config) < 2:
+            raise MP4Exception('MP4: No AAC decoder configuration available')
+
+        bits = BitReader(decoder_config)
+        object_type = self._object_type(bits)
+        frequency_index = bits.read(4)
+        if frequency_index == 15:
+            bits.read(24)
+        channels = bits.read(4)
+
+        # HE-AAC: the base object type follows the extension frequency,
+        # the header holds the frequency of the core AAC stream
+        if object_type in [5, 29]:
+            extension_index = bits.read(4)
+            if extension_index == 15:
+                bits.read(24)
+            object_type = self._object_type(bits)
+
+        if object_type > 4 or frequency_index > 12 or channels > 7:
+            raise MP4Exception('MP4: Unable to represent AAC configuration '
+                               'in ADTS')
+
+        self._header = (0xFFF1 << 40) | ((object_type - 1) << 38) | \
+            (frequency_index << 34) | (channels << 30) | (0x7FF << 2)
+
+    def _object_type(self, bits):
+        object_type = bits.read(5)
+        if object_type == 31:
+            object_type = 32 + bits.read(6)
+        return object_type
+
+    def write(self, ds, sample, sync):
+        header = self._header | ((len(sample) + 7) << 13)
+        ds.write(struct.pack('>Q', header)[1:])
+        ds.write(sample)
+
+
+class AnnexBWriter(object):
+    """Convert length prefixed NAL units into an Annex B byte stream, with
+    the parameter sets repeated before each sync sample"""
+
+    def __init__(self, nal_length_size, parameter_sets):
+        self._length_format = {1: '>B', 2: '>H', 4: '>L'}.get(nal_length_size)
+        if self._length_format is None:
+            raise MP4Exception('MP4: Invalid NAL length size %d' % nal_length_size)
+
+        self._length_size = nal_length_size
+        self._parameter_sets = b''.join([START_CODE + ps for ps in parameter_sets])
+
+    def write(self, ds, sample, sync):
+        if sync:
+            ds.write(self._parameter_sets)
+
+        pos = 0
+        length_size = self._length_size
+        while pos + length_size <= len(sample):
+            length = struct.unpack(self._length_format,
+                                   sample[pos:pos + length_size])[0]
+            pos += length_size
+            ds.write(START_CODE)
+            ds.write(sample[pos:pos + length])
+            pos += length
+
+
+class BitReader(object):
+    def __init__(self, data):
+        self._value = int.from_bytes(bytes(data), 'big')
+        self._bits = len(data) * 8
+        self._pos = 0
+
+    def read(self, count):
+        self._pos += count
+        if self._pos > self._bits:
+            raise MP4Exception('MP4: Not enough data in decoder configuration')
+        return (self._value >> (self._bits - self._pos)) & ((1 << count) - 1)
@@ -0,0 +1,254 @@
+# Copyright (c) 2015 Simon Kennedy <sffjunkie+code@gmail.com>
+
+"""Convert progressive MP4 files into fragmented MP4 files.
+
+The init segment is the original 'moov' box with empty sample tables and an
+'mvex' box. Each fragment is a 'moof' box built from the decoded sample
+tables followed by an 'mdat' box which is filled by copying contiguous runs
+of sample data from the source stream.
+"""
+
+import struct
+from bisect import bisect_left
+
+from mogul.media import copy_range
+from mogul.media.mp4 import MP4Exception, mp4_box, mp4_iter_boxes
+from mogul.media.mp4_segment import mp4_tracks, mp4_cut_times
+
+__all__ = ['MP4Fragment', 'MP4Fragmenter']
+
+SYNC_SAMPLE_FLAGS = 0x02000000
+NON_SYNC_SAMPLE_FLAGS = 0x01010000
+
+TFHD_DEFAULT_BASE_IS_MOOF = 0x020000
+
+TRUN_DATA_OFFSET = 0x000001
+TRUN_SAMPLE_DURATION = 0x000100
+TRUN_SAMPLE_SIZE = 0x000200
+TRUN_SAMPLE_FLAGS = 0x000400
+TRUN_SAMPLE_COMPOSITION_OFFSET = 0x000800
+
+_CONTAINERS = (b'trak', b'mdia', b'minf')
+
+
+class MP4Fragment(object):
+    def __init__(self, sequence_number):
+        self.sequence_number = sequence_number
+
+        self.runs = []
+        """(track, first sample, end sample) for each track"""
+
+
+class _Track(object):
+    """Sample information for a track, expanded once per fragmenter"""
+
+    def __init__(self, stream):
+        table = stream.sample_table
+
+        self.id = stream.id
+        self.time_scale = stream.time_scale
+        self.times = table.times()
+        self.sizes = table.sizes()
+        self.offsets = table.offsets()
+        self.composition_offsets = table.composition_offsets_per_sample()
+
+        if table.sync_samples is None:
+            self.sync = None
+        else:
+            self.sync = set(table.sync_sample_indexes())
+
+    def sample_flags(self, sample):
+        if self.sync is None or sample in self.sync:
+            return SYNC_SAMPLE_FLAGS
+        else:
+            return NON_SYNC_SAMPLE_FLAGS
+
+    def ranges(self, first, end):
+        """The contiguous byte ranges holding samples `first` to `end`"""
+
+        ranges = []
+        for sample in range(first, end):
+            offset = self.offsets[sample]
+            size = self.sizes[sample]
+            if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                ranges[-1][1] += size
+            else:
+                ranges.append([offset, size])
+        return ranges
+
+
+class MP4Fragmenter(object):
+    """Fragment the file read by an MP4Handler.
+
+    `ds` is the stream the handler read from. Fragments are cut at the sync
+    samples of the first video track, as close to `target_duration` seconds
+    as possible.
+    """
+
+    def __init__(self, handler, ds, target_duration=2.0, track_id=None):
+        self._handler = handler
+        self._ds = ds
+        self._target_duration = target_duration
+        self._track_id = track_id
+
+        self._tracks = [_Track(stream) for stream in mp4_tracks(handler)]
+        if len(self._tracks) == 0:
+            raise MP4Exception('MP4: No tracks with samples to fragment')
+
+    def write(self, ds):
+        """Write the init segment followed by all the fragments to `ds`"""
+
+        ds.write(self.init_segment())
+        for fragment in self.fragments():
+            self.write_fragment(ds, fragment)
+
+    def init_segment(self):
+        """The 'ftyp' and 'moov' boxes for the fragmented file"""
+
+        moov = self._handler.find_box((b'moov',))
+        if moov is None:
+            raise MP4Exception("MP4: No 'moov' box found")
+
+        self._ds.seek(moov.offset)
+        data = self._ds.read(moov.size)
+
+        payload = b''
+        for box_type, start, payload_start, end in \
+                mp4_iter_boxes(data, moov.header_size):
+            if box_type in _CONTAINERS:
+                payload += self._init_box(box_type, data, payload_start, end)
+            elif box_type != b'mvex':
+                payload += data[start:end]
+
+        mvex = b''
+        for track in self._tracks:
+            mvex += mp4_box(b'trex', struct.pack('>LLLLLL', 0, track.id,
+                                                 1, 0, 0, 0))
+        payload += mp4_box(b'mvex', mvex)
+
+        ftyp = mp4_box(b'ftyp', b'iso6' + struct.pack('>L', 0) +
+                       b'iso6isommp41dash')
+        return ftyp + mp4_box(b'moov', payload)
+
+    def _init_box(self, box_type, data, start, end):
+        payload = b''
+        for child_type, child_start, payload_start, child_end in \
+                mp4_iter_boxes(data, start, end):
+            if child_type in _CONTAINERS:
+                payload += self._init_box(child_type, data, payload_start,
+                                          child_end)
+            elif child_type == b'stbl':
+                payload += self._init_stbl(data, payload_start, child_end)
+            else:
+                payload += data[child_start:child_end]
+        return mp4_box(box_type, payload)
+
+    def _init_stbl(self, data, start, end):
+        payload = b''
+        for child_type, child_start, _payload_start, child_end in \
+                mp4_iter_boxes(data, start, end):
+            if child_type in (b'stsd', b'sgpd', b'sbgp'):
+                payload += data[child_start:child_end]
+
+        payload += mp4_box(b'stts', b'\x00' * 8)
+        payload += mp4_box(b'stsc', b'\x00' * 8)
+        payload += mp4_box(b'stsz', b'\x00' * 12)
+        payload += mp4_box(b'stco', b'\x00' * 8)
+        return mp4_box(b'stbl', payload)
+
+    def fragments(self):
+        """Generate the fragments, each covering the same time range of
+        every track"""
+
+        reference, cut_times = mp4_cut_times(self._handler,
+                                             self._target_duration,
+                                             self._track_id)
+
+        bounds = []
+        for track in self._tracks:
+            scale = float(track.time_scale) / reference.time_scale
+            samples = [bisect_left(track.times, int(round(t * scale)))
+                       for t in cut_times[:-1]]
+            samples[0] = 0
+            samples.append(len(track.sizes))
+            bounds.append(samples)
+
+        for idx in range(len(cut_times) - 1):
+            fragment = MP4Fragment(idx + 1)
+            for track, samples in zip(self._tracks, bounds):
+                if samples[idx + 1] > samples[idx]:
+                    fragment.runs.append((track, samples[idx],
+                                          samples[idx + 1]))
+
+            if len(fragment.runs) > 0:
+                yield fragment
+
+    def write_fragment(self, ds, fragment):
+        """Write a 'moof' box and an 'mdat' box containing the sample data
+        for the fragment to `ds`"""
+
+        moof = self._moof(fragment, 0)
+        moof = self._moof(fragment, len(moof))
+        ds.write(moof)
+
+        ranges = []
+        for track, first, end in fragment.runs:
+            ranges.extend(track.ranges(first, end))
+
+        data_size = sum([size for _offset, size in ranges])
+        if data_size + 8 <= 0xFFFFFFFF:
+            ds.write(struct.pack('>L4s', data_size + 8, b'mdat'))
+        else:
+            ds.write(struct.pack('>L4sQ', 1, b'mdat', data_size + 16))
+
+        for offset, size in ranges:
+            copy_range(self._ds, ds, offset, size)
+
+    def _moof(self, fragment, moof_size):
+        data_size = sum([sum(track.sizes[first:end])
+                         for track, first, end in fragment.runs])
+        if data_size + 8 <= 0xFFFFFFFF:
+            data_offset = moof_size + 8
+        else:
+            data_offset = moof_size + 16
+
+        payload = mp4_box(b'mfhd', struct.pack('>LL', 0,
+                                               fragment.sequence_number))
+        for track, first, end in fragment.runs:
+            payload += self._traf(track, first, end, data_offset)
+            data_offset += sum(track.sizes[first:end])
+
+        return mp4_box(b'moof', payload)
+
+    def _traf(self, track, first, end, data_offset):
+        tfhd = mp4_box(b'tfhd', struct.pack('>LL', TFHD_DEFAULT_BASE_IS_MOOF,
+                                            track.id))
+        tfdt = mp4_box(b'tfdt', struct.pack('>LQ', 0x01000000,
+                                            track.times[first]))
+
+        flags = TRUN_DATA_OFFSET | TRUN_SAMPLE_DURATION | \
+            TRUN_SAMPLE_SIZE | TRUN_SAMPLE_FLAGS
+        version = 0
+        cts = track.composition_offsets
+        if cts is not None:
+            flags |= TRUN_SAMPLE_COMPOSITION_OFFSET
+            if min(cts[first:end]) < 0:
+                version = 1
+            entry = struct.Struct('>LLLl' if version else '>LLLL')
+        else:
+            entry = struct.Struct('>LLL')
+
+        times = track.times
+        sizes = track.sizes
+        entries = []
+        for sample in range(first, end):
+            values = (times[sample + 1] - times[sample], sizes[sample],
+                      track.sample_flags(sample))
+            if cts is not None:
+                values += (cts[sample],)
+            entries.append(entry.pack(*values))
+
+        trun = mp4_box(b'trun', struct.pack('>LLl', (version << 24) | flags,
+                                            end - first, data_offset) +
+                       b''.join(entries))
+        return mp4_box(b'traf', tfhd + tfdt + trun)
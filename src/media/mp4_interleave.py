@@ -0,0 +1,106 @@
+# Copyright (c) 2015 Simon Kennedy <sffjunkie+code@gmail.com>
+
+"""Measure how well the tracks of an MP4 file are interleaved.
+
+Only the chunk offset, sample to chunk, sample size and time to sample
+tables are used so only the 'moov' box needs to be read.
+"""
+
+from mogul.media.mp4 import MP4Exception
+from mogul.media.mp4_segment import mp4_tracks
+
+__all__ = ['MP4TrackInterleave', 'MP4Interleave', 'mp4_interleave']
+
+
+class MP4TrackInterleave(object):
+    """Chunk statistics for a single track"""
+
+    def __init__(self, track_id):
+        self.track_id = track_id
+        self.chunk_count = 0
+        self.mean_chunk_size = 0
+        self.mean_chunk_duration = 0.0
+        self.mean_distance = 0
+        """Mean number of bytes between the end of one chunk and the start
+        of the next"""
+        self.max_distance = 0
+
+
+class MP4Interleave(object):
+    def __init__(self):
+        self.tracks = []
+
+        self.lookahead = 0
+        """Largest number of bytes a sequential reader needs to hold to
+        have the data for the same time from every track"""
+
+        self.lookahead_duration = 0.0
+        """`lookahead` in seconds at the file's average data rate. This is
+        the interleave score, lower is better."""
+
+        self.badly_interleaved = False
+
+
+def mp4_interleave(handler, threshold=1.0):
+    """Analyse the interleaving of the file read by an MP4Handler.
+
+    The file is flagged as badly interleaved when more than `threshold`
+    seconds worth of data needs to be read ahead to keep the tracks in sync.
+    """
+
+    tracks = mp4_tracks(handler)
+    if len(tracks) == 0:
+        raise MP4Exception('MP4: No tracks with samples to analyse')
+
+    result = MP4Interleave()
+    events = []
+    total_size = 0
+    duration = 0.0
+    for index, track in enumerate(tracks):
+        table = track.sample_table
+        times = table.times()
+        sizes = table.sizes()
+        scale = float(track.time_scale)
+
+        chunks = []
+        for _chunk, offset, first, count in table.chunks():
+            size = sum(sizes[first:first + count])
+            chunks.append((offset, size, times[first] / scale,
+                           times[first + count] / scale))
+
+        stats = MP4TrackInterleave(track.id)
+        stats.chunk_count = len(chunks)
+        track_size = sum([chunk[1] for chunk in chunks])
+        track_duration = times[-1] / scale
+        if len(chunks) > 0:
+            stats.mean_chunk_size = track_size // len(chunks)
+            stats.mean_chunk_duration = track_duration / len(chunks)
+
+        distances = [abs(chunks[idx + 1][0] - (chunk[0] + chunk[1]))
+                     for idx, chunk in enumerate(chunks[:-1])]
+        if len(distances) > 0:
+            stats.mean_distance = sum(distances) // len(distances)
+            stats.max_distance = max(distances)
+
+        result.tracks.append(stats)
+        events.extend([(start, index, offset, size, end)
+                       for offset, size, start, end in chunks])
+        total_size += track_size
+        duration = max(duration, track_duration)
+
+    current = [None] * len(tracks)
+    for time, index, offset, size, end in sorted(events):
+        current[index] = (offset, offset + size, end)
+        active = [chunk for chunk in current
+                  if chunk is not None and chunk[2] > time]
+        if len(active) == 0:
+            continue
+        span = max([chunk[1] for chunk in active]) - \
+            min([chunk[0] for chunk in active])
+        result.lookahead = max(result.lookahead, span)
+
+    if duration > 0 and total_size > 0:
+        result.lookahead_duration = result.lookahead / (total_size / duration)
+    result.badly_interleaved = result.lookahead_duration > threshold
+
+    return result
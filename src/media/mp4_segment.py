@@ -0,0 +1,220 @@
+# Copyright (c) 2015 Simon Kennedy <sffjunkie+code@gmail.com>
+
+"""Segment maps for progressive MP4 files.
+
+Segments are cut at the sync samples of a reference track and their byte
+ranges are calculated from the sample tables so only the 'moov' box needs
+to be read.
+"""
+
+import struct
+from bisect import bisect_left, bisect_right
+
+from mogul.media.mp4 import MP4Exception, mp4_box
+
+__all__ = ['MP4Segment', 'mp4_cut_times', 'mp4_segments', 'mp4_sidx', 'mp4_segment_manifest']
+
+
+class MP4Segment(object):
+    def __init__(self, start, duration):
+        self.start = start
+        """Start time in the reference track's time scale"""
+        
+        self.duration = duration
+        
+        self.ranges = []
+        """(offset, size) of each contiguous run of sample data"""
+    
+    @property
+    def offset(self):
+        return self.ranges[0][0]
+    
+    @property
+    def end(self):
+        return max([offset + size for offset, size in self.ranges])
+
+
+def mp4_tracks(handler):
+    """All the tracks in an MP4Handler which have a sample table"""
+    
+    tracks = []
+    for entry in handler.container.entries:
+        for stream in entry.streams:
+            table = getattr(stream, 'sample_table', None)
+            if table is not None and table.sample_count > 0:
+                tracks.append(stream)
+    return tracks
+
+
+def mp4_reference_track(handler, track_id=None):
+    tracks = mp4_tracks(handler)
+    if len(tracks) == 0:
+        raise MP4Exception('MP4: No tracks with samples found')
+    
+    if track_id is not None:
+        for track in tracks:
+            if track.id == track_id:
+                return track
+        raise MP4Exception('MP4: Track %d not found' % track_id)
+    
+    for track in tracks:
+        if getattr(track, 'handler_type', None) == b'vide':
+            return track
+    return tracks[0]
+
+
+def mp4_cut_times(handler, target_duration=2.0, track_id=None):
+    """The times, in the reference track's time scale, at which to start
+    each segment plus the end time of the reference track.
+    
+    Segments start at a sync sample of the reference track and last as close
+    to `target_duration` seconds as the sync samples allow. The reference
+    track is either the track with the id `track_id` or the first video
+    track.
+    """
+    
+    reference = mp4_reference_track(handler, track_id)
+    table = reference.sample_table
+    times = table.times()
+    target = int(target_duration * reference.time_scale)
+
+    sync_times = [times[idx] for idx in table.sync_sample_indexes()]
+    cut_times = [0]
+    while True:
+        desired = cut_times[-1] + target
+        idx = bisect_left(sync_times, desired)
+        candidates = [t for t in sync_times[max(idx - 1, 0):idx + 1]
+                      if t > cut_times[-1]]
+        if len(candidates) == 0:
+            break
+        cut_times.append(min(candidates, key=lambda t: abs(t - desired)))
+    
+    end_time = times[-1]
+    if cut_times[-1] >= end_time:
+        cut_times.pop()
+    cut_times.append(end_time)
+    
+    return reference, cut_times
+
+
+def mp4_segments(handler, target_duration=2.0, track_id=None):
+    """Split a file into segments using the cut times from
+    :func:`mp4_cut_times` and find the byte ranges of each segment."""
+    
+    reference, cut_times = mp4_cut_times(handler, target_duration, track_id)
+
+    segments = []
+    for idx in range(len(cut_times) - 1):
+        start = cut_times[idx]
+        segments.append(MP4Segment(start, cut_times[idx + 1] - start))
+
+    cut_times = cut_times[:-1]
+    for track in mp4_tracks(handler):
+        scale = float(track.time_scale) / reference.time_scale
+        track_cuts = [int(round(t * scale)) for t in cut_times]
+        _add_track_ranges(segments, track.sample_table, track_cuts)
+
+    for segment in segments:
+        segment.ranges = _coalesce(segment.ranges)
+    
+    return [segment for segment in segments if len(segment.ranges) > 0]
+
+
+def _add_track_ranges(segments, table, cuts):
+    times = table.times()
+    sizes = table.sizes()
+    for _chunk, offset, first, count in table.chunks():
+        ranges = None
+        segment = -1
+        for sample in range(first, first + count):
+            idx = max(bisect_right(cuts, times[sample]) - 1, 0)
+            size = sizes[sample]
+            if idx != segment:
+                segment = idx
+                ranges = segments[idx].ranges
+                ranges.append((offset, size))
+            else:
+                start, length = ranges[-1]
+                ranges[-1] = (start, length + size)
+            offset += size
+
+
+def _coalesce(ranges):
+    """Sort and merge touching or overlapping byte ranges"""
+    
+    merged = []
+    for offset, size in sorted(ranges):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            last_offset, last_size = merged[-1]
+            merged[-1] = (last_offset,
+                          max(last_size, offset + size - last_offset))
+        else:
+            merged.append((offset, size))
+    return merged
+
+
+def mp4_sidx(handler, segments=None, target_duration=2.0, track_id=None,
+             anchor=None):
+    """Build a Segment Index ('sidx') box for the file.
+    
+    Each reference covers the bytes from the start of one segment to the
+    start of the next, which requires the sample data to be stored in time
+    order. `anchor` is the file offset of the first byte after the 'sidx'
+    box and defaults to the start of the first segment.
+    """
+    
+    reference = mp4_reference_track(handler, track_id)
+    if segments is None:
+        segments = mp4_segments(handler, target_duration, reference.id)
+    
+    if len(segments) == 0:
+        raise MP4Exception('MP4: No segments to index')
+
+    boundaries = [segment.offset for segment in segments]
+    boundaries.append(max([segment.end for segment in segments]))
+    for idx in range(len(segments)):
+        if boundaries[idx + 1] <= boundaries[idx] or \
+                (idx + 1 < len(segments) and
+                 segments[idx].end > segments[idx + 1].offset):
+            raise MP4Exception('MP4: Sample data is not stored in time order')
+
+    if anchor is None:
+        anchor = boundaries[0]
+    first_offset = boundaries[0] - anchor
+    earliest = segments[0].start
+
+    if earliest > 0xFFFFFFFF or first_offset > 0xFFFFFFFF:
+        version = 1
+        data = struct.pack('>LLQQ', reference.id, reference.time_scale,
+                           earliest, first_offset)
+    else:
+        version = 0
+        data = struct.pack('>LLLL', reference.id, reference.time_scale,
+                           earliest, first_offset)
+    
+    data += struct.pack('>HH', 0, len(segments))
+    for idx, segment in enumerate(segments):
+        size = boundaries[idx + 1] - boundaries[idx]
+        if size >= 0x80000000:
+            raise MP4Exception('MP4: Segment too large for a sidx reference')
+        
+        data += struct.pack('>LLL', size, segment.duration, 0x90000000)
+
+    return mp4_box(b'sidx', struct.pack('>B3x', version) + data)
+
+
+def mp4_segment_manifest(handler, target_duration=2.0, track_id=None):
+    """A JSON serialisable description of the byte ranges of each segment"""
+    
+    reference = mp4_reference_track(handler, track_id)
+    segments = mp4_segments(handler, target_duration, reference.id)
+    
+    return {
+        'track_id': reference.id,
+        'timescale': reference.time_scale,
+        'segments': [{
+            'start': segment.start,
+            'duration': segment.duration,
+            'ranges': [[offset, size] for offset, size in segment.ranges],
+        } for segment in segments],
+    }
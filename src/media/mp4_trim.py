@@ -0,0 +1,347 @@
+# Copyright (c) 2015 Simon Kennedy <sffjunkie+code@gmail.com>
+
+"""Cut a time range out of an MP4 file without re-encoding.
+
+The start of the range is moved back to a sync sample of the reference track
+and the end forward to the next sync sample so the output can be decoded on
+its own. New sample tables are built for every track and the sample data is
+copied from the source stream a contiguous run at a time, using the kernel's
+zero copy functions where available.
+"""
+
+import struct
+from bisect import bisect_left, bisect_right
+
+from mogul.media import copy_range
+from mogul.media.mp4 import MP4Exception, mp4_box, mp4_iter_boxes
+from mogul.media.mp4_segment import mp4_reference_track
+
+__all__ = ['MP4Trimmer']
+
+_CONTAINERS = (b'mdia', b'minf')
+
+
+class _Track(object):
+    """The samples of a track which fall within the trimmed range"""
+
+    def __init__(self, stream, first, end):
+        table = stream.sample_table
+
+        self.stream = stream
+        self.table = table
+        self.first = first
+        self.end = end
+
+        self.times = table.times()
+        self.sizes = table.sizes()
+
+        self.chunks = []
+        """[source offset, size, sample count, description index, offset]
+        for each chunk, in sample order"""
+
+        offsets = table.offsets()
+        for chunk, _offset, chunk_first, count in table.chunks():
+            lo = max(chunk_first, first)
+            hi = min(chunk_first + count, end)
+            if lo < hi:
+                self.chunks.append([offsets[lo], sum(self.sizes[lo:hi]),
+                                    hi - lo, self._description(chunk), 0])
+
+    @property
+    def duration(self):
+        """Duration in the track's time scale"""
+
+        return self.times[self.end] - self.times[self.first]
+
+    def _description(self, chunk):
+        runs = self.table.sample_to_chunk
+        idx = bisect_right([run[0] for run in runs], chunk + 1) - 1
+        return runs[idx][2]
+
+
+class MP4Trimmer(object):
+    """Trim the file read by an MP4Handler.
+
+    `ds` is the stream the handler read from. The range is aligned to the
+    sync samples of either the track with the id `track_id` or the first
+    video track.
+    """
+
+    def __init__(self, handler, ds, track_id=None):
+        self._handler = handler
+        self._ds = ds
+        self._track_id = track_id
+
+    def sample_range(self, start, end=None):
+        """The (start, end) times in seconds of the range which will be
+        written when trimming to `start` - `end`"""
+
+        reference, t0, t1 = self._range(start, end)
+        scale = float(reference.time_scale)
+        return (t0 / scale, t1 / scale)
+
+    def write(self, ds, start, end=None):
+        """Write the samples from `start` up to `end` seconds to `ds` as a
+        new MP4 file.
+
+        Returns the (start, end) times in seconds of the range written.
+        """
+
+        reference, t0, t1 = self._range(start, end)
+        tracks = self._tracks(reference, t0, t1)
+
+        chunks = sorted([chunk for track in tracks if track is not None
+                         for chunk in track.chunks])
+        data_size = sum([chunk[1] for chunk in chunks])
+
+        ftyp = self._handler.find_box((b'ftyp',))
+        if ftyp is not None:
+            self._ds.seek(ftyp.offset)
+            ftyp = self._ds.read(ftyp.size)
+        else:
+            ftyp = b''
+
+        if data_size + 8 <= 0xFFFFFFFF:
+            mdat = struct.pack('>L4s', data_size + 8, b'mdat')
+        else:
+            mdat = struct.pack('>L4sQ', 1, b'mdat', data_size + 16)
+
+        # The chunk offsets depend on the size of the 'moov' box which only
+        # changes when the offsets need more than 32 bits.
+        moov = b''
+        for _pass in range(3):
+            offset = len(ftyp) + len(moov) + len(mdat)
+            for chunk in chunks:
+                chunk[4] = offset
+                offset += chunk[1]
+
+            size = len(moov)
+            moov = self._moov(tracks, reference.time_scale, t1 - t0,
+                              offset > 0xFFFFFFFF)
+            if len(moov) == size:
+                break
+
+        ds.write(ftyp)
+        ds.write(moov)
+        ds.write(mdat)
+
+        run = None
+        for chunk in chunks:
+            if run is not None and run[0] + run[1] == chunk[0]:
+                run[1] += chunk[1]
+            else:
+                if run is not None:
+                    copy_range(self._ds, ds, run[0], run[1])
+                run = chunk[:2]
+        if run is not None:
+            copy_range(self._ds, ds, run[0], run[1])
+
+        scale = float(reference.time_scale)
+        return (t0 / scale, t1 / scale)
+
+    def _range(self, start, end):
+        reference = mp4_reference_track(self._handler, self._track_id)
+        table = reference.sample_table
+        times = table.times()
+        scale = reference.time_scale
+
+        sync_times = [times[idx] for idx in table.sync_sample_indexes()]
+        t0 = int(round(start * scale))
+        idx = max(bisect_right(sync_times, t0) - 1, 0)
+        t0 = sync_times[idx]
+
+        if end is None:
+            t1 = times[-1]
+        else:
+            t1 = int(round(end * scale))
+            idx = bisect_left(sync_times, t1)
+            if idx < len(sync_times):
+                t1 = sync_times[idx]
+            else:
+                t1 = times[-1]
+
+        if t1 <= t0:
+            raise MP4Exception('MP4: No samples in the range %s - %s' % \
+                               (start, end))
+
+        return reference, t0, t1
+
+    def _tracks(self, reference, t0, t1):
+        """A _Track for each stream in the order of the 'trak' boxes, or
+        None for streams without samples"""
+
+        tracks = []
+        for stream in self._handler.container.entries[0].streams:
+            table = getattr(stream, 'sample_table', None)
+            if table is None or table.sample_count == 0:
+                tracks.append(None)
+                continue
+
+            times = table.times()
+            scale = float(stream.time_scale) / reference.time_scale
+            start = int(round(t0 * scale))
+            end = int(round(t1 * scale))
+
+            # Start with the sample playing at the start of the range
+            first = max(bisect_right(times, start, 0, table.sample_count) - 1, 0)
+            last = bisect_left(times, end, 0, table.sample_count)
+            tracks.append(_Track(stream, first, max(first, last)))
+        return tracks
+
+    def _moov(self, tracks, reference_scale, duration, large_offsets):
+        moov = self._handler.find_box((b'moov',))
+        self._ds.seek(moov.offset)
+        data = self._ds.read(moov.size)
+
+        movie_scale = self._handler.container.entries[0].time_scale
+        movie_duration = 0
+        traks = []
+        for track in tracks:
+            if track is None:
+                traks.append(None)
+            else:
+                track_duration = track.duration * movie_scale // \
+                    track.stream.time_scale
+                movie_duration = max(movie_duration, track_duration)
+                traks.append((track, track_duration))
+
+        payload = b''
+        index = 0
+        for box_type, start, payload_start, end in \
+                mp4_iter_boxes(data, moov.header_size):
+            if box_type == b'mvhd':
+                payload += self._header(b'mvhd', data, payload_start, end,
+                                        movie_duration)
+            elif box_type == b'trak':
+                if index < len(traks) and traks[index] is not None:
+                    payload += self._trak(data, payload_start, end,
+                                          traks[index], large_offsets)
+                else:
+                    payload += data[start:end]
+                index += 1
+            else:
+                payload += data[start:end]
+        return mp4_box(b'moov', payload)
+
+    def _header(self, box_type, data, start, end, duration):
+        """Replace the duration in an 'mvhd', 'tkhd' or 'mdhd' box"""
+
+        payload = bytearray(data[start:end])
+        if payload[0] == 1:
+            pos = 28 if box_type == b'tkhd' else 24
+            struct.pack_into('>Q', payload, pos, duration)
+        else:
+            pos = 20 if box_type == b'tkhd' else 16
+            struct.pack_into('>L', payload, pos, duration)
+        return mp4_box(box_type, bytes(payload))
+
+    def _trak(self, data, start, end, trak, large_offsets):
+        track, track_duration = trak
+
+        payload = b''
+        for box_type, child_start, payload_start, child_end in \
+                mp4_iter_boxes(data, start, end):
+            if box_type == b'tkhd':
+                payload += self._header(b'tkhd', data, payload_start,
+                                        child_end, track_duration)
+            elif box_type == b'edts':
+                # The edit list refers to the original timeline
+                continue
+            elif box_type == b'mdia':
+                payload += self._media_box(box_type, data, payload_start,
+                                           child_end, track, large_offsets)
+            else:
+                payload += data[child_start:child_end]
+        return mp4_box(b'trak', payload)
+
+    def _media_box(self, box_type, data, start, end, track, large_offsets):
+        payload = b''
+        for child_type, child_start, payload_start, child_end in \
+                mp4_iter_boxes(data, start, end):
+            if child_type == b'mdhd':
+                payload += self._header(b'mdhd', data, payload_start,
+                                        child_end, track.duration)
+            elif child_type in _CONTAINERS:
+                payload += self._media_box(child_type, data, payload_start,
+                                           child_end, track, large_offsets)
+            elif child_type == b'stbl':
+                payload += self._stbl(data, payload_start, child_end, track,
+                                      large_offsets)
+            else:
+                payload += data[child_start:child_end]
+        return mp4_box(box_type, payload)
+
+    def _stbl(self, data, start, end, track, large_offsets):
+        table = track.table
+        first = track.first
+        last = track.end
+
+        payload = b''
+        for child_type, child_start, _payload_start, child_end in \
+                mp4_iter_boxes(data, start, end):
+            if child_type == b'stsd':
+                payload += data[child_start:child_end]
+
+        times = track.times
+        payload += _full_box(b'stts', 0, _runs([times[idx + 1] - times[idx]
+                                               for idx in range(first, last)]))
+
+        cts = table.composition_offsets_per_sample()
+        if cts is not None:
+            cts = cts[first:last]
+            version = 1 if len(cts) > 0 and min(cts) < 0 else 0
+            payload += _full_box(b'ctts', version, _runs(cts),
+                                 '>Ll' if version else '>LL')
+
+        if table.sync_samples is not None:
+            sync = [idx - first + 1 for idx in table.sync_sample_indexes()
+                    if first <= idx < last]
+            payload += _full_box(b'stss', 0, sync, '>L')
+
+        stsc = []
+        for idx, chunk in enumerate(track.chunks):
+            if len(stsc) == 0 or stsc[-1][1:] != (chunk[2], chunk[3]):
+                stsc.append((idx + 1, chunk[2], chunk[3]))
+        payload += _full_box(b'stsc', 0, stsc, '>LLL')
+
+        if table.sample_sizes is None:
+            payload += mp4_box(b'stsz', struct.pack('>LLL', 0,
+                                                    table.sample_size,
+                                                    last - first))
+        else:
+            payload += mp4_box(b'stsz', struct.pack('>LLL', 0, 0,
+                                                    last - first) +
+                               struct.pack('>%dL' % (last - first),
+                                           *track.sizes[first:last]))
+
+        offsets = [chunk[4] for chunk in track.chunks]
+        if large_offsets:
+            payload += _full_box(b'co64', 0, offsets, '>Q')
+        else:
+            payload += _full_box(b'stco', 0, offsets, '>L')
+
+        return mp4_box(b'stbl', payload)
+
+
+def _runs(values):
+    """Run length encode `values` as (count, value) tuples"""
+
+    runs = []
+    for value in values:
+        if len(runs) > 0 and runs[-1][1] == value:
+            runs[-1][0] += 1
+        else:
+            runs.append([1, value])
+    return [tuple(run) for run in runs]
+
+
+def _full_box(box_type, version, entries, entry_format='>LL'):
+    """A full box holding an entry count followed by the entries"""
+
+    entry = struct.Struct(entry_format)
+    if entry_format == '>L' or entry_format == '>Q':
+        data = b''.join([entry.pack(value) for value in entries])
+    else:
+        data = b''.join([entry.pack(*value) for value in entries])
+    return mp4_box(box_type, struct.pack('>LL', version << 24, len(entries)) +
+                   data)
@@ -1,9 +1,16 @@
 # Copyright (c) 2009-2014 Simon Kennedy <sffjunkie+code@gmail.com>
 
 import os
+import sys
 import struct
 from io import BytesIO
+from array import array
 from datetime import datetime
+from contextlib import contextmanager
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 
 from mogul.media import localize
 _ = localize()
@@ -27,6 +34,231 @@ TIFF_GrayResponseUnit = {1: 'tenths', 2: 'hundredths', 3: 'thousandths',
                          4: 'ten-thousandths', 5: 'hundred-thousandths'}
 TIFF_SubFileType = {0: 'Reduced Resolution', 1: 'Multipage', 2: 'Transparency Mask'}
 
+TIFF_FieldSizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8,
+                   11: 4, 12: 8, 13: 4, 16: 8, 17: 8, 18: 8}
+TIFF_FieldFormats = {1: 'B', 3: 'H', 4: 'L', 5: 'L', 6: 'b', 8: 'h', 9: 'l',
+                     10: 'l', 11: 'f', 12: 'd', 13: 'L', 16: 'Q', 17: 'q',
+                     18: 'Q'}
+
+# Offsets and byte counts of strips and tiles, decoded into arrays
+TIFF_ArrayTags = set([273, 279, 288, 289, 324, 325])
+TIFF_ArrayTypes = {2: 'H', 4: 'I' if array('I').itemsize == 4 else 'L', 8: 'Q'}
+
+# Out of line values closer together than this are read together
+TIFF_MergeGap = 4096
+
+# Sidecar page index files
+TIFF_IndexMagic = b'MGTI'
+TIFF_IndexHeader = struct.Struct('<4sHQqQ')
+TIFF_IndexVersion = 1
+
+_native_endian = '<' if sys.byteorder == 'little' else '>'
+
+def _rational(numerator, denominator):
+    if denominator == 0:
+        return '0'
+    else:
+        return '%d/%d' % (numerator, denominator)
+
+
+class TIFFIFD(MutableMapping):
+    """The tags of an IFD keyed by their name or number.
+    
+    The entry table is read when a tag is first looked up and each value is
+    only decoded when it is accessed. The stream the IFD was read from must
+    still be open, or have been read from a file, when values are accessed.
+    """
+    
+    def __init__(self, handler, offset, valid_tags, entries=None):
+        self.offset = offset
+        
+        self._handler = handler
+        self._valid_tags = valid_tags
+        self._values = {}
+        self._pending = None
+        """The (tag, field type, count, value) entries for each key which
+        has not been decoded"""
+        
+        if entries is not None:
+            self._set_entries(entries)
+    
+    def load(self, keys=None):
+        """Decode the values for `keys`, or all the values, together.
+        
+        Values stored out of line are read in offset order."""
+        
+        pending = self._table()
+        if keys is None:
+            keys = list(pending.keys())
+        keys = [key for key in keys if key in pending]
+        if len(keys) == 0:
+            return
+        
+        entries = [(key, entry) for key in keys for entry in pending[key]]
+        values = self._handler._read_values([entry for _key, entry in entries])
+        
+        decoded = {}
+        for (key, entry), value in zip(entries, values):
+            value = self._handler._finish_value(entry[0], value,
+                                                self._valid_tags)
+            decoded.setdefault(key, []).append(value)
+        
+        for key in keys:
+            values = decoded[key]
+            self._values[key] = values[0] if len(values) == 1 else values
+            del pending[key]
+    
+    def entries(self):
+        """The undecoded (tag, field type, count, value) entries of the
+        IFD"""
+        
+        return [entry for key_entries in self._table().values()
+                for entry in key_entries]
+    
+    def copy(self):
+        self.load()
+        return dict(self._values)
+    
+    def items(self):
+        self.load()
+        return super(TIFFIFD, self).items()
+    
+    def values(self):
+        self.load()
+        return super(TIFFIFD, self).values()
+    
+    def __getitem__(self, key):
+        if key not in self._values:
+            if key not in self._table():
+                raise KeyError(key)
+            self.load([key])
+        return self._values[key]
+    
+    def __setitem__(self, key, value):
+        self._table().pop(key, None)
+        self._values[key] = value
+    
+    def __delitem__(self, key):
+        if key not in self._values and key not in self._table():
+            raise KeyError(key)
+        self._values.pop(key, None)
+        self._table().pop(key, None)
+    
+    def __contains__(self, key):
+        return key in self._values or key in self._table()
+    
+    def __iter__(self):
+        return iter(list(self._values.keys()) + 
+                    [key for key in self._table() if key not in self._values])
+    
+    def __len__(self):
+        return len(self._values) + len(self._table())
+    
+    def __repr__(self):
+        return 'TIFFIFD(offset=%d, keys=%r)' % (self.offset, list(self))
+    
+    def _table(self):
+        if self._pending is None:
+            table = self._handler._read_ifd_table(self.offset)
+            self._set_entries(table[0] if table is not None else [])
+        return self._pending
+    
+    def _set_entries(self, entries):
+        self._pending = {}
+        for entry in entries:
+            if entry[1] not in TIFF_FieldSizes:
+                self._handler.logger.debug('TIFF: Unknown field type %d' %
+                                           entry[1])
+                continue
+            
+            key = self._handler._tag_key(entry[0], self._valid_tags)
+            if key in self._pending:
+                self._handler.logger.debug('TIFF: Repeated tag 0x%04X' %
+                                           entry[0])
+            self._pending.setdefault(key, []).append(entry)
+
+
+class TIFFPageIndex(object):
+    """The IFD offset and dimensions of each page, one array entry per
+    page"""
+    
+    def __init__(self):
+        self.offsets = array('Q')
+        self.widths = array(TIFF_ArrayTypes[4])
+        self.heights = array(TIFF_ArrayTypes[4])
+        self.samples = array('H')
+        self.compressions = array('H')
+        self.subfile_types = array(TIFF_ArrayTypes[4])
+    
+    def __len__(self):
+        return len(self.offsets)
+    
+    def append(self, offset, width, height, samples, compression,
+               subfile_type):
+        self.offsets.append(offset)
+        self.widths.append(width)
+        self.heights.append(height)
+        self.samples.append(samples)
+        self.compressions.append(compression)
+        self.subfile_types.append(subfile_type)
+    
+    def save(self, filename, source_stat):
+        """Write the index to the sidecar `filename`.
+        
+        `source_stat` is the `os.stat` result for the indexed file.
+        """
+        
+        with open(filename, 'wb') as fp:
+            fp.write(TIFF_IndexHeader.pack(TIFF_IndexMagic, TIFF_IndexVersion,
+                                           source_stat.st_size,
+                                           _mtime(source_stat), len(self)))
+            for values in self._arrays():
+                if sys.byteorder == 'big':
+                    values = array(values.typecode, values)
+                    values.byteswap()
+                fp.write(values.tobytes())
+    
+    @staticmethod
+    def load(filename, source_stat):
+        """Read an index from a sidecar file, returns None if the file does
+        not exist or does not match `source_stat`"""
+        
+        try:
+            fp = open(filename, 'rb')
+        except (IOError, OSError):
+            return None
+        
+        with fp:
+            header = fp.read(TIFF_IndexHeader.size)
+            if len(header) != TIFF_IndexHeader.size:
+                return None
+            
+            magic, version, size, mtime, count = \
+                TIFF_IndexHeader.unpack(header)
+            if magic != TIFF_IndexMagic or version != TIFF_IndexVersion or \
+                    size != source_stat.st_size or \
+                    mtime != _mtime(source_stat):
+                return None
+            
+            index = TIFFPageIndex()
+            for values in index._arrays():
+                data = fp.read(count * values.itemsize)
+                if len(data) != count * values.itemsize:
+                    return None
+                values.frombytes(data)
+                if sys.byteorder == 'big':
+                    values.byteswap()
+            return index
+    
+    def _arrays(self):
+        return [self.offsets, self.widths, self.heights, self.samples,
+                self.compressions, self.subfile_types]
+
+
+def _mtime(source_stat):
+    return int(source_stat.st_mtime * 1000000)
+
+
 class TIFFHandler(MediaHandler):
     """A handler for TIFF files"""
     
@@ -146,20 +378,20 @@ class TIFFHandler(MediaHandler):
             33450: Element(_('MD Preparation Date'), 'mddate'),
             33451: Element(_('MD Preparation Time'), 'mdtime'),
             33452: Element(_('MD File Units')),
-            33550: Element(_('Model Pixel Scale Tag')),
+            33550: Element(_('Model Pixel Scale Tag'), key='model_pixel_scale'),
             33723: Element(_('IPTC'), 'iptc'),
             33918: Element(_('INGR Packet Data Tag')),
             33919: Element(_('INGR Flag Registers')),
             33920: Element(_('IrasB Transformation Matrix')),
-            33922: Element(_('Model Tiepoint Tag')),
-            34264: Element(_('Model Transformation Tag')),
+            33922: Element(_('Model Tiepoint Tag'), key='model_tiepoint'),
+            34264: Element(_('Model Transformation Tag'), key='model_transformation'),
             34377: Element(_('Photoshop'), 'photoshop'),
             34665: Element(_('Exif IFD Offset'), 'exif_ifd'),
             34675: Element(_('ICC Profile')),
             34732: Element(_('Image Layer')),
-            34735: Element(_('Geo Key Directory Tag')),
-            34736: Element(_('Geo Double Params Tag')),
-            34737: Element(_('Geo Ascii Params Tag')),
+            34735: Element(_('Geo Key Directory Tag'), key='geo_key_directory'),
+            34736: Element(_('Geo Double Params Tag'), key='geo_double_params'),
+            34737: Element(_('Geo Ascii Params Tag'), key='geo_ascii_params'),
             34850: Element(_('Exposure Program')),
             34852: Element(_('Spectral Sensitivity')),
             34853: Element(_('GPS'), 'gps'),
@@ -386,8 +618,13 @@ class TIFFHandler(MediaHandler):
 
         self._reads = None
         self._writes = None
+        self._write_base = 0
         self._offset_size = -1
         self._ifd_offsets = []
+        self._path = ''
+        
+        self.pages = None
+        """The TIFFPageIndex read by `read_index`"""
 
     @staticmethod
     def can_handle(filename):
@@ -429,25 +666,24 @@ class TIFFHandler(MediaHandler):
             return None
         
     def read_stream(self, ds, length=-1):
-        self.container = MediaContainer('image/tiff')
-
-        self._reads = ds
-        self._base = ds.tell()
-        self._reads_length = length
-        
         try:
-            ifd_offset = self._read_header()
+            ifd_offset = self._start_read(ds, length)
             
             while ifd_offset != 0:
                 if self._reads_length == -1 or ifd_offset < self._reads_length:
+                    self.logger.debug('TIFF: Reading IFD')
+                    table = self._read_ifd_table(ifd_offset)
+                    if table is None:
+                        break
+                    
                     self._media_entry = MediaEntry()
+                    self._media_entry.metadata = TIFFIFD(self, ifd_offset,
+                                                         self._elements,
+                                                         table[0])
                     self.container.entries.append(self._media_entry)
+                    self._read_sub_ifds(self._media_entry)
                     
-                    self.logger.debug('TIFF: Reading IFD')
-                    try:
-                        ifd_offset = self._read_ifd(self._media_entry.metadata, self._elements, ifd_offset)
-                    except StopIteration:
-                        break
+                    ifd_offset = table[1]
                 else:
                     self.logger.debug('TIFF: IFD offset past end of stream')
                     ifd_offset = 0
@@ -457,6 +693,69 @@ class TIFFHandler(MediaHandler):
             if self.filename != '':
                 raise TIFFError('%s reading file %s' % (exc.args[0], self.filename))
     
+    def read_index(self, ds, length=-1, cache=None):
+        """Read only the IFD offset and dimensions of each page, the pages
+        are then read one at a time with `page`.
+        
+        If `cache` is the name of a sidecar file, a valid index in it is
+        used rather than following the IFD chain and a newly built index is
+        saved to it.
+        """
+        
+        ifd_offset = self._start_read(ds, length)
+        
+        source_stat = None
+        if cache is not None:
+            source_stat = os.fstat(ds.fileno())
+            self.pages = TIFFPageIndex.load(cache, source_stat)
+            if self.pages is not None:
+                return self.pages
+        
+        self.pages = TIFFPageIndex()
+        seen = set()
+        while ifd_offset != 0 and ifd_offset not in seen:
+            if self._reads_length != -1 and ifd_offset >= self._reads_length:
+                self.logger.debug('TIFF: IFD offset past end of stream')
+                break
+            
+            table = self._read_ifd_table(ifd_offset)
+            if table is None:
+                break
+            
+            seen.add(ifd_offset)
+            values = {256: 0, 257: 0, 277: 1, 259: 1, 254: 0}
+            for entry in table[0]:
+                if entry[0] in values:
+                    value = self._inline_value(entry)
+                    if value is not None:
+                        values[entry[0]] = value
+            
+            self.pages.append(ifd_offset, values[256], values[257],
+                              values[277], values[259], values[254])
+            ifd_offset = table[1]
+        
+        if cache is not None:
+            self.pages.save(cache, source_stat)
+        return self.pages
+    
+    def page(self, number):
+        """Read the IFD of page `number` of the index read by `read_index`
+        into a MediaEntry"""
+        
+        if self.pages is None:
+            raise TIFFError('TIFF: No page index has been read')
+        
+        offset = self.pages.offsets[number]
+        table = self._read_ifd_table(offset)
+        if table is None:
+            raise TIFFError('IFD at offset %d is past the end of the stream' %
+                            offset)
+        
+        entry = MediaEntry()
+        entry.metadata = TIFFIFD(self, offset, self._elements, table[0])
+        self._read_sub_ifds(entry)
+        return entry
+    
     def write(self, image, filename=''):
         if filename == '' and self.filename != '':
             filename = self.filename
@@ -472,8 +771,23 @@ class TIFFHandler(MediaHandler):
             self.filename = ''
             
     def write_stream(self, ds, image):
-        for entry in image.entries:
-            self._write_ifd(entry)
+        raise TIFFError('TIFF: Images are written with '
+                        'mogul.media.tiff_writer.TIFFWriter')
+    
+    def _start_read(self, ds, length):
+        """Start reading the TIFF data at the current position of `ds`,
+        returns the offset of the first IFD"""
+        
+        self.container = MediaContainer('image/tiff')
+
+        self._reads = ds
+        self._base = ds.tell()
+        self._reads_length = length
+        
+        if self.filename != '':
+            self._path = self.filename
+        
+        return self._read_header()
     
     def _read_header(self):
         """Read the TIFF header to determine the endianness and offset to
@@ -503,52 +817,217 @@ class TIFFHandler(MediaHandler):
         else:
             raise TIFFError("Unknown TIFF Version number %d" % magic)
 
-        if self._offset_size == 4:
-            self._offset_format = 'L'
-        elif self._offset_size == 8:
-            self._offset_format = 'Q'
-        else:
+        if self._offset_size != 4 and self._offset_size != 8:
             raise TIFFError('Invalid TIFF offset size %d' % self._offset_size)
-
+        
+        self._set_format(self.endian, self.big)
         return self._read_offset()
+    
+    def _set_format(self, endian, big):
+        """Set up the structures used to read and write standard or Big
+        TIFF files"""
         
-    def _read_ifd(self, target, valid_tags, offset=-1):
-        """Read an IFD and any sub-IFDs"""
-
-        self._reads.seek(self._base + offset, os.SEEK_SET)
+        self.endian = endian
+        self.big = big
+        self._offset_size = 8 if big else 4
+        self._offset_format = 'Q' if big else 'L'
+        
+        self._offset_struct = struct.Struct('%s%s' % (self.endian,
+                                                      self._offset_format))
+        self._count_struct = struct.Struct('%s%s' % (self.endian,
+                                                     'Q' if self.big else 'H'))
+        # Tag, field type, count and the value or offset to it
+        self._entry_struct = struct.Struct('%sHH%s%ds' % (self.endian,
+            self._offset_format, self._offset_size))
+        
+    def _read_ifd_table(self, offset):
+        """Read the entry table of an IFD in one go.
+        
+        Returns a list of (tag, field type, count, value) entries and the
+        offset of the next IFD, or None at the end of the stream."""
 
-        if not self.big:
-            data = self._reads.read(2)
-            if len(data) == 0:
-                raise StopIteration
-            count = struct.unpack('%sH' % self.endian, data)[0]
-        else:
-            data = self._reads.read(8)
+        with self._stream() as ds:
+            ds.seek(self._base + offset, os.SEEK_SET)
+    
+            data = ds.read(self._count_struct.size)
             if len(data) == 0:
-                raise StopIteration
-            count = struct.unpack('%sQ' % self.endian, data)[0]
+                return None
+            count = self._count_struct.unpack(data)[0]
+            table_size = count * self._entry_struct.size
+            
+            # A corrupt Big TIFF count could ask for an enormous read
+            table_start = offset + self._count_struct.size
+            if self._reads_length != -1:
+                remaining = self._reads_length - table_start
+            else:
+                remaining = ds.seek(0, os.SEEK_END) - self._base - table_start
+                ds.seek(self._base + table_start, os.SEEK_SET)
+            if table_size > remaining:
+                raise TIFFError('IFD at offset %d is truncated' % offset)
+            
+            data = ds.read(table_size + self._offset_size)
+        
+        if len(data) < table_size:
+            raise TIFFError('IFD at offset %d is truncated' % offset)
         
-        for _x in range(count):
-            self._read_ifd_entry(target, valid_tags)
+        entries = list(self._entry_struct.iter_unpack(data[:table_size]))
 
-        return self._read_offset()
+        if len(data) < table_size + self._offset_size:
+            return (entries, 0)
+        return (entries, self._offset_struct.unpack_from(data, table_size)[0])
     
-    def _read_ifd_entry(self, target, valid_tags):
-        """Read a single entry from an IFD"""
+    def _inline_value(self, entry):
+        """The first value of an integer IFD entry whose values are stored
+        in the entry, or None"""
         
-        tag, field_type = \
-            struct.unpack('%sHH' % self.endian, self._reads.read(4))
-
-        if not self.big:
-            count = struct.unpack('%sL' % self.endian, self._reads.read(4))[0]
+        tag, field_type, count, data = entry
+        if field_type not in (1, 3, 4, 13, 16) or count == 0 or \
+                TIFF_FieldSizes[field_type] * count > self._offset_size:
+            return None
+        return struct.unpack_from('%s%s' % (self.endian,
+                                            TIFF_FieldFormats[field_type]),
+                                  data)[0]
+    
+    def _read_sub_ifds(self, entry):
+        sub_ifds = entry.metadata.get(330, None)
+        if sub_ifds is None:
+            return
+        
+        self.logger.debug('TIFF: Reading Sub IFD')
+        for ifd in sub_ifds:
+            sub_entry = MediaEntry()
+            sub_entry.metadata = ifd
+            entry.subentries.append(sub_entry)
+    
+    def _read_values(self, entries):
+        """Decode the values of a list of (tag, field type, count, value)
+        IFD entries"""
+        
+        values = [None] * len(entries)
+        ranges = []
+        for idx, (tag, field_type, count, raw) in enumerate(entries):
+            try:
+                size = TIFF_FieldSizes[field_type]
+            except KeyError:
+                self.logger.debug('TIFF: Unknown field type %d' % field_type)
+                continue
+            
+            length = size * count
+            if self._reads_length != -1 and length > self._reads_length:
+                raise TIFFError(('Count too high. Data stream not long enough to '
+                                 'hold %d items') % count)
+            
+            if length <= self._offset_size:
+                values[idx] = self._decode_value(tag, field_type, count,
+                                                 raw[:length])
+            else:
+                ranges.append((self._offset_struct.unpack(raw)[0], length, idx))
+        
+        for idx, data in self._read_ranges(ranges):
+            tag, field_type, count, _raw = entries[idx]
+            values[idx] = self._decode_value(tag, field_type, count, data)
+        
+        return values
+    
+    def _read_ranges(self, ranges):
+        """Read a list of (offset, length, key) ranges, merging those which
+        are close together into a single read.
+        
+        Returns a list of (key, data) tuples."""
+        
+        result = []
+        if len(ranges) == 0:
+            return result
+        
+        run = []
+        run_start = run_end = 0
+        with self._stream() as ds:
+            for offset, length, key in sorted(ranges) + [(None, 0, None)]:
+                if offset is not None and len(run) > 0 and \
+                        offset <= run_end + TIFF_MergeGap:
+                    run.append((offset, length, key))
+                    run_end = max(run_end, offset + length)
+                    continue
+                
+                if len(run) > 0:
+                    ds.seek(self._base + run_start, os.SEEK_SET)
+                    data = ds.read(run_end - run_start)
+                    for run_offset, run_length, run_key in run:
+                        pos = run_offset - run_start
+                        result.append((run_key, data[pos:pos + run_length]))
+                
+                run = [(offset, length, key)]
+                run_start = offset
+                run_end = (offset or 0) + length
+        
+        return result
+    
+    @contextmanager
+    def _stream(self):
+        """The stream being read or, once it has been closed, the file it
+        was opened from"""
+        
+        if self._reads is not None and not self._reads.closed:
+            yield self._reads
+        elif self._path != '':
+            with open(self._path, 'rb') as ds:
+                yield ds
         else:
-            count = struct.unpack('%sQ' % self.endian, self._reads.read(8))[0]
+            raise TIFFError('The stream the TIFF data was read from is closed')
+    
+    def _decode_value(self, tag, field_type, count, data):
+        if len(data) < TIFF_FieldSizes[field_type] * count:
+            self.logger.debug('TIFF: 0x%04X - Value past end of stream' % tag)
+            return None
+        
+        # String
+        if field_type == 2:
+            if data[-1:] == b'\x00':
+                data = data[:-1]
+            return data.decode('UTF-8', 'replace')
+        
+        # Undefined
+        elif field_type == 7:
+            return data
+        
+        # Numerator + denominator
+        elif field_type == 5 or field_type == 10:
+            values = struct.unpack('%s%d%s' % (self.endian, count * 2,
+                                               TIFF_FieldFormats[field_type]),
+                                   data)
+            value = tuple([_rational(values[idx], values[idx + 1])
+                           for idx in range(0, len(values), 2)])
+            if count == 1:
+                value = value[0]
+            return value
+        
+        elif tag in TIFF_ArrayTags and count > 1 and \
+                field_type in (3, 4, 13, 16, 18):
+            value = array(TIFF_ArrayTypes[TIFF_FieldSizes[field_type]], data)
+            if self.endian != _native_endian:
+                value.byteswap()
+            return value
+        
+        return struct.unpack('%s%d%s' % (self.endian, count,
+                                         TIFF_FieldFormats[field_type]), data)
+    
+    def _tag_key(self, tag, valid_tags):
+        try:
+            key = valid_tags[tag].key
+        except:
+            key = None
+            
+        if key is None:
+            key = tag
+        return key
+    
+    def _finish_value(self, tag, value, valid_tags):
+        """Transform a decoded value as described by `valid_tags`"""
         
-        value = self._read_value(field_type, count)
         if value is None:
-            return
-
-        if isinstance(value, (tuple, list)) and len(value) == 1:
+            return None
+        
+        if isinstance(value, (tuple, list, array)) and len(value) == 1:
             value = value[0]
 
         value = self._transform_value_after_read(value, tag, valid_tags)
@@ -568,234 +1047,6 @@ class TIFFHandler(MediaHandler):
         else:
             self.logger.debug('TIFF: 0x%04X - %s' % (tag, tag_name))
         
-        try:
-            key = valid_tags[tag].key
-        except:
-            key = None
-            
-        if key is None:
-            key = tag
-            
-        if key in target: 
-            self.logger.debug('TIFF: Repeated tag 0x%04X' % tag)
-            
-            if not isinstance(target[key], list):
-                target[key] = [target[key], value]
-        else:
-            target[key] = value
-    
-    def _read_value(self, field_type, count):
-        value = None
-        
-        # Byte
-        if field_type == 1 or field_type == 6 or field_type == 7:
-            if self._reads_length != -1 and count > self._reads_length:
-                raise TIFFError(('Count too high. Data stream not long enough to '
-                                 'hold %d items') % count)
-            
-            if field_type == 1 or field_type == 7:
-                format_char = 'B'
-            else:
-                format_char = 'b'
-                
-            if (self.big and count <= 8) or count <= 4:
-                value = struct.unpack('%d%s' % (count, format_char),
-                    self._reads.read(count))
-                
-                if not self.big:
-                    self._reads.seek(4 - count, os.SEEK_CUR)
-                else:
-                    self._reads.seek(8 - count, os.SEEK_CUR)
-            else:
-                offset = self._read_offset()
-                pos = self._reads.tell()
-                self._reads.seek(self._base + offset, os.SEEK_SET)
-                value = struct.unpack('%s%d%s' % (self.endian, count,
-                    format_char), self._reads.read(count))
-                self._reads.seek(pos, os.SEEK_SET)
-            
-        # String
-        elif field_type == 2:
-            if self._reads_length != -1 and count > self._reads_length:
-                raise TIFFError(('Count too high. Data stream not long enough to '
-                                 'hold %d items') % count)
-            
-            if (self.big and count <= 8) or count <= 4:
-                value = str(self._reads.read(count))[:-1]
-                
-                if not self.big:
-                    self._reads.seek(4 - count, os.SEEK_CUR)
-                else:
-                    self._reads.seek(8 - count, os.SEEK_CUR)
-            else:
-                offset = self._read_offset()
-                pos = self._reads.tell()
-                self._reads.seek(self._base + offset, os.SEEK_SET)
-                value = self._reads.read(count)[:-1]
-                value = value.decode('UTF-8')
-                self._reads.seek(pos, os.SEEK_SET)
-               
-        # Word 
-        elif field_type == 3 or field_type == 8:
-            if self._reads_length != -1 and count > (self._reads_length / 2):
-                raise TIFFError(('Count too high. Data stream not long enough to '
-                                 'hold %d items') % count)
-            
-            if field_type == 3:
-                format_char = 'H'
-            else:
-                format_char = 'h'
-                
-            if (self.big and count <= 4) or count <= 2:
-                value = struct.unpack('%s%d%s' % (self.endian, count,
-                    format_char), self._reads.read(2*count))
-                
-                if not self.big:
-                    self._reads.seek(4 - count*2, os.SEEK_CUR)
-                else:
-                    self._reads.seek(8 - count*2, os.SEEK_CUR)
-                
-            else:
-                offset = self._read_offset()
-                pos = self._reads.tell()
-                self._reads.seek(self._base + offset, os.SEEK_SET)
-                value = struct.unpack('%s%d%s' % (self.endian, count,
-                    format_char), self._reads.read(2*count))
-                self._reads.seek(pos, os.SEEK_SET)
-        
-        # Long
-        elif field_type == 4 or field_type == 9:
-            if self._reads_length != -1 and count > (self._reads_length / 4):
-                raise TIFFError(('Count too high. Data stream not long enough to '
-                                 'hold %d items') % count)
-            
-            if field_type == 4:
-                format_char = 'L'
-            else:
-                format_char = 'l'
-                
-            if (self.big and count <= 2) or count == 1:
-                value = struct.unpack('%s%d%s' % (self.endian, count,
-                    format_char), self._reads.read(4*count))
-                
-                if self.big and count == 1:
-                    self._reads.seek(4, os.SEEK_CUR)
-            else:
-                offset = self._read_offset()
-                pos = self._reads.tell()
-                self._reads.seek(self._base + offset, os.SEEK_SET)
-                try:
-                    value = struct.unpack('%s%d%s' % (self.endian, count,
-                        format_char), self._reads.read(4*count))
-                except OverflowError:
-                    pass
-                self._reads.seek(pos, os.SEEK_SET)
-                
-        # Numerator + denominator
-        elif field_type == 5 or field_type == 10:
-            if self._reads_length != -1 and count > (self._reads_length / 8):
-                raise TIFFError(('Count too high. Data stream not long enough to '
-                                 'hold %d items') % count)
-            
-            if field_type == 5:
-                format_char = 'L'
-            else:
-                format_char = 'l'
-                
-            if self.big and count == 1:
-                value = self._read_rational(format_char)
-            else:
-                offset = self._read_offset()
-                pos = self._reads.tell()
-                self._reads.seek(self._base + offset, os.SEEK_SET)
-                if count == 1:
-                    value = self._read_rational(format_char)
-                else:
-                    value = []
-                    for _idx in range(count):
-                        value.append(self._read_rational(format_char))
-                    value = tuple(value)
-                self._reads.seek(pos, os.SEEK_SET)
-        
-        # 4 byte float
-        elif field_type == 11:
-            if self._reads_length != -1 and count > (self._reads_length / 4):
-                raise TIFFError(('Count too high. Data stream not long enough to '
-                                 'hold %d items') % count)
-            
-            if (self.big and count <= 2) or count == 1:
-                value = struct.unpack('%s%df' % (self.endian, count),
-                    self._reads.read(4*count))
-                
-                if self.big and count == 1:
-                    self._reads.seek(4, os.SEEK_CUR)
-            else:
-                offset = self._read_offset()
-                pos = self._reads.tell()
-                self._reads.seek(self._base + offset, os.SEEK_SET)
-                value = struct.unpack('%s%df' % (self.endian, count),
-                    self._reads.read(4*count))
-                self._reads.seek(pos, os.SEEK_SET)
-        
-        # 8 byte double
-        elif field_type == 12:
-            if self._reads_length != -1 and count > (self._reads_length / 8):
-                raise TIFFError(('Count too high. Data stream not long enough to '
-                                 'hold %d items') % count)
-            
-            if (self.big and count == 1):
-                value = struct.unpack('%sd' % self.endian, self._reads.read(8))
-            else:
-                offset = self._read_offset()
-                pos = self._reads.tell()
-                self._reads.seek(self._base + offset, os.SEEK_SET)
-                value = struct.unpack('%s%dd' % (self.endian, count),
-                    self._reads.read(8*count))
-                self._reads.seek(pos, os.SEEK_SET)
-
-        # 32 bit Sub IFD
-        elif field_type == 13:
-            value = struct.unpack('%s%dL' % (self.endian, count),
-                self._reads.read(4*count))
-        
-        # Unicode
-        elif field_type == 14:
-            self.logger.debug("TIFF: Don't know how to handle Unicode field types") 
-        
-        # Complex
-        elif field_type == 15:
-            self.logger.debug("TIFF: Don't know how to handle Complex field types") 
-        
-        # Quad word
-        elif field_type == 16 or field_type == 17:
-            if self._reads_length != -1 and count > (self._reads_length / 16):
-                raise TIFFError(('Count too high. Data stream not long enough to '
-                                 'hold %d items') % count)
-            
-            if field_type == 16:
-                format_char = 'Q'
-            else:
-                format_char = 'q'
-                
-            if (self.big and count == 1):
-                value = struct.unpack('%s%s' % (self.endian, format_char),
-                    self._reads.read(8))
-            else:
-                offset = self._read_offset()
-                pos = self._reads.tell()
-                self._reads.seek(self._base + offset, os.SEEK_SET)
-                value = struct.unpack('%s%d%s' % (self.endian, count,
-                    format_char), self._reads.read(8*count))
-                self._reads.seek(pos, os.SEEK_SET)
-
-        # 64 bit Sub IFD
-        elif field_type == 18:
-            value = struct.unpack('%s%dQ' % (self.endian, count),
-                self._reads.read(8 * count))[0]
-            
-        else:
-            self.logger.debug('TIFF: Unknown field type %d' % field_type)
-                
         return value
     
     def _transform_value_after_read(self, value, tag, valid_tags):
@@ -831,25 +1082,11 @@ class TIFFHandler(MediaHandler):
             value = datetime.strptime(str(value).strip(), '%H:%M')
         
         elif read_transform == 'i14y':
-            info = {}
-            pos = self._reads.tell()
-            
-            self._read_ifd(info, self.__i14y_tags, value)
-            
-            self._reads.seek(pos, os.SEEK_SET)
-            value = info
+            value = TIFFIFD(self, value, self.__i14y_tags)
         
         elif read_transform == 'gps':
-            self.logger.debug('TIFF: Reading GPS Tags')
-
-            info = {}
-            pos = self._reads.tell()
-            
             # The tag value is an offset to the GPS data
-            self._read_ifd(info, self.__gps_tags, value)
-
-            self._reads.seek(pos, os.SEEK_SET)
-            value = info
+            value = TIFFIFD(self, value, self.__gps_tags)
         
         elif read_transform == 'gpsdate':
             try:
@@ -861,29 +1098,12 @@ class TIFFHandler(MediaHandler):
             pass
         
         elif read_transform == 'exif_ifd':
-            self.logger.debug('TIFF: Reading Exif IFD')
-
-            pos = self._reads.tell()
-            info = {}
-            self._read_ifd(info, self._elements, offset=value)
-            self._reads.seek(pos, os.SEEK_SET)
-            value = info
+            value = TIFFIFD(self, value, self._elements)
 
         elif read_transform == 'subifd':
-            self.logger.debug('TIFF: Reading Sub IFD')
-
-            pos = self._reads.tell()                
-            entry = MediaEntry()
-            self._media_entry.subentries.append(entry)
-            
-            if isinstance(value, (list, tuple)):
-                for offset in value:
-                    self._read_ifd(entry.metadata, self._elements, offset)
-            else:
-                self._read_ifd(entry.metadata, self._elements, value)
-                
-            self._reads.seek(pos, os.SEEK_SET)
-            value = None
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            value = [TIFFIFD(self, offset, self._elements) for offset in value]
                 
         elif read_transform == 'xmp':
             self.logger.debug('TIFF:     Reading XMP')
@@ -895,14 +1115,6 @@ class TIFFHandler(MediaHandler):
                 
         elif read_transform == 'iptc':
             self.logger.debug('TIFF:     Reading IPTC')
-
-            pos = self._reads.tell()                
-
-            if isinstance(value, (list, tuple)):
-                for offset in value:
-                    self._reads.seek(self._base + offset, os.SEEK_SET)
-
-            self._reads.seek(pos, os.SEEK_SET)
                 
         elif read_transform == 'photoshop':
             self.logger.debug('TIFF:     Reading Photoshop IRBs')
@@ -936,35 +1148,106 @@ class TIFFHandler(MediaHandler):
         return struct.unpack(format_string,
                              self._reads.read(self._offset_size))[0]
 
-    def _read_rational(self, format_char):
-        format_string = '%s%s%s' % (self.endian, format_char, format_char)
-        numerator, denominator = struct.unpack(format_string,
-            self._reads.read(8))
-        if denominator == 0:
-            return '0'
-        else:
-            return '%d/%d' % (numerator, denominator)
-        
     def _build_image(self):
         image = Image('image/tiff')
         #for tag, value in self.metadata.items():
         #    pass
         return image
 
-    def _write_header(self, endian='<'):
-        pass
+    def _write_header(self, endian='<', big=False, ifd_offset=0):
+        """Write the header at `_write_base` in the output stream.
+        
+        A standard header is padded to the size of a Big TIFF header so
+        that the header can be rewritten as either once the size of the
+        file is known."""
+        
+        self._set_format(endian, big)
+        
+        bom = b'\x49\x49' if endian == '<' else b'\x4d\x4d'
+        if big:
+            header = bom + struct.pack('%sHHHQ' % endian, 43, 8, 0, ifd_offset)
+        else:
+            header = bom + struct.pack('%sHL' % endian, 42, ifd_offset) + \
+                b'\x00' * 8
+        
+        self._writes.seek(self._write_base, os.SEEK_SET)
+        self._writes.write(header)
 
-    def _write_ifd(self, entry):
-        pass
+    def _write_ifd(self, tags, next_offset=0):
+        """Write an IFD for a list of (tag, field type, values) at the end
+        of the output stream, the values stored out of line follow its entry
+        table.
+        
+        Returns the offset of the IFD and of its next IFD pointer."""
+        
+        ds = self._writes
+        ds.seek(0, os.SEEK_END)
+        if (ds.tell() - self._write_base) % 2:
+            ds.write(b'\x00')
+        offset = ds.tell() - self._write_base
+        
+        tags = sorted(tags, key=lambda tag: tag[0])
+        table_size = self._count_struct.size + \
+            len(tags) * self._entry_struct.size + self._offset_size
+        
+        values = []
+        value_offset = offset + table_size
+        ds.write(self._count_struct.pack(len(tags)))
+        for tag, field_type, value in tags:
+            count, data = self._write_value(field_type, value)
+            if len(data) <= self._offset_size:
+                data = data.ljust(self._offset_size, b'\x00')
+            else:
+                if len(data) % 2:
+                    data += b'\x00'
+                values.append(data)
+                data = self._offset_struct.pack(value_offset)
+                value_offset += len(values[-1])
+            self._write_ifd_entry(tag, field_type, count, data)
+        
+        self._write_offset(next_offset)
+        for data in values:
+            ds.write(data)
+        
+        return (offset, offset + table_size - self._offset_size)
 
-    def _write_ifd_entry(self):
-        pass
+    def _write_ifd_entry(self, tag, field_type, count, data):
+        self._writes.write(self._entry_struct.pack(tag, field_type, count,
+                                                   data))
 
     def _transform_value_before_write(self):
         pass
 
-    def _write_value(self, field_type, count, value):
-        pass
+    def _write_value(self, field_type, value):
+        """The count and the bytes of a value to be written"""
+        
+        # String
+        if field_type == 2:
+            if not isinstance(value, bytes):
+                value = value.encode('UTF-8')
+            data = value + b'\x00'
+            return (len(data), data)
+        
+        # Undefined
+        elif field_type == 7:
+            data = bytes(value)
+            return (len(data), data)
+        
+        elif isinstance(value, (int, float)):
+            value = [value]
+        
+        # Numerator + denominator
+        if field_type == 5 or field_type == 10:
+            value = [int(part) for pair in value for part in pair]
+            return (len(value) // 2,
+                    struct.pack('%s%d%s' % (self.endian, len(value),
+                                            TIFF_FieldFormats[field_type]),
+                                *value))
+        
+        return (len(value),
+                struct.pack('%s%d%s' % (self.endian, len(value),
+                                        TIFF_FieldFormats[field_type]),
+                            *value))
     
     def _write_offset(self, offset):
         format_string = '%s%s' % (self.endian, self._offset_format)
@@ -0,0 +1,254 @@
+# Copyright (c) 2015 Simon Kennedy <sffjunkie+code@gmail.com>
+
+"""GeoTIFF georeferencing and overview aware reads.
+
+The GeoKey directory is decoded from the GeoTIFF tags of an IFD. Reads of
+an area given in model coordinates use the smallest overview which has the
+resolution asked for, and only the tiles of that overview which cover the
+area are read.
+"""
+
+import math
+
+from mogul.media.tiff import TIFFError
+from mogul.media.tiff_region import TIFFRegionReader, _first, _list
+
+__all__ = ['GEO_KEYS', 'GeoTIFFReader', 'geotiff_keys']
+
+GEO_KEYS = {
+    1024: 'model_type',
+    1025: 'raster_type',
+    1026: 'citation',
+    2048: 'geographic_type',
+    2049: 'geog_citation',
+    2050: 'geog_geodetic_datum',
+    2051: 'geog_prime_meridian',
+    2052: 'geog_linear_units',
+    2053: 'geog_linear_unit_size',
+    2054: 'geog_angular_units',
+    2055: 'geog_angular_unit_size',
+    2056: 'geog_ellipsoid',
+    2057: 'geog_semi_major_axis',
+    2058: 'geog_semi_minor_axis',
+    2059: 'geog_inv_flattening',
+    2061: 'geog_prime_meridian_long',
+    3072: 'projected_cs_type',
+    3073: 'pcs_citation',
+    3074: 'projection',
+    3075: 'proj_coord_trans',
+    3076: 'proj_linear_units',
+    3077: 'proj_linear_unit_size',
+    4096: 'vertical_cs_type',
+    4097: 'vertical_citation',
+    4098: 'vertical_datum',
+    4099: 'vertical_units',
+}
+
+GEO_DOUBLE_PARAMS = 34736
+GEO_ASCII_PARAMS = 34737
+GEO_KEY_DIRECTORY = 34735
+
+RASTER_PIXEL_IS_POINT = 2
+
+SUBFILE_REDUCED_RESOLUTION = 1
+SUBFILE_MASK = 4
+PHOTOMETRIC_MASK = 4
+
+
+def geotiff_keys(metadata):
+    """Decode the GeoKey directory of an IFD's metadata into a dictionary
+    keyed by the names in GEO_KEYS, or the key number for unknown keys"""
+
+    directory = metadata.get('geo_key_directory', None)
+    if directory is None:
+        return {}
+
+    directory = _list(directory)
+    if len(directory) < 4:
+        raise TIFFError('TIFF: GeoKey directory is truncated')
+
+    doubles = _list(metadata.get('geo_double_params', ()))
+    ascii = metadata.get('geo_ascii_params', '')
+
+    keys = {}
+    for idx in range(4, min(4 + directory[3] * 4, len(directory) - 3), 4):
+        key_id, location, count, value = directory[idx:idx + 4]
+        if location == 0:
+            pass
+        elif location == GEO_DOUBLE_PARAMS:
+            value = tuple(doubles[value:value + count])
+            if count == 1 and len(value) == 1:
+                value = value[0]
+        elif location == GEO_ASCII_PARAMS:
+            # Strings are terminated with a '|'
+            value = ascii[value:value + count].rstrip('|\x00')
+        elif location == GEO_KEY_DIRECTORY:
+            value = tuple(directory[value:value + count])
+        else:
+            continue
+
+        keys[GEO_KEYS.get(key_id, key_id)] = value
+    return keys
+
+
+class GeoTIFFReader(object):
+    """Read areas of a GeoTIFF file read by a TIFFHandler.
+
+    The full resolution image is the first image in the IFD chain which is
+    not a reduced resolution image or a transparency mask. Its overviews
+    are the reduced resolution images in the IFD chain and their Sub IFDs.
+    """
+
+    def __init__(self, handler):
+        self._handler = handler
+
+        entries = []
+        for entry in handler.container.entries:
+            entries.append(entry)
+            entries.extend(entry.subentries)
+
+        full = None
+        overviews = []
+        for entry in entries:
+            metadata = entry.metadata
+            subfile_type = _first(metadata.get('subfile_type', 0))
+            if subfile_type & SUBFILE_MASK or \
+                    _first(metadata.get('photometric_interpretation',
+                                        0)) == PHOTOMETRIC_MASK:
+                continue
+            if subfile_type & SUBFILE_REDUCED_RESOLUTION:
+                overviews.append(entry)
+            elif full is None:
+                full = entry
+
+        if full is None:
+            raise TIFFError('TIFF: No full resolution image found')
+
+        self.levels = [TIFFRegionReader(handler, entry)
+                       for entry in overviews]
+        self.levels.sort(key=lambda level: level.width, reverse=True)
+        self.levels.insert(0, TIFFRegionReader(handler, full))
+        """Region readers for the full resolution image then its overviews,
+        largest first"""
+
+        self.keys = geotiff_keys(full.metadata)
+        self.transform = self._geo_transform(full.metadata)
+        """(a, b, c, d, e, f) mapping the column and row of a full
+        resolution pixel's corner to x = a*col + b*row + c and
+        y = d*col + e*row + f"""
+
+    @property
+    def resolution(self):
+        """Size of a full resolution pixel in model units"""
+
+        a, b, _c, d, e, _f = self.transform
+        return (math.hypot(a, d), math.hypot(b, e))
+
+    def level_resolution(self, level):
+        """Size of a pixel of the image `level` in model units"""
+
+        full = self.levels[0]
+        res_x, res_y = self.resolution
+        return (res_x * full.width / float(level.width),
+                res_y * full.height / float(level.height))
+
+    def select_level(self, resolution=None):
+        """The smallest image whose pixels are no larger than `resolution`
+        model units, or the full resolution image when none are"""
+
+        if resolution is None:
+            return self.levels[0]
+
+        selected = self.levels[0]
+        for level in self.levels[1:]:
+            if max(self.level_resolution(level)) <= resolution:
+                selected = level
+        return selected
+
+    def window(self, bbox, level=None):
+        """The (x, y, width, height) pixel window of `level` which covers
+        the (min x, min y, max x, max y) model bounding box `bbox`"""
+
+        if level is None:
+            level = self.levels[0]
+
+        full = self.levels[0]
+        scale_x = full.width / float(level.width)
+        scale_y = full.height / float(level.height)
+
+        min_x, min_y, max_x, max_y = bbox
+        columns = []
+        rows = []
+        for x, y in ((min_x, min_y), (min_x, max_y), (max_x, min_y),
+                     (max_x, max_y)):
+            column, row = self.model_to_pixel(x, y)
+            columns.append(column / scale_x)
+            rows.append(row / scale_y)
+
+        x0 = max(int(math.floor(min(columns))), 0)
+        y0 = max(int(math.floor(min(rows))), 0)
+        x1 = min(int(math.ceil(max(columns))), level.width)
+        y1 = min(int(math.ceil(max(rows))), level.height)
+        if x1 <= x0 or y1 <= y0:
+            raise TIFFError('TIFF: Bounding box is outside the image')
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    def read_bbox(self, bbox, resolution=None, workers=None):
+        """Read the pixels covering the (min x, min y, max x, max y) model
+        bounding box `bbox` from the smallest image whose pixels are no
+        larger than `resolution` model units.
+
+        Returns the pixel array and the model (x, y) of its top left corner.
+        """
+
+        level = self.select_level(resolution)
+        x, y, width, height = self.window(bbox, level)
+        pixels = level.read_region(x, y, width, height, workers)
+
+        full = self.levels[0]
+        corner = self.pixel_to_model(x * full.width / float(level.width),
+                                     y * full.height / float(level.height))
+        return pixels, corner
+
+    def pixel_to_model(self, column, row):
+        a, b, c, d, e, f = self.transform
+        return (a * column + b * row + c, d * column + e * row + f)
+
+    def model_to_pixel(self, x, y):
+        a, b, c, d, e, f = self.transform
+        determinant = a * e - b * d
+        if determinant == 0:
+            raise TIFFError('TIFF: Model transformation is not invertible')
+
+        x -= c
+        y -= f
+        return ((e * x - b * y) / determinant, (a * y - d * x) / determinant)
+
+    def _geo_transform(self, metadata):
+        matrix = metadata.get('model_transformation', None)
+        if matrix is not None:
+            matrix = _list(matrix)
+            if len(matrix) < 8:
+                raise TIFFError('TIFF: Model transformation is truncated')
+            transform = (matrix[0], matrix[1], matrix[3],
+                         matrix[4], matrix[5], matrix[7])
+        else:
+            scale = metadata.get('model_pixel_scale', None)
+            tiepoint = metadata.get('model_tiepoint', None)
+            if scale is None or tiepoint is None:
+                raise TIFFError('TIFF: Image is not georeferenced')
+
+            scale = _list(scale)
+            tiepoint = _list(tiepoint)
+            if len(scale) < 2 or len(tiepoint) < 6:
+                raise TIFFError('TIFF: Georeferencing tags are truncated')
+
+            column, row, _k, x, y, _z = tiepoint[:6]
+            transform = (scale[0], 0.0, x - column * scale[0],
+                         0.0, -scale[1], y + row * scale[1])
+
+        if self.keys.get('raster_type', None) == RASTER_PIXEL_IS_POINT:
+            # The transform maps to pixel centres
+            a, b, c, d, e, f = transform
+            transform = (a, b, c - (a + b) / 2.0, d, e, f - (d + e) / 2.0)
+        return transform
@@ -0,0 +1,195 @@
+# Copyright (c) 2015 Simon Kennedy <sffjunkie+code@gmail.com>
+
+"""Embedded JPEG previews of TIFF based camera RAW files.
+
+Canon CR2, Nikon NEF, Sony ARW and Adobe DNG files store one or more JPEG
+previews alongside the raw sensor data. The previews are found by reading
+only the entry tables of the IFD chain and its Sub IFDs, taking the size
+and offset of each JPEG from the entries' inline values. The largest is
+returned as a range of the file which can be read or mapped without
+copying.
+"""
+
+import os
+import mmap
+import struct
+from collections import namedtuple
+
+from mogul.media.tiff import TIFFHandler, TIFFError
+
+__all__ = ['RAWPreview', 'raw_format', 'raw_preview', 'raw_preview_view']
+
+RAWPreview = namedtuple('RAWPreview', "offset size")
+"""Offset in the stream and size of an embedded JPEG"""
+
+RAW_MIMETYPES = {
+    'cr2': 'image/x-canon-cr2',
+    'nef': 'image/x-nikon-nef',
+    'arw': 'image/x-sony-arw',
+    'dng': 'image/x-adobe-dng',
+}
+
+COMPRESSION_OLD_JPEG = 6
+COMPRESSION_JPEG = 7
+
+# Photometric interpretations of raw sensor data
+PHOTOMETRIC_CFA = 32803
+PHOTOMETRIC_LINEAR_RAW = 34892
+
+COMPRESSION_NIKON_NEF = 34713
+
+SUB_IFDS_TAG = 330
+DNG_VERSION_TAG = 50706
+CR2_SLICES_TAG = 50752
+
+# Largest number of IFDs visited, to stop at loops in corrupt files
+MAX_IFDS = 64
+
+
+def raw_format(ds):
+    """The mimetype of the camera RAW file in the stream `ds`, or None if
+    it is not one of the RAW formats in RAW_MIMETYPES"""
+
+    handler = TIFFHandler()
+    try:
+        ifd_offset = handler._start_read(ds, -1)
+    except (TIFFError, struct.error):
+        return None
+
+    return _raw_format(handler, ifd_offset)
+
+
+def raw_preview(ds):
+    """The largest embedded JPEG of the camera RAW file in the stream `ds`
+    as a RAWPreview, or None if there is none"""
+
+    start = ds.tell()
+    handler = TIFFHandler()
+    try:
+        ifd_offset = handler._start_read(ds, -1)
+    except (TIFFError, struct.error):
+        return None
+
+    candidates = []
+    offsets = [ifd_offset]
+    visited = set()
+    while len(offsets) > 0 and len(visited) < MAX_IFDS:
+        ifd_offset = offsets.pop(0)
+        if ifd_offset == 0 or ifd_offset in visited:
+            continue
+        visited.add(ifd_offset)
+
+        table = handler._read_ifd_table(ifd_offset)
+        if table is None:
+            continue
+
+        entries, next_offset = table
+        candidates.extend(_jpeg_ranges(handler, entries))
+        offsets.extend(_sub_ifd_offsets(handler, entries))
+        offsets.append(next_offset)
+
+    # Largest first, checking each starts with a JPEG Start Of Image marker
+    for offset, size in sorted(set(candidates), key=lambda c: c[1],
+                               reverse=True):
+        ds.seek(start + offset, os.SEEK_SET)
+        if ds.read(2) == b'\xFF\xD8':
+            return RAWPreview(start + offset, size)
+    return None
+
+
+def raw_preview_view(filename):
+    """A memoryview of the largest embedded JPEG in the file `filename`
+    which shares the memory of a map of the file, or None"""
+
+    with open(filename, 'rb') as ds:
+        preview = raw_preview(ds)
+        if preview is None:
+            return None
+
+        data = mmap.mmap(ds.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return memoryview(data)[preview.offset:preview.offset + preview.size]
+
+
+def _raw_format(handler, ifd_offset):
+    ds = handler._reads
+    ds.seek(handler._base + 8, os.SEEK_SET)
+    if ds.read(2) == b'CR':
+        return RAW_MIMETYPES['cr2']
+
+    table = handler._read_ifd_table(ifd_offset)
+    if table is None:
+        return None
+
+    entries = dict([(entry[0], entry) for entry in table[0]])
+    if DNG_VERSION_TAG in entries:
+        return RAW_MIMETYPES['dng']
+
+    # TIFF and JPEG files written by cameras also have a Make tag so
+    # NEF and ARW files must hold raw sensor data as well
+    if 271 in entries and _has_raw_data(handler, table[0]):
+        make = handler._read_values([entries[271]])[0]
+        if isinstance(make, str):
+            make = make.strip().upper()
+            if make.startswith('NIKON'):
+                return RAW_MIMETYPES['nef']
+            elif make.startswith('SONY'):
+                return RAW_MIMETYPES['arw']
+    return None
+
+
+def _has_raw_data(handler, entries):
+    """Whether IFD 0 or one of its Sub IFDs holds raw sensor data"""
+
+    tables = [entries]
+    for offset in _sub_ifd_offsets(handler, entries)[:MAX_IFDS]:
+        table = handler._read_ifd_table(offset)
+        if table is not None:
+            tables.append(table[0])
+
+    for table in tables:
+        for entry in table:
+            if entry[2] != 1:
+                continue
+            if entry[0] == 259 and \
+                    handler._inline_value(entry) == COMPRESSION_NIKON_NEF:
+                return True
+            elif entry[0] == 262 and handler._inline_value(entry) in \
+                    (PHOTOMETRIC_CFA, PHOTOMETRIC_LINEAR_RAW):
+                return True
+    return False
+
+
+def _jpeg_ranges(handler, entries):
+    """(offset, size) of the JPEGs described by an IFD's entries"""
+
+    values = {}
+    for entry in entries:
+        if entry[0] in (259, 262, 273, 279, 513, 514):
+            if entry[2] == 1:
+                values[entry[0]] = handler._inline_value(entry)
+        elif entry[0] == CR2_SLICES_TAG:
+            # The raw data of a CR2 file
+            return []
+
+    ranges = []
+    if values.get(513) and values.get(514):
+        ranges.append((values[513], values[514]))
+
+    if values.get(259) in (COMPRESSION_OLD_JPEG, COMPRESSION_JPEG) and \
+            values.get(262) not in (PHOTOMETRIC_CFA, PHOTOMETRIC_LINEAR_RAW) \
+            and values.get(273) and values.get(279):
+        ranges.append((values[273], values[279]))
+    return ranges
+
+
+def _sub_ifd_offsets(handler, entries):
+    for entry in entries:
+        if entry[0] == SUB_IFDS_TAG:
+            offsets = handler._read_values([entry])[0]
+            if offsets is None:
+                return []
+            elif isinstance(offsets, int):
+                return [offsets]
+            return list(offsets)
+    return []
@@ -0,0 +1,311 @@
+# Copyright (c) 2015 Simon Kennedy <sffjunkie+code@gmail.com>
+
+"""Read rectangular regions of the pixels of a TIFF image.
+
+Only the strips or tiles which intersect the region are read. Their data is
+fetched in offset order, decompressed on a pool of threads (zlib releases
+the GIL while it works) and copied into a NumPy array.
+
+LZW and PackBits data is decoded by imagecodecs when it is installed, which
+also releases the GIL. Otherwise it is decoded in pure Python, which holds
+the GIL, so these blocks are decoded on a pool of processes instead.
+"""
+
+import zlib
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+from mogul.media.tiff import TIFFError
+
+__all__ = ['TIFFRegionReader', 'tiff_decompress']
+
+COMPRESSION_NONE = 1
+COMPRESSION_LZW = 5
+COMPRESSION_DEFLATE = 8
+COMPRESSION_PACKBITS = 32773
+COMPRESSION_DEFLATE_OLD = 32946
+
+PREDICTOR_HORIZONTAL = 2
+PREDICTOR_FLOAT = 3
+
+_SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+class TIFFRegionReader(object):
+    """Read regions of an image in the file read by a TIFFHandler.
+
+    `entry` is the MediaEntry of the image, by default the first.
+    """
+
+    def __init__(self, handler, entry=None):
+        if numpy is None:
+            raise TIFFError('TIFF: NumPy is needed to read pixel data')
+
+        if entry is None:
+            entry = handler.container.entries[0]
+        metadata = entry.metadata
+
+        self._handler = handler
+        self.width = _first(metadata['image_width'])
+        self.height = _first(metadata['image_height'])
+        self.samples = _first(metadata.get('samples_per_pixel', 1))
+
+        bits = set(_list(metadata.get('bits_per_sample', 1)))
+        if len(bits) != 1 or list(bits)[0] not in (8, 16, 32, 64):
+            raise TIFFError('TIFF: Unsupported bits per sample %s' %
+                            sorted(bits))
+        self.bits_per_sample = list(bits)[0]
+
+        sample_format = _first(metadata.get(339, 1))
+        if sample_format not in _SAMPLE_KINDS:
+            raise TIFFError('TIFF: Unsupported sample format %d' %
+                            sample_format)
+        self.dtype = numpy.dtype('%s%s%d' % (handler.endian,
+                                             _SAMPLE_KINDS[sample_format],
+                                             self.bits_per_sample // 8))
+
+        self.compression = _first(metadata.get('compression', 1))
+        self.predictor = _first(metadata.get(317, 1))
+        self.planar = _first(metadata.get(284, 1)) == 2
+
+        if 324 in metadata:
+            self.tiled = True
+            self.block_width = _first(metadata[322])
+            self.block_height = _first(metadata[323])
+            self.offsets = _list(metadata[324])
+            self.byte_counts = _list(metadata[325])
+        else:
+            self.tiled = False
+            self.block_width = self.width
+            self.block_height = min(_first(metadata.get('rows_per_strip',
+                                                        self.height)),
+                                    self.height)
+            self.offsets = _list(metadata['strip_offsets'])
+            self.byte_counts = _list(metadata['strip_byte_counts'])
+
+        self.blocks_across = -(-self.width // self.block_width)
+        self.blocks_down = -(-self.height // self.block_height)
+
+    def read_region(self, x, y, width, height, workers=None):
+        """Read the pixels in the rectangle with its top left corner at
+        (`x`, `y`), decompressing the blocks on `workers` threads, or
+        processes for LZW and PackBits data without imagecodecs.
+
+        Returns an array of shape (height, width, samples), or (height,
+        width) for images with one sample per pixel, clipped to the image.
+        """
+
+        x0 = max(x, 0)
+        y0 = max(y, 0)
+        x1 = min(x + width, self.width)
+        y1 = min(y + height, self.height)
+        if x1 <= x0 or y1 <= y0:
+            raise TIFFError('TIFF: Region is outside the image')
+
+        blocks = self._blocks(x0, y0, x1, y1)
+
+        # Blocks with no data are sparse and read as zeros
+        data = dict(self._handler._read_ranges(
+            [(self.offsets[index], self.byte_counts[index], index)
+             for index, _plane, _bx, _by in blocks
+             if self.byte_counts[index] > 0]))
+        data = [data.pop(index, b'') for index, _plane, _bx, _by in blocks]
+        rows = [min(self.block_height, self.height - by)
+                if not self.tiled else self.block_height
+                for _index, _plane, _bx, by in blocks]
+
+        compression = self.compression
+        if compression in (COMPRESSION_LZW, COMPRESSION_PACKBITS) and \
+                imagecodecs is None and workers != 1 and len(blocks) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                data = list(executor.map(tiff_decompress, data,
+                                         repeat(compression)))
+            compression = COMPRESSION_NONE
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            decoded = list(executor.map(self._decode_block, data, rows,
+                                        repeat(compression)))
+
+        region = numpy.zeros((y1 - y0, x1 - x0, self.samples),
+                             dtype=self.dtype.newbyteorder('='))
+        for (index, plane, bx, by), pixels in zip(blocks, decoded):
+            sx0 = max(x0, bx)
+            sy0 = max(y0, by)
+            sx1 = min(x1, bx + self.block_width)
+            sy1 = min(y1, by + pixels.shape[0])
+            source = pixels[sy0 - by:sy1 - by, sx0 - bx:sx1 - bx]
+            target = region[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0]
+            if self.planar:
+                target[:, :, plane] = source[:, :, 0]
+            else:
+                target[:] = source
+
+        if self.samples == 1:
+            region = region[:, :, 0]
+        return region
+
+    def _blocks(self, x0, y0, x1, y1):
+        """(index, plane, x, y) of the blocks which intersect the region"""
+
+        across = range(x0 // self.block_width,
+                       (x1 - 1) // self.block_width + 1)
+        down = range(y0 // self.block_height,
+                     (y1 - 1) // self.block_height + 1)
+        planes = range(self.samples) if self.planar else [0]
+        per_plane = self.blocks_across * self.blocks_down
+
+        blocks = []
+        for plane in planes:
+            for row in down:
+                for column in across:
+                    index = plane * per_plane + row * self.blocks_across + \
+                        column
+                    blocks.append((index, plane, column * self.block_width,
+                                   row * self.block_height))
+        return blocks
+
+    def _decode_block(self, data, rows, compression):
+        """Decompress a strip or tile into an array of shape (rows,
+        block width, samples)"""
+
+        samples = 1 if self.planar else self.samples
+        if len(data) > 0:
+            data = tiff_decompress(data, compression)
+
+        size = rows * self.block_width * samples * self.dtype.itemsize
+        if len(data) < size:
+            data = data + b'\x00' * (size - len(data))
+
+        if self.predictor == PREDICTOR_FLOAT:
+            return self._undo_float_predictor(data[:size], rows, samples)
+
+        pixels = numpy.frombuffer(data, dtype=self.dtype, count=size //
+                                  self.dtype.itemsize)
+        pixels = pixels.reshape(rows, self.block_width, samples)
+
+        if self.predictor == PREDICTOR_HORIZONTAL:
+            # Differences wrap around at the width of the unsigned type
+            unsigned = pixels.astype(self.dtype.newbyteorder('='))
+            unsigned = unsigned.view('u%d' % self.dtype.itemsize)
+            pixels = numpy.cumsum(unsigned, axis=1, dtype=unsigned.dtype)
+            pixels = pixels.view(self.dtype.newbyteorder('='))
+        return pixels
+
+    def _undo_float_predictor(self, data, rows, samples):
+        """Floating point predictor, each row holds the differences of the
+        bytes of its values with the most significant bytes first. Each
+        byte is the difference from the byte `samples` bytes before it."""
+
+        itemsize = self.dtype.itemsize
+        count = self.block_width * samples
+        planes = numpy.frombuffer(data, dtype=numpy.uint8)
+        planes = planes.reshape(rows, count * itemsize // samples, samples)
+        planes = numpy.cumsum(planes, axis=1, dtype=numpy.uint8)
+        planes = planes.reshape(rows, itemsize, count).transpose(0, 2, 1)
+
+        pixels = numpy.ascontiguousarray(planes).view('>f%d' % itemsize)
+        return pixels.reshape(rows, self.block_width, samples)
+
+
+def tiff_decompress(data, compression):
+    """Decompress the data of a strip or tile"""
+
+    if compression == COMPRESSION_NONE:
+        return data
+    elif compression == COMPRESSION_DEFLATE or \
+            compression == COMPRESSION_DEFLATE_OLD:
+        return zlib.decompress(data)
+    elif compression == COMPRESSION_LZW:
+        if imagecodecs is not None:
+            return imagecodecs.lzw_decode(data)
+        return _lzw_decode(data)
+    elif compression == COMPRESSION_PACKBITS:
+        if imagecodecs is not None:
+            return imagecodecs.packbits_decode(data)
+        return _packbits_decode(data)
+    else:
+        raise TIFFError('TIFF: Unsupported compression %d' % compression)
+
+
+def _packbits_decode(data):
+    output = bytearray()
+    pos = 0
+    while pos < len(data):
+        header = data[pos]
+        pos += 1
+        if header < 128:
+            output += data[pos:pos + header + 1]
+            pos += header + 1
+        elif header > 128:
+            output += data[pos:pos + 1] * (257 - header)
+            pos += 1
+    return bytes(output)
+
+
+def _lzw_decode(data):
+    """Decode TIFF LZW data, codes are packed most significant bit first
+    and the code width increases one code early"""
+
+    output = bytearray()
+    table = [bytes([code]) for code in range(256)] + [b'', b'']
+    width = 9
+    previous = None
+
+    bits = 0
+    bit_count = 0
+    pos = 0
+    while True:
+        while bit_count < width:
+            if pos >= len(data):
+                return bytes(output)
+            bits = (bits << 8) | data[pos]
+            pos += 1
+            bit_count += 8
+
+        bit_count -= width
+        code = bits >> bit_count
+        bits &= (1 << bit_count) - 1
+
+        if code == 256:
+            del table[258:]
+            width = 9
+            previous = None
+            continue
+        elif code == 257:
+            break
+
+        if previous is None:
+            entry = table[code]
+        else:
+            if code < len(table):
+                entry = table[code]
+            else:
+                entry = previous + previous[:1]
+            table.append(previous + entry[:1])
+            if len(table) >= (1 << width) - 1 and width < 12:
+                width += 1
+
+        output += entry
+        previous = entry
+
+    return bytes(output)
+
+
+def _list(value):
+    if isinstance(value, (int, float)):
+        return [value]
+    return list(value)
+
+
+def _first(value):
+    return _list(value)[0]
@@ -0,0 +1,227 @@
+# Copyright (c) 2015 Simon Kennedy <sffjunkie+code@gmail.com>
+
+"""Write TIFF and Big TIFF images strip by strip or tile by tile.
+
+Strips and tiles are written as they are produced so only the offset and
+size of each is held in memory. The IFD is written after the image data and
+the header is rewritten to point to it, as a Big TIFF header when the file
+is too large for 32 bit offsets. Deflate compression can be spread over a
+pool of threads, with a bounded number of blocks in flight.
+"""
+
+import os
+import zlib
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from mogul.media.tiff import TIFFHandler, TIFFError
+
+__all__ = ['TIFFWriter']
+
+COMPRESSION_NONE = 1
+COMPRESSION_DEFLATE = 8
+
+PHOTOMETRIC_MIN_IS_BLACK = 1
+PHOTOMETRIC_RGB = 2
+
+EXTRA_SAMPLE_UNASSOCIATED_ALPHA = 2
+
+# Largest offset in a standard TIFF file
+MAX_OFFSET = 0xffffffff
+
+# Header padded to the size of a Big TIFF header
+HEADER_SIZE = 16
+
+
+class TIFFWriter(object):
+    """Write an image of `width` by `height` pixels to the seekable stream
+    `ds`.
+
+    The image is stored in strips of `rows_per_strip` rows, or in tiles when
+    `tile` is a (width, height) tuple. `big` is True or False to force a
+    Big TIFF or standard file, by default a Big TIFF file is written only
+    when it is needed. `tags` is a list of extra (tag, field type, values)
+    to add to the IFD.
+    """
+
+    def __init__(self, ds, width, height, samples=1, bits_per_sample=8,
+                 sample_format=1, photometric=None, compression=COMPRESSION_NONE,
+                 rows_per_strip=None, tile=None, endian='<', big=None,
+                 workers=None, level=6, tags=None):
+        if compression not in (COMPRESSION_NONE, COMPRESSION_DEFLATE):
+            raise TIFFError('TIFF: Unsupported compression %d' % compression)
+
+        self.width = width
+        self.height = height
+        self.samples = samples
+        self.bits_per_sample = bits_per_sample
+        self.sample_format = sample_format
+        self.compression = compression
+        self.level = level
+        self.workers = workers
+        self.big = big
+        self.tags = list(tags or [])
+
+        if photometric is None:
+            photometric = PHOTOMETRIC_RGB if samples >= 3 else \
+                PHOTOMETRIC_MIN_IS_BLACK
+        self.photometric = photometric
+
+        pixel_bits = samples * bits_per_sample
+        if tile is not None:
+            self.tiled = True
+            self.block_width, self.block_height = tile
+            if self.block_width % 16 or self.block_height % 16:
+                raise TIFFError('TIFF: Tile sizes must be multiples of 16')
+        else:
+            self.tiled = False
+            self.block_width = width
+            if rows_per_strip is None:
+                # About 64KiB per strip
+                row_size = (width * pixel_bits + 7) // 8
+                rows_per_strip = max(65536 // max(row_size, 1), 1)
+            self.block_height = min(rows_per_strip, height)
+
+        self._row_size = (self.block_width * pixel_bits + 7) // 8
+        self.block_count = -(-width // self.block_width) * \
+            -(-height // self.block_height)
+
+        self.offsets = array('Q')
+        self.byte_counts = array('Q')
+
+        self._ds = ds
+        self._handler = TIFFHandler()
+        self._handler._writes = ds
+        self._handler._write_base = ds.tell()
+        self._handler._write_header(endian, False)
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def write(self, blocks):
+        """Write the strips or tiles produced by the iterable `blocks`,
+        each a bytes like object holding the samples of one block.
+
+        Tiles are in rows from the top left of the image, each holding a
+        full tile. Strips hold `rows_per_strip` rows, apart from the last.
+        """
+
+        if self.workers is None or self.compression == COMPRESSION_NONE:
+            for block in blocks:
+                self._write_block(self._compress(block))
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for block in blocks:
+                pending.append(executor.submit(self._compress, block))
+                if len(pending) >= self.workers * 2:
+                    self._write_block(pending.popleft().result())
+
+            while len(pending) > 0:
+                self._write_block(pending.popleft().result())
+
+    def close(self):
+        """Write the IFD and point the header to it"""
+
+        if self._closed:
+            return
+        self._closed = True
+
+        if len(self.offsets) != self.block_count:
+            raise TIFFError('TIFF: %d of %d blocks written' %
+                            (len(self.offsets), self.block_count))
+
+        handler = self._handler
+        self._ds.seek(0, os.SEEK_END)
+        data_end = self._ds.tell() - handler._write_base
+
+        # Upper bound for the end of the IFD of a standard file
+        ifd_end = data_end + 4096 + len(self.tags) * 12 + \
+            self.block_count * 8 + \
+            sum([len(handler._write_value(field_type, value)[1])
+                 for _tag, field_type, value in self.tags])
+
+        big = self.big
+        if big is None:
+            big = ifd_end > MAX_OFFSET
+        elif not big and ifd_end > MAX_OFFSET:
+            raise TIFFError('TIFF: Image is too large for a standard TIFF file')
+
+        handler._set_format(handler.endian, big)
+        offset, _next = handler._write_ifd(self._ifd_tags(big))
+        handler._write_header(handler.endian, big, offset)
+        self._ds.seek(0, os.SEEK_END)
+
+    def _block_size(self, index):
+        """Size of the samples of block `index`"""
+
+        if self.tiled:
+            return self._row_size * self.block_height
+        rows = min(self.block_height, self.height - index * self.block_height)
+        return self._row_size * rows
+
+    def _compress(self, block):
+        block = memoryview(block)
+        if self.compression == COMPRESSION_DEFLATE:
+            return (block.nbytes, zlib.compress(block, self.level))
+        return (block.nbytes, block)
+
+    def _write_block(self, block):
+        size, data = block
+
+        index = len(self.offsets)
+        if index >= self.block_count:
+            raise TIFFError('TIFF: More than %d blocks written' %
+                            self.block_count)
+        if size != self._block_size(index):
+            raise TIFFError('TIFF: Block %d holds %d bytes, expected %d' %
+                            (index, size, self._block_size(index)))
+
+        self._ds.seek(0, os.SEEK_END)
+        position = self._ds.tell() - self._handler._write_base
+        if position < HEADER_SIZE:
+            self._ds.write(b'\x00' * (HEADER_SIZE - position))
+            position = HEADER_SIZE
+
+        self._ds.write(data)
+        self.offsets.append(position)
+        self.byte_counts.append(len(data))
+
+    def _ifd_tags(self, big):
+        long_type = 16 if big else 4
+
+        tags = [(256, 4, self.width),
+                (257, 4, self.height),
+                (258, 3, [self.bits_per_sample] * self.samples),
+                (259, 3, self.compression),
+                (262, 3, self.photometric),
+                (277, 3, self.samples),
+                (284, 3, 1)]
+
+        if self.sample_format != 1:
+            tags.append((339, 3, [self.sample_format] * self.samples))
+
+        colour_samples = 3 if self.photometric == PHOTOMETRIC_RGB else 1
+        if self.samples > colour_samples:
+            tags.append((338, 3, [EXTRA_SAMPLE_UNASSOCIATED_ALPHA] +
+                         [0] * (self.samples - colour_samples - 1)))
+
+        if self.tiled:
+            tags += [(322, 4, self.block_width),
+                     (323, 4, self.block_height),
+                     (324, long_type, self.offsets),
+                     (325, long_type, self.byte_counts)]
+        else:
+            tags += [(273, long_type, self.offsets),
+                     (278, 4, self.block_height),
+                     (279, long_type, self.byte_counts)]
+
+        written = set([tag[0] for tag in tags])
+        return tags + [tag for tag in self.tags if tag[0] not in written]
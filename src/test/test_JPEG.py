@@ -36,6 +36,7 @@ logger.addHandler(logging.FileHandler(os.path.join(base_path, 'data', 'output',
 logger.setLevel(logging.DEBUG)
 
 from mogul.media.jpeg import JPEGHandler
+from mogul.media.exif import exif_thumbnail
 
 def filename(name):
     return os.path.join(data_path, name)
@@ -52,6 +53,21 @@ def read_JPEG(filename):
 def test_All_JPEG():
     for filename in glob.glob(os.path.join(data_path, '*.jpg')):
         read_JPEG(filename)
+
+def test_All_JPEG_thumbnail():
+    for filename in glob.glob(os.path.join(data_path, '*.jpg')):
+        with open(filename, 'rb') as ds:
+            thumbnail = exif_thumbnail(ds)
+            if thumbnail is None:
+                continue
+            assert thumbnail[:2] == b'\xFF\xD8'
+            
+            ds.seek(0)
+            reference = exif_thumbnail(ds, lazy=True)
+            assert reference.size == len(thumbnail)
+            
+            ds.seek(reference.offset)
+            assert ds.read(reference.size) == thumbnail
         
 if __name__ == '__main__':
     test_All_JPEG()
@@ -4,6 +4,7 @@
 
 import sys
 import glob
+import shutil
 import os.path
 import logging
 
@@ -26,6 +27,15 @@ logger.addHandler(logging.FileHandler(os.path.join(base_path, 'data', 'output',
 logger.setLevel(logging.DEBUG)
 
 from mogul.media.mkv import MKVHandler
+from mogul.media.tag import Tag
+from mogul.media.ebml import (EBML_SCHEMA, CUES_ID, ebml_resync,
+                              ebml_tail_duration, ebml_void)
+from mogul.media.ebml_attachment import (ebml_export_attachments,
+                                         ebml_export_attachments_parallel)
+from mogul.media.ebml_subtitle import ebml_extract_subtitles, TEXT_CODECS
+from mogul.media.ebml_index import (ebml_index, ebml_write_cues, ebml_scan_blocks,
+                                    ebml_scan_blocks_parallel,
+                                    _scan_range_worker)
 
 
 def filename(name):
@@ -52,6 +62,252 @@ def test_All_MKV(all_files=True):
         
         if not all_files:
             break
+
+
+def test_All_MKV_seek_head():
+    for filename in glob.glob(os.path.join(data_path, '*.mkv')):
+        h = MKVHandler()
+        h.read(filename)
+        
+        for entry in h.container.entries:
+            assert 'metadata' not in entry.seek or entry.tick_period > 0
+            if 'tags' in entry.seek:
+                assert len(entry.tag_groups) > 0
+            if 'tracks' in entry.seek:
+                assert len(entry.streams) > 0
+
+
+def test_All_MKV_index():
+    for filename in glob.glob(os.path.join(data_path, '*.mkv')):
+        cache = os.path.join(base_path, 'data', 'output', 'mogul',
+                             '%s.idx' % os.path.basename(filename))
+        if os.path.exists(cache):
+            os.remove(cache)
+        
+        h = MKVHandler()
+        h.read(filename)
+        with open(filename, 'rb') as ds:
+            index = ebml_index(h, ds, cache)
+            cached = ebml_index(h, ds, cache)
+        
+        assert list(index.times) == list(cached.times)
+        assert list(index.cluster_offsets) == list(cached.cluster_offsets)
+        if len(index) > 0:
+            assert index.seek(0) == index.cluster_offsets[0]
+
+
+def test_All_MKV_scan_parallel():
+    for filename in glob.glob(os.path.join(data_path, '*.mkv')):
+        h = MKVHandler()
+        h.read(filename)
+        start = h.container.entries[0].segment_offset
+        
+        with open(filename, 'rb') as ds:
+            blocks = ebml_scan_blocks(ds, start)
+        
+        size = os.path.getsize(filename)
+        parallel = ebml_scan_blocks_parallel(filename, start, workers=4,
+                                             min_range_size=size // 16 + 1)
+        for name in blocks._arrays():
+            assert getattr(blocks, name) == getattr(parallel, name)
+
+
+def test_All_MKV_scan_parallel_workers():
+    for filename in glob.glob(os.path.join(data_path, '*.mkv')):
+        h = MKVHandler()
+        h.read(filename)
+        start = h.container.entries[0].segment_offset
+        
+        with open(filename, 'rb') as ds:
+            blocks = ebml_scan_blocks(ds, start)
+        
+        clusters = sorted(set(blocks.cluster_offsets))
+        if len(clusters) < 2:
+            continue
+        
+        # Two workers each scan a range, the second finding its own Cluster
+        size = os.path.getsize(filename)
+        results = [_scan_range_worker(filename, start, clusters[1], True),
+                   _scan_range_worker(filename, clusters[0] + 1, size, False)]
+        assert results[0][0] == start
+        assert results[1][0] == clusters[1]
+        assert len(results[0][1]) > 0
+        assert len(results[1][1]) > 0
+        assert len(results[0][1]) + len(results[1][1]) == len(blocks)
+
+
+def test_All_MKV_resync():
+    for filename in glob.glob(os.path.join(data_path, '*.mkv')):
+        with open(filename, 'rb') as ds:
+            ds.seek(1)
+            offset = ebml_resync(ds, window=4096)
+            assert offset is not None
+            assert ds.read(4) == b'\x18\x53\x80\x67'
+
+
+def test_MKV_schema():
+    h = MKVHandler()
+    assert len(h._elements) == len(EBML_SCHEMA)
+    assert all([isinstance(element_id, int) for element_id in h._elements])
+    assert h._elements is MKVHandler()._elements
+
+
+def test_All_MKV_write_tags():
+    for filename in glob.glob(os.path.join(data_path, '*.mkv')):
+        output = os.path.join(base_path, 'data', 'output', 'mogul',
+                              'tags_%s' % os.path.basename(filename))
+        shutil.copyfile(filename, output)
+        
+        h = MKVHandler()
+        h.read(output)
+        groups = h.container.entries[0].tag_groups
+        if len(groups) == 0:
+            continue
+        
+        groups[0].tags.append(Tag('COMMENT', 'Written by mogul'))
+        h.write_tags(output)
+        
+        h = MKVHandler()
+        h.read(output)
+        tags = h.container.entries[0].tag_groups[0].tags
+        assert tags[-1].name == 'COMMENT'
+        assert tags[-1].value == 'Written by mogul'
+
+
+def test_All_MKV_write_unread():
+    for filename in glob.glob(os.path.join(data_path, '*.mkv')):
+        output = os.path.join(base_path, 'data', 'output', 'mogul',
+                              'unread_%s' % os.path.basename(filename))
+        shutil.copyfile(filename, output)
+        
+        # The handler has not read a file so the file's own are rewritten
+        MKVHandler().write_tags(output)
+        MKVHandler().write_attachments(output)
+        
+        h = MKVHandler()
+        h.read(output)
+        source = MKVHandler()
+        source.read(filename)
+        assert len(h.container.entries[0].tag_groups) == \
+            len(source.container.entries[0].tag_groups)
+        assert len(h.container.entries[0].attachments) == \
+            len(source.container.entries[0].attachments)
+
+
+def test_All_MKV_write_cues():
+    for filename in glob.glob(os.path.join(data_path, '*.mkv')):
+        output = os.path.join(base_path, 'data', 'output', 'mogul',
+                              'cues_%s' % os.path.basename(filename))
+        shutil.copyfile(filename, output)
+        
+        count = ebml_write_cues(MKVHandler(), output)
+        
+        h = MKVHandler()
+        h.read(output)
+        assert len(h.container.entries[0].cues.times) == count
+
+
+def test_All_MKV_write_cues_into_void():
+    for filename in glob.glob(os.path.join(data_path, '*.mkv')):
+        output = os.path.join(base_path, 'data', 'output', 'mogul',
+                              'void_%s' % os.path.basename(filename))
+        shutil.copyfile(filename, output)
+        ebml_write_cues(MKVHandler(), output)
+        
+        # Replace the Cues with a Void element of the same size
+        h = MKVHandler()
+        h.read(output)
+        offset, size = [(offset, size) for element_id, offset, size in
+                        h._segment_elements if element_id == CUES_ID][0]
+        with open(output, 'r+b') as ds:
+            ds.seek(offset)
+            ds.write(ebml_void(size))
+        
+        before = os.path.getsize(output)
+        count = ebml_write_cues(MKVHandler(), output)
+        assert os.path.getsize(output) == before
+        
+        h = MKVHandler()
+        h.read(output)
+        assert len(h.container.entries[0].cues.times) == count
+
+
+def test_All_MKV_tail_duration():
+    for filename in glob.glob(os.path.join(data_path, '*.mkv')):
+        h = MKVHandler()
+        h.read(filename)
+        entry = h.container.entries[0]
+        
+        with open(filename, 'rb') as ds:
+            ticks = ebml_tail_duration(ds, entry.segment_offset,
+                                       os.path.getsize(filename))
+        
+        assert ticks is not None
+        if entry.ticks > 0:
+            # The last block's own duration is not known
+            assert abs(entry.ticks - ticks) * entry.tick_period < 1000000000
+
+
+def test_All_MKV_extract_subtitles():
+    for filename in glob.glob(os.path.join(data_path, '*.mkv')):
+        h = MKVHandler()
+        h.read(filename)
+        
+        for stream in h.container.entries[0].streams:
+            codec = getattr(stream, 'codec', b'').decode('ascii', 'replace')
+            if codec not in TEXT_CODECS:
+                continue
+            
+            output = os.path.join(base_path, 'data', 'output', 'mogul',
+                                  '%s.%d.srt' % (os.path.basename(filename),
+                                                 stream.number))
+            with open(filename, 'rb') as ds, open(output, 'w') as fp:
+                count = ebml_extract_subtitles(h, ds, fp, stream.number)
+            
+            with open(output) as fp:
+                assert fp.read().count(' --> ') == count
+
+
+def test_All_MKV_export_attachments():
+    filenames = glob.glob(os.path.join(data_path, '*.mkv'))
+    output = os.path.join(base_path, 'data', 'output', 'mogul', 'attachments')
+    exported = ebml_export_attachments_parallel(filenames, output, workers=2)
+    
+    for filename in filenames:
+        h = MKVHandler()
+        h.read(filename)
+        attachments = h.container.entries[0].attachments
+        
+        written = ebml_export_attachments(filename, output)
+        assert len(written) == len(attachments)
+        assert len(exported[filename]) == len(attachments)
+        for attachment, path in zip(attachments, written):
+            assert os.path.getsize(path) == attachment['data'][1]
+
+
+def test_MKV_export_attachments_same_name():
+    filenames = glob.glob(os.path.join(data_path, '*.mkv'))
+    if len(filenames) == 0:
+        return
+    
+    output = os.path.join(base_path, 'data', 'output', 'mogul', 'same_name')
+    sources = []
+    for idx in range(2):
+        directory = os.path.join(output, 'source%d' % idx)
+        os.makedirs(directory, exist_ok=True)
+        sources.append(shutil.copy(filenames[0], directory))
+    
+    broken = os.path.join(output, 'broken.mkv')
+    with open(broken, 'wb') as fp:
+        fp.write(b'\x1a\x45\xdf\xa3\xff')
+    
+    exported = ebml_export_attachments_parallel(sources + [broken],
+                                                os.path.join(output, 'out'),
+                                                workers=2)
+    assert isinstance(exported[broken], Exception)
+    
+    written = exported[sources[0]] + exported[sources[1]]
+    assert len(set(written)) == len(written)
     
     
 if __name__ == '__main__':
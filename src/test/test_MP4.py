@@ -12,8 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
 import sys
 import glob
+import shutil
 import os.path
 import logging
 
@@ -35,7 +37,12 @@ logger.addHandler(logging.StreamHandler())
 logger.addHandler(logging.FileHandler(os.path.join(base_path, 'data', 'output', 'mogul', 'run.txt')))
 logger.setLevel(logging.DEBUG)
 
-from mogul.media.mp4 import MP4Handler    
+from mogul.media.mp4 import MP4Handler, MP4Exception
+from mogul.media.mp4_segment import MP4Segment, mp4_segment_manifest, mp4_sidx
+from mogul.media.mp4_fragment import MP4Fragmenter
+from mogul.media.mp4_demux import MP4Demuxer, ADTSWriter
+from mogul.media.mp4_interleave import mp4_interleave
+from mogul.media.mp4_trim import MP4Trimmer
 
 def filename(name):
     return os.path.join(data_path, name)
@@ -53,7 +60,110 @@ def read_MP4(filename):
 def test_All_MP4():
     for filename in glob.glob(os.path.join(data_path, '*.mp4')):
         read_MP4(filename)
+
+def write_MP4_tags(filename):
+    output = os.path.join(base_path, 'data', 'output', 'mogul',
+                          os.path.basename(filename))
+    shutil.copyfile(filename, output)
+
+    h = MP4Handler()
+    h.write_tags(output, {'title': 'mogul.media', 'track': (1, 2)})
+
+    h = MP4Handler()
+    with open(output, 'rb') as ds:
+        h.read_stream(ds)
+    assert h.find_box((b'moov', b'udta', b'meta', b'ilst')) is not None
+
+def test_MP4_encode_integers():
+    h = MP4Handler()
+    assert h._encode_meta_data(b'tmpo', 120) == (0x15, b'\x00\x78')
+    assert h._encode_meta_data(b'cpil', 1) == (0x15, b'\x01')
+    try:
+        h._encode_meta_data(b'tmpo', -1)
+        assert False
+    except ValueError:
+        pass
+
+def test_All_MP4_write_tags():
+    for filename in glob.glob(os.path.join(data_path, '*.mp4')):
+        write_MP4_tags(filename)
+
+def test_All_MP4_segments():
+    for filename in glob.glob(os.path.join(data_path, '*.mp4')):
+        h = MP4Handler()
+        h.read(filename)
+        manifest = mp4_segment_manifest(h, 2.0)
+        assert len(manifest['segments']) > 0
+
+def test_All_MP4_sidx_overlap():
+    for filename in glob.glob(os.path.join(data_path, '*.mp4')):
+        h = MP4Handler()
+        h.read(filename)
+        
+        # Start offsets in order but the ranges of the segments interleave
+        first = MP4Segment(0, 1000)
+        first.ranges = [(100, 50), (300, 50)]
+        second = MP4Segment(1000, 1000)
+        second.ranges = [(200, 50), (400, 50)]
+        try:
+            mp4_sidx(h, [first, second])
+            assert False
+        except MP4Exception:
+            pass
     
+def test_All_MP4_fragment():
+    for filename in glob.glob(os.path.join(data_path, '*.mp4')):
+        output = os.path.join(base_path, 'data', 'output', 'mogul',
+                              'frag_%s' % os.path.basename(filename))
+        with open(filename, 'rb') as ds:
+            h = MP4Handler()
+            h.read_stream(ds)
+            with open(output, 'wb') as out:
+                MP4Fragmenter(h, ds).write(out)
+
+def test_All_MP4_demux():
+    for filename in glob.glob(os.path.join(data_path, '*.mp4')):
+        with open(filename, 'rb') as ds:
+            h = MP4Handler()
+            h.read_stream(ds)
+            demuxer = MP4Demuxer(h, ds)
+            for stream in h.container.entries[0].streams:
+                if stream.codec in [b'mp4a', b'avc1']:
+                    output = os.path.join(base_path, 'data', 'output', 'mogul',
+                        '%s.%d.es' % (os.path.basename(filename), stream.id))
+                    with open(output, 'wb') as out:
+                        demuxer.write_track(stream.id, out)
+
+def test_MP4_adts_he_aac():
+    # HE-AAC, 24000Hz AAC-LC core with a 48000Hz SBR extension, stereo
+    out = io.BytesIO()
+    ADTSWriter(b'\x2b\x11\x88').write(out, b'abc', True)
+    assert out.getvalue() == b'\xff\xf1\x58\x80\x01\x5f\xfcabc'
+
+def test_All_MP4_interleave():
+    for filename in glob.glob(os.path.join(data_path, '*.mp4')):
+        h = MP4Handler()
+        h.read(filename)
+        result = mp4_interleave(h)
+        logger.debug('%s: lookahead %d bytes, %.2fs' % (filename,
+            result.lookahead, result.lookahead_duration))
+
+def test_All_MP4_trim():
+    for filename in glob.glob(os.path.join(data_path, '*.mp4')):
+        output = os.path.join(base_path, 'data', 'output', 'mogul',
+                              'trim_%s' % os.path.basename(filename))
+        with open(filename, 'rb') as ds:
+            h = MP4Handler()
+            h.read_stream(ds)
+            with open(output, 'wb') as out:
+                start, end = MP4Trimmer(h, ds).write(out, 1.0, 3.0)
+        
+        t = MP4Handler()
+        t.read(output)
+        assert start <= 1.0
+        assert len(t.container.entries[0].streams) == \
+            len(h.container.entries[0].streams)
+
 if __name__ == '__main__':
     #test_All_MP4()
     read_MP4(filename('test2.mp4'))
@@ -16,6 +16,8 @@ import sys
 import glob
 import os.path
 import logging
+import tempfile
+from io import BytesIO
 
 test_path = os.path.abspath(os.path.dirname(__file__))
 
@@ -35,7 +37,11 @@ logger.addHandler(logging.StreamHandler())
 logger.addHandler(logging.FileHandler(os.path.join(base_path, 'data', 'output', 'mogul', 'run.txt')))
 logger.setLevel(logging.DEBUG)
 
-from mogul.media.tiff import TIFFHandler
+from mogul.media.tiff import TIFFHandler, TIFFIFD, TIFFError, TIFFPageIndex
+from mogul.media.tiff_region import TIFFRegionReader
+from mogul.media.tiff_geo import GeoTIFFReader
+from mogul.media.tiff_writer import TIFFWriter
+from mogul.media.tiff_raw import raw_format, raw_preview
 
 def filename(name):
     return os.path.join(data_path, name)
@@ -54,6 +60,173 @@ def test_All_TIFF():
     for filename in glob.glob(os.path.join(data_path, '*.tif')):
         read_TIFF(filename)
 
+def test_All_TIFF_strips():
+    for filename in glob.glob(os.path.join(data_path, '*.tif')):
+        h = TIFFHandler()
+        h.read(filename)
+        
+        for entry in h.container.entries:
+            offsets = entry.metadata.get('strip_offsets', None)
+            if offsets is not None and not isinstance(offsets, int):
+                assert len(offsets) == len(entry.metadata['strip_byte_counts'])
+
+def test_All_TIFF_lazy():
+    for filename in glob.glob(os.path.join(data_path, '*.tif')):
+        h = TIFFHandler()
+        h.read(filename)
+        
+        for entry in h.container.entries:
+            metadata = entry.metadata
+            assert isinstance(metadata, TIFFIFD)
+            
+            # Values are decoded from the file after it has been closed
+            for key in list(metadata):
+                assert key in metadata
+                metadata[key]
+            
+            assert len(metadata.copy()) == len(metadata)
+
+def test_All_TIFF_region():
+    for filename in glob.glob(os.path.join(data_path, '*.tif')):
+        h = TIFFHandler()
+        h.read(filename)
+        
+        try:
+            reader = TIFFRegionReader(h)
+        except TIFFError:
+            continue
+        
+        image = reader.read_region(0, 0, reader.width, reader.height)
+        assert image.shape[:2] == (reader.height, reader.width)
+        
+        half = reader.height // 2
+        if half > 0:
+            top = reader.read_region(0, 0, reader.width, half, workers=2)
+            bottom = reader.read_region(0, half, reader.width,
+                                        reader.height - half, workers=2)
+            assert (image[:half] == top).all()
+            assert (image[half:] == bottom).all()
+
+def test_All_TIFF_geo():
+    for filename in glob.glob(os.path.join(data_path, '*.tif')):
+        h = TIFFHandler()
+        h.read(filename)
+        
+        try:
+            reader = GeoTIFFReader(h)
+        except TIFFError:
+            continue
+        
+        full = reader.levels[0]
+        widths = [level.width for level in reader.levels]
+        assert widths == sorted(widths, reverse=True)
+        assert reader.select_level() is full
+        
+        left, top = reader.pixel_to_model(0, 0)
+        right, bottom = reader.pixel_to_model(full.width, full.height)
+        bbox = (min(left, right), min(top, bottom),
+                max(left, right), max(top, bottom))
+        assert reader.window(bbox) == (0, 0, full.width, full.height)
+        
+        coarsest = reader.levels[-1]
+        resolution = max(reader.level_resolution(coarsest))
+        assert reader.select_level(resolution) is coarsest
+
+def test_All_TIFF_page_index():
+    cache = os.path.join(tempfile.mkdtemp(), 'pages.idx')
+    for filename in glob.glob(os.path.join(data_path, '*.tif')):
+        h = TIFFHandler()
+        h.read(filename)
+        entries = h.container.entries
+        
+        with open(filename, 'rb') as ds:
+            indexer = TIFFHandler()
+            pages = indexer.read_index(ds, cache=cache)
+            assert len(pages) == len(entries)
+            
+            for number, entry in enumerate(entries):
+                assert pages.offsets[number] == entry.metadata.offset
+                assert pages.widths[number] == entry.metadata['image_width']
+                
+                page = indexer.page(number)
+                assert sorted(page.metadata, key=str) == \
+                    sorted(entry.metadata, key=str)
+            
+            cached = TIFFPageIndex.load(cache, os.fstat(ds.fileno()))
+            assert list(cached.offsets) == list(pages.offsets)
+        os.remove(cache)
+
+def test_All_TIFF_write():
+    for filename in glob.glob(os.path.join(data_path, '*.tif')):
+        h = TIFFHandler()
+        h.read(filename)
+        
+        try:
+            reader = TIFFRegionReader(h)
+        except TIFFError:
+            continue
+        
+        image = reader.read_region(0, 0, reader.width, reader.height)
+        image = image.reshape(reader.height, reader.width, reader.samples)
+        
+        ds = BytesIO()
+        writer = TIFFWriter(ds, reader.width, reader.height, reader.samples,
+                            reader.bits_per_sample,
+                            {'u': 1, 'i': 2, 'f': 3}[image.dtype.kind],
+                            compression=8, rows_per_strip=16, workers=2)
+        writer.write(image[row:row + 16].tobytes()
+                     for row in range(0, reader.height, 16))
+        writer.close()
+        
+        ds.seek(0)
+        written = TIFFHandler()
+        written.read_stream(ds, len(ds.getvalue()))
+        copy = TIFFRegionReader(written).read_region(0, 0, reader.width,
+                                                     reader.height)
+        assert (copy.reshape(image.shape) == image).all()
+
+def test_TIFF_float_predictor_samples():
+    import numpy
+    
+    width, height, samples = 11, 7, 3
+    image = (numpy.arange(width * height * samples, dtype='f4') * 1.37 - 20) ** 2
+    image = image.reshape(height, width, samples)
+    
+    # Each row holds the byte planes of its big endian values, each byte
+    # the difference from the byte of the previous pixel
+    rows = numpy.frombuffer(image.astype('>f4').tobytes(), dtype=numpy.uint8)
+    rows = rows.reshape(height, width * samples, 4).transpose(0, 2, 1)
+    rows = rows.reshape(height, -1).astype(numpy.int16)
+    rows[:, samples:] -= rows[:, :-samples].copy()
+    
+    ds = BytesIO()
+    writer = TIFFWriter(ds, width, height, samples, 32, 3,
+                        rows_per_strip=height, tags=[(317, 3, 3)])
+    writer.write([(rows & 0xff).astype(numpy.uint8).tobytes()])
+    writer.close()
+    
+    ds.seek(0)
+    h = TIFFHandler()
+    h.read_stream(ds, len(ds.getvalue()))
+    region = TIFFRegionReader(h).read_region(0, 0, width, height)
+    assert (region == image).all()
+
+def test_All_TIFF_raw_preview():
+    for filename in glob.glob(os.path.join(data_path, '*.tif')):
+        with open(filename, 'rb') as ds:
+            mimetype = raw_format(ds)
+            
+            ds.seek(0)
+            preview = raw_preview(ds)
+            if mimetype is not None:
+                assert preview is not None
+            if preview is None:
+                continue
+            
+            ds.seek(preview.offset)
+            assert ds.read(2) == b'\xFF\xD8'
+            assert preview.offset + preview.size <= os.path.getsize(filename)
+
 if __name__ == '__main__':
     #test_All_TIFF()
     read_TIFF(filename('0c84d07e1b22b76f24cccc70d8788e4a.tif'))
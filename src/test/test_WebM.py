@@ -36,6 +36,7 @@ logger.addHandler(logging.FileHandler(os.path.join(base_path, 'data', 'output',
 logger.setLevel(logging.DEBUG)
 
 from mogul.media.webm import WebMHandler
+from mogul.media.ebml_stream import EBMLStreamParser
 
 def filename(name):
     return os.path.join(data_path, name)
@@ -53,6 +54,27 @@ def read_WebM(filename):
 def test_All_WebM():
     for filename in glob.glob(os.path.join(data_path, '*.webm')):
         read_WebM(filename)
+
+def test_All_WebM_stream():
+    for filename in glob.glob(os.path.join(data_path, '*.webm')):
+        h = WebMHandler()
+        h.read(filename)
+        
+        parser = EBMLStreamParser()
+        events = []
+        with open(filename, 'rb') as ds:
+            while True:
+                data = ds.read(4096)
+                if not data:
+                    break
+                events.extend(parser.feed(data))
+        events.extend(parser.close())
+        
+        starts = [e for e in events if e.kind == 'start']
+        ends = [e for e in events if e.kind == 'end']
+        assert len(starts) == len(ends)
+        assert len(parser.tracks) == len(h.container.entries[0].streams)
+        assert parser.duration > 0
     
 if __name__ == '__main__':
     test_All_WebM()